@@ -98,7 +98,9 @@ class Int8EntropyCalibrator(trt.IInt8EntropyCalibrator2):
         self.currentIndex = 0
         self.PreProcessedSetPath = calibrationSetPath + '/PreProcessedSet'
         self.PreProcessedSetCount = calibSet.max
-        self.PreProcessedSize = calibSet.first().size * 4 # float 32
+        # The calibration samples keep their own element type, e.g. uint8 for raw image inputs
+        self.PreProcessedDtype = calibSet.first().dtype
+        self.PreProcessedSize = calibSet.first().size * self.PreProcessedDtype.itemsize
         self.currentIndex = 0
 
         # Allocate enough memory for a whole batch.
@@ -148,7 +150,7 @@ class Int8EntropyCalibrator(trt.IInt8EntropyCalibrator2):
 
         print('Get pre processed file index - ', not self.currentIndex)
 
-        batchData = np.fromfile(self.PreProcessedSetPath + '/' + str(self.currentIndex) + '.bin', dtype=np.single)
+        batchData = np.fromfile(self.PreProcessedSetPath + '/' + str(self.currentIndex) + '.bin', dtype=self.PreProcessedDtype)
 
         cuda.memcpy_htod(self.deviceInput, batchData)
         self.currentIndex += 1
@@ -189,6 +191,7 @@ modelName = None
 
 inputs = []
 outputs = []
+outputBindingNames = []
 bindings = []
 stream = None
 
@@ -291,6 +294,7 @@ def ModelInferSetup():
     global engine
     global inputs
     global outputs
+    global outputBindingNames
     global bindings
     global stream
 
@@ -314,12 +318,28 @@ def ModelInferSetup():
             inputs.append(HostDeviceMem(host_mem, device_mem))
         else:
             outputs.append(HostDeviceMem(host_mem, device_mem))
+            # Iterating the engine yields the binding names
+            outputBindingNames.append(binding)
 
     # Contexts are used to perform inference.
     context = engine.create_execution_context()
     context.error_recorder = errorRecorder
 
-def Inference(externalnputs = None):
+def SelectOutputs(names = None):
+    """Return the output buffers to copy back: all of them, or only the named ones
+    (e.g. the compact heads of onnxUtils.AppendClassifierHeads), in the requested order"""
+    if names is None:
+        return outputs
+    selected = []
+    for name in names:
+        if name not in outputBindingNames:
+            raise ValueError("Unknown engine output - {}".format(name))
+        selected.append(outputs[outputBindingNames.index(name)])
+    return selected
+
+def Inference(externalnputs = None, outputNames = None):
+    """Run the engine on a list of inputs (one array per engine input). Only the outputs
+    named in outputNames (default: all) are copied back from the device and returned"""
 
     global context
     global stream
@@ -346,12 +366,13 @@ def Inference(externalnputs = None):
                     [cuda.memcpy_htod_async(inp.device, inp.host, stream) for inp in inputs]
                     # Run asynchronously inference using the user\internal stream.
                     context.execute_async_v2(bindings=bindings, stream_handle=stream.handle)
-                    # Transfer predictions back from the GPU.
-                    [cuda.memcpy_dtoh_async(out.host, out.device, stream) for out in outputs]
+                    # Transfer the selected predictions back from the GPU.
+                    selectedOutputs = SelectOutputs(outputNames)
+                    [cuda.memcpy_dtoh_async(out.host, out.device, stream) for out in selectedOutputs]
 
                     stream.synchronize()
                     # Build a list of Tensors outputs and return only the host outputs.
-                    return [out.host for out in outputs]
+                    return [out.host for out in selectedOutputs]
                 else:
                     print('External inputs list size - ', len(externalnputs), ' is not equal to model inputs list size - ', len(inputs))
                     return None
@@ -361,3 +382,40 @@ def Inference(externalnputs = None):
     except BaseException as e:
         msg = e
         print('TRT inference exception ERROR - ', msg)
+
+
+def InferencePinned(hostInputs, outputNames = None):
+    """Run inference directly from caller owned page locked host buffers
+    (e.g. the PrefetchPipeline buffers), skipping the staging copy into the
+    engine own host buffers done by Inference(). Only the outputs named in
+    outputNames (default: all) are copied back from the device"""
+
+    global context
+    global stream
+    global inputs
+    global outputs
+    global bindings
+
+    try:
+        if context is not None:
+            if len(hostInputs) != len(inputs):
+                print('External inputs list size - ', len(hostInputs), ' is not equal to model inputs list size - ', len(inputs))
+                return None
+
+            for index in range(len(hostInputs)):
+                if hostInputs[index].nbytes != inputs[index].host.nbytes:
+                    print('TRT external input bytes - ', hostInputs[index].nbytes,
+                          ' is not equal to model inputs bytes - ', inputs[index].host.nbytes)
+                    return None
+
+            # Transfer input data to the GPU straight from the caller page locked memory.
+            [cuda.memcpy_htod_async(inp.device, hostInp, stream) for inp, hostInp in zip(inputs, hostInputs)]
+            context.execute_async_v2(bindings=bindings, stream_handle=stream.handle)
+            selectedOutputs = SelectOutputs(outputNames)
+            [cuda.memcpy_dtoh_async(out.host, out.device, stream) for out in selectedOutputs]
+
+            stream.synchronize()
+            return [out.host for out in selectedOutputs]
+    except BaseException as e:
+        msg = e
+        print('TRT inference exception ERROR - ', msg)
@@ -0,0 +1,244 @@
+# approximateCache
+#!pip install numba (optional, compiled histogram kernel)
+import threading
+import time
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+def _histogramKernel(pixels, numBins, out):
+    # CPU port of the cv_histogram CUDA kernel: a value v falls into bin int(v / (255 / numBins)),
+    # and 255 (bin numBins) is not counted
+    binWidth = 255 / numBins
+    for i in range(pixels.shape[0]):
+        for c in range(pixels.shape[1]):
+            b = np.int32(pixels[i, c] / binWidth)
+            if b >= 0 and b < numBins:
+                out[c, b] += 1
+
+if numba is not None:
+    _histogramKernel = numba.njit(cache=True, nogil=True)(_histogramKernel)
+
+def _ToUint8(image, scale=None):
+    """Return the 0-255 uint8 values of a float image multiplied by scale, by default 255 for
+    images with values in [0, 1] and 1 otherwise"""
+    image = np.asarray(image)
+    if image.dtype.kind == 'f':
+        if scale is None:
+            scale = 255.0 if image.max() <= 1.0 else 1.0
+        return np.clip(np.rint(image * scale), 0, 255).astype(np.uint8)
+    return image
+
+def ColorHistogram(image, numBins=20, scale=None):
+    """Return the (channels, numBins) per channel histogram counts of a HWC (or HW) image,
+    with the binning of the cv_histogram kernel (scale -- see _ToUint8)"""
+    image = _ToUint8(image, scale)
+    pixels = image.reshape(-1, image.shape[2] if image.ndim == 3 else 1)
+    histogram = np.zeros((pixels.shape[1], numBins), dtype=np.int64)
+    if numba is not None:
+        _histogramKernel(pixels, numBins, histogram)
+    else:
+        bins = (pixels / (255 / numBins)).astype(np.int32)
+        for c in range(pixels.shape[1]):
+            histogram[c] = np.bincount(bins[:, c], minlength=numBins + 1)[:numBins]
+    return histogram
+
+def Thumbnail(image, size=8, scale=None):
+    """Return the (size, size) area averaged grayscale thumbnail of an image, in [0, 1]"""
+    image = _ToUint8(image, scale).astype(np.float32)
+    gray = image.mean(axis=2) if image.ndim == 3 else image
+    rows = np.linspace(0, gray.shape[0], size + 1).astype(np.int64)
+    cols = np.linspace(0, gray.shape[1], size + 1).astype(np.int64)
+    sums = np.add.reduceat(np.add.reduceat(gray, rows[:-1], axis=0), cols[:-1], axis=1)
+    return sums / (np.diff(rows)[:, None] * np.diff(cols)[None, :] * 255.0)
+
+def Signature(image, numBins=20, thumbnailSize=0, thumbnailWeight=1.0, scale=None):
+    """Return the compact float32 signature of an image: its normalized per channel histograms,
+    optionally followed by a downsampled thumbnail. The parts are scaled so that the L1 distance
+    of two signatures is the histograms L1 distance (halved and averaged over the channels,
+    in [0, 1]) plus thumbnailWeight times the thumbnails mean absolute difference"""
+    histogram = ColorHistogram(image, numBins, scale).astype(np.float64)
+    histogram /= np.maximum(histogram.sum(axis=1, keepdims=True), 1) * 2 * histogram.shape[0]
+    parts = [histogram.ravel()]
+    if thumbnailSize > 0:
+        parts.append(Thumbnail(image, thumbnailSize, scale).ravel() * (thumbnailWeight / thumbnailSize ** 2))
+    return np.concatenate(parts).astype(np.float32)
+
+class SignatureIndex(object):
+    """Bounded nearest neighbour index of signatures, a single preallocated matrix searched
+    with one vectorized L1 distance pass. When full, the oldest entries are replaced"""
+
+    def __init__(self, dimension, capacity=4096):
+        self.capacity = capacity
+        self.signatures = np.zeros((capacity, dimension), dtype=np.float32)
+        self.values = [None] * capacity
+        self.count = 0
+        self._next = 0
+
+    def Nearest(self, signature):
+        """Return (value, distance) of the nearest signature, (None, inf) when empty"""
+        if self.count == 0:
+            return None, np.inf
+        distances = np.abs(self.signatures[:self.count] - signature).sum(axis=1)
+        nearest = int(np.argmin(distances))
+        return self.values[nearest], float(distances[nearest])
+
+    def Add(self, signature, value):
+        self.signatures[self._next] = signature
+        self.values[self._next] = value
+        self._next = (self._next + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+class ApproximateCache(object):
+    """Near duplicate result cache in front of a single input model with the
+    Inference(externalnputs) calling convention: the inference is skipped for every sample
+    whose signature is within maxDistance of a cached one, and its cached outputs are reused.
+    The samples of a batch are looked up one by one, the misses run as a single batch and
+    the outputs are merged back in order.
+
+    Usage example:
+        session = OrtInference(modelFile)
+        cache = ApproximateCache(session.Inference, maxDistance=0.02, thumbnailSize=8)
+        outputs = cache.Inference([images])
+    """
+
+    def __init__(self, inference, maxDistance=0.02, numBins=20, thumbnailSize=0, thumbnailWeight=1.0, capacity=4096, scale=None):
+        """Keyword arguments:
+        inference -- callable(externalnputs) returning the list of outputs of a batch, the
+        first dimension of every output being the samples dimension
+        maxDistance -- reuse a cached result when the signature L1 distance is at most this
+        numBins -- histogram bins per channel
+        thumbnailSize -- side of the grayscale thumbnail added to the signature (0 for none)
+        thumbnailWeight -- weight of the thumbnail mean absolute difference in the distance
+        capacity -- maximum cached samples
+        scale -- multiplies float images to 0-255 values, e.g. 255 for [0, 1] images (default:
+        255 when an image has no value above 1, 1 otherwise)
+        """
+        self.inference = inference
+        self.maxDistance = maxDistance
+        self.numBins = numBins
+        self.thumbnailSize = thumbnailSize
+        self.thumbnailWeight = thumbnailWeight
+        self.capacity = capacity
+        self.scale = scale
+        self.index = None
+        self._lock = threading.Lock()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.signatureTime = 0.0
+        self.inferenceTime = 0.0
+
+    def Signature(self, image):
+        return Signature(image, self.numBins, self.thumbnailSize, self.thumbnailWeight, self.scale)
+
+    def Inference(self, externalnputs):
+        """Return the outputs of the batch, and the mask of the samples served from the cache
+        (None, None when the inference fails)"""
+        images = externalnputs[0]
+        startTime = time.perf_counter()
+        signatures = [self.Signature(image) for image in images]
+        self.signatureTime += time.perf_counter() - startTime
+
+        cached = [None] * len(images)
+        with self._lock:
+            if self.index is None:
+                self.index = SignatureIndex(len(signatures[0]), self.capacity)
+            for sample, signature in enumerate(signatures):
+                value, distance = self.index.Nearest(signature)
+                if distance <= self.maxDistance:
+                    cached[sample] = value
+        reused = np.array([value is not None for value in cached], dtype=bool)
+
+        missing = np.flatnonzero(~reused)
+        missOutputs = None
+        if len(missing) > 0:
+            startTime = time.perf_counter()
+            missOutputs = self.inference([np.ascontiguousarray(images[missing])])
+            self.inferenceTime += time.perf_counter() - startTime
+            if missOutputs is None:
+                return None, None
+            missOutputs = [np.asarray(output).reshape((len(missing),) + np.shape(output)[1:]) for output in missOutputs]
+            # The outputs may be reused buffers (TensorRT host memory), the cache keeps copies
+            missOutputs = [np.array(output, copy=True) for output in missOutputs]
+
+        with self._lock:
+            for position, sample in enumerate(missing):
+                self.index.Add(signatures[sample], [output[position] for output in missOutputs])
+            self.hits += int(reused.sum())
+            self.misses += len(missing)
+
+        # Merge the cached and the new outputs in the samples order
+        template = missOutputs if missOutputs is not None else [np.asarray(value)[None] for value in cached[0]]
+        outputs = [np.empty((len(images),) + output.shape[1:], dtype=output.dtype) for output in template]
+        for sample, value in enumerate(cached):
+            if value is not None:
+                for output, cachedOutput in zip(outputs, value):
+                    output[sample] = cachedOutput
+        for output, missOutput in zip(outputs, missOutputs if missOutputs is not None else []):
+            output[missing] = missOutput
+        return outputs, reused
+
+    def Stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": 0 if self.index is None else self.index.count,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups > 0 else 0.0,
+            "signatureTime": self.signatureTime,
+            "inferenceTime": self.inferenceTime,
+        }
+
+def MeasureFalseReuse(cache, exactInference, images, labels=None, batchSize=64):
+    """Run a labelled sample through the approximate cache and through the exact model, and
+    return the hit rate and the false reuse rate: the fraction of the reused results whose
+    predicted class differs from the exact model prediction (and the accuracies, given labels)"""
+    cachedPredictions = np.empty(len(images), dtype=np.int64)
+    exactPredictions = np.empty(len(images), dtype=np.int64)
+    reusedMask = np.zeros(len(images), dtype=bool)
+    cacheTime = exactTime = 0.0
+
+    for batchStart in range(0, len(images), batchSize):
+        batch = images[batchStart:batchStart + batchSize]
+
+        startTime = time.perf_counter()
+        outputs, reused = cache.Inference([batch])
+        cacheTime += time.perf_counter() - startTime
+
+        startTime = time.perf_counter()
+        exactOutputs = exactInference([batch])
+        exactTime += time.perf_counter() - startTime
+
+        cachedPredictions[batchStart:batchStart + len(batch)] = np.argmax(outputs[0].reshape(len(batch), -1), axis=1)
+        exactPredictions[batchStart:batchStart + len(batch)] = np.argmax(np.asarray(exactOutputs[0]).reshape(len(batch), -1), axis=1)
+        reusedMask[batchStart:batchStart + len(batch)] = reused
+
+    numReused = int(reusedMask.sum())
+    falseReuse = int(np.sum(cachedPredictions[reusedMask] != exactPredictions[reusedMask]))
+    report = {
+        "samples": len(images),
+        "reused": numReused,
+        "hitRate": numReused / max(len(images), 1),
+        "falseReuse": falseReuse,
+        "falseReuseRate": falseReuse / numReused if numReused > 0 else 0.0,
+        "cacheTime": cacheTime,
+        "exactTime": exactTime,
+    }
+    if labels is not None:
+        labels = np.asarray(labels).astype(np.int64)
+        report["exactAccuracy"] = float(np.mean(exactPredictions == labels))
+        report["cachedAccuracy"] = float(np.mean(cachedPredictions == labels))
+    return report
+
+def PrintApproximateCacheReport(report):
+    print("===============================================================")
+    print("Approximate cache report:")
+    print("Samples - ", report["samples"], ", reused - {:.2f}%".format(100.0 * report["hitRate"]))
+    print("False reuse - ", report["falseReuse"], " ({:.2f}% of the reused)".format(100.0 * report["falseReuseRate"]))
+    if "exactAccuracy" in report:
+        print("Accuracy - exact {:.4f}, cached {:.4f}".format(report["exactAccuracy"], report["cachedAccuracy"]))
@@ -0,0 +1,54 @@
+# benchmarkUtils
+import time
+import numpy as np
+
+def BenchmarkBackend(name, predictBatch, images, batchSize=1, warmupBatches=10, maxBatches=0, dtype=np.float32):
+    """Time a backend on the same full size batches every other backend gets.
+    Only full batches are timed, so all backends run matched batch sizes, and
+    the dtype conversion is done once up front, outside of the timed region.
+    Keyword arguments:
+    name -- backend name for the report
+    predictBatch -- callable(batch) running the model on a single batch
+    images -- samples array, first dimension is the samples dimension
+    batchSize -- samples per batch
+    warmupBatches -- untimed batches run before measuring
+    maxBatches -- limit on timed batches (0 for the whole set)
+    """
+    data = np.ascontiguousarray(images, dtype=dtype)
+    numBatches = data.shape[0] // batchSize
+    if maxBatches > 0:
+        numBatches = min(numBatches, maxBatches)
+    if numBatches == 0:
+        raise ValueError("Not enough samples for a single batch of size {}".format(batchSize))
+
+    for idx in range(warmupBatches):
+        batchIdx = idx % numBatches
+        predictBatch(data[batchIdx * batchSize:(batchIdx + 1) * batchSize])
+
+    latencies = np.empty(numBatches, dtype=np.float64)
+    startTime = time.perf_counter()
+    for batchIdx in range(numBatches):
+        batchStart = time.perf_counter()
+        predictBatch(data[batchIdx * batchSize:(batchIdx + 1) * batchSize])
+        latencies[batchIdx] = time.perf_counter() - batchStart
+    totalTime = time.perf_counter() - startTime
+
+    latenciesMs = latencies * 1e3
+    return {
+        "name": name,
+        "batchSize": batchSize,
+        "batches": numBatches,
+        "samples": numBatches * batchSize,
+        "meanMs": float(np.mean(latenciesMs)),
+        "p50Ms": float(np.percentile(latenciesMs, 50)),
+        "p99Ms": float(np.percentile(latenciesMs, 99)),
+        "samplesPerSec": numBatches * batchSize / totalTime,
+    }
+
+def PrintBenchmarkReport(results):
+    print("=====================================================================================")
+    print("{:<32} {:>6} {:>10} {:>12} {:>12} {:>12}".format("Backend", "Batch", "Samples", "Mean [ms]", "p99 [ms]", "Samples/s"))
+    print("=====================================================================================")
+    for result in results:
+        print("{:<32} {:>6} {:>10} {:>12.4f} {:>12.4f} {:>12.1f}".format(
+            result["name"], result["batchSize"], result["samples"], result["meanMs"], result["p99Ms"], result["samplesPerSec"]))
@@ -0,0 +1,171 @@
+# cascadeInference
+import time
+import numpy as np
+
+def ToProbabilities(outputs):
+    """Return the (N, classes) class probabilities of a batch of classifier outputs,
+    applying a softmax unless the rows already are probabilities"""
+    outputs = np.asarray(outputs, dtype=np.float64).reshape(len(outputs), -1)
+    if outputs.min() >= 0.0 and np.allclose(outputs.sum(axis=1), 1.0, atol=1e-3):
+        return outputs
+    exp = np.exp(outputs - outputs.max(axis=1, keepdims=True))
+    return exp / exp.sum(axis=1, keepdims=True)
+
+def Confidence(probabilities, criterion='margin'):
+    """Per sample confidence, low values are escalated to the accurate model.
+    Keyword arguments:
+    probabilities -- (N, classes) class probabilities
+    criterion -- 'margin' for the top-1 minus top-2 probability, 'entropy' for one minus
+                 the entropy normalized by log(classes); both are in [0, 1]
+    """
+    if criterion == 'margin':
+        top2 = np.partition(probabilities, -2, axis=1)[:, -2:]
+        return top2[:, 1] - top2[:, 0]
+    if criterion == 'entropy':
+        entropy = -np.sum(probabilities * np.log(np.maximum(probabilities, 1e-12)), axis=1)
+        return 1.0 - entropy / np.log(probabilities.shape[1])
+    raise ValueError("Unknown confidence criterion - {}".format(criterion))
+
+def CalibrateThreshold(cheapOutputs, accurateOutputs, criterion='margin', targetAgreement=0.995):
+    """Return the smallest confidence threshold for which the cascade predictions agree with
+    the accurate model on at least targetAgreement of the calibration samples, together with
+    the calibration escalation rate and agreement.
+    Samples whose cheap model confidence is below the threshold are escalated, an escalated
+    sample always agrees, the others agree when both models predict the same class.
+    Keyword arguments:
+    cheapOutputs, accurateOutputs -- (N, classes) outputs of both models on the calibration set
+    criterion -- see Confidence
+    targetAgreement -- required top-1 agreement with the accurate model
+    """
+    cheapProbabilities = ToProbabilities(cheapOutputs)
+    confidence = Confidence(cheapProbabilities, criterion)
+    disagree = np.argmax(cheapProbabilities, axis=1) != np.argmax(ToProbabilities(accurateOutputs), axis=1)
+    numSamples = len(confidence)
+
+    order = np.argsort(confidence, kind='stable')
+    confidence = confidence[order]
+    # remaining[j] -- disagreements left when the j least confident samples are escalated
+    remaining = np.concatenate([np.cumsum(disagree[order][::-1])[::-1], [0]])
+    allowed = np.floor((1.0 - targetAgreement) * numSamples + 1e-9)
+    numEscalated = int(np.argmax(remaining <= allowed))
+    # Escalate while the next samples are tied with the last escalated one
+    while 0 < numEscalated < numSamples and confidence[numEscalated] == confidence[numEscalated - 1]:
+        numEscalated += 1
+
+    if numEscalated == 0:
+        threshold = 0.0
+    elif numEscalated == numSamples:
+        threshold = np.inf
+    else:
+        threshold = float(confidence[numEscalated])
+
+    return {
+        "threshold": threshold,
+        "criterion": criterion,
+        "escalationRate": numEscalated / max(numSamples, 1),
+        "agreement": float(1.0 - remaining[numEscalated] / max(numSamples, 1)),
+    }
+
+class CascadeClassifier(object):
+    """Confidence gated cascade of two classifier variants, e.g. an int8 and a fp32 build
+    of the same model (TensorRT engines or their ONNX Runtime CPU equivalents).
+    Every batch runs through the cheap model, only the samples whose confidence is below
+    the threshold are re-run on the accurate model, and the outputs are merged in order.
+
+    Usage example:
+        calibration = CalibrateThreshold(cheap(validationImages), accurate(validationImages))
+        cascade = CascadeClassifier(cheap, accurate, calibration["threshold"])
+        probabilities, escalated = cascade.Predict(batch)
+    """
+
+    def __init__(self, cheapPredict, accuratePredict, threshold, criterion='margin'):
+        """Keyword arguments:
+        cheapPredict, accuratePredict -- callable(batch) returning the (N, classes) outputs,
+        logits or probabilities, of the batch
+        threshold -- samples whose cheap confidence is below it are escalated (see CalibrateThreshold)
+        criterion -- see Confidence
+        """
+        self.cheapPredict = cheapPredict
+        self.accuratePredict = accuratePredict
+        self.threshold = threshold
+        self.criterion = criterion
+
+        self.samples = 0
+        self.escalated = 0
+        self.cheapTime = 0.0
+        self.accurateTime = 0.0
+
+    def Predict(self, batch):
+        """Return the (N, classes) probabilities of the batch and the mask of the escalated samples"""
+        startTime = time.perf_counter()
+        probabilities = ToProbabilities(self.cheapPredict(batch))
+        escalated = Confidence(probabilities, self.criterion) < self.threshold
+        self.cheapTime += time.perf_counter() - startTime
+
+        if escalated.any():
+            startTime = time.perf_counter()
+            # The escalated samples are gathered into a single contiguous batch
+            probabilities[escalated] = ToProbabilities(self.accuratePredict(np.ascontiguousarray(batch[escalated])))
+            self.accurateTime += time.perf_counter() - startTime
+
+        self.samples += len(batch)
+        self.escalated += int(escalated.sum())
+        return probabilities, escalated
+
+    @property
+    def escalationRate(self):
+        return self.escalated / max(self.samples, 1)
+
+def EvaluateCascade(cascade, baselinePredict, images, labels, batchSize=64):
+    """Run the fp32 baseline and the cascade on the same batches and return the accuracy of
+    both, the cascade agreement with the baseline, its escalation rate and throughput gain"""
+    baselinePredictions = np.empty(len(images), dtype=np.int64)
+    cascadePredictions = np.empty(len(images), dtype=np.int64)
+    baselineTime = cascadeTime = 0.0
+    samples = escalated = 0
+
+    for batchStart in range(0, len(images), batchSize):
+        batch = images[batchStart:batchStart + batchSize]
+
+        startTime = time.perf_counter()
+        outputs = baselinePredict(batch)
+        baselineTime += time.perf_counter() - startTime
+        baselinePredictions[batchStart:batchStart + len(batch)] = np.argmax(np.asarray(outputs).reshape(len(batch), -1), axis=1)
+
+        startTime = time.perf_counter()
+        probabilities, batchEscalated = cascade.Predict(batch)
+        cascadeTime += time.perf_counter() - startTime
+        cascadePredictions[batchStart:batchStart + len(batch)] = np.argmax(probabilities, axis=1)
+        samples += len(batch)
+        escalated += int(batchEscalated.sum())
+
+    labels = np.asarray(labels).astype(np.int64)
+    return {
+        "samples": samples,
+        "baselineAccuracy": float(np.mean(baselinePredictions == labels)),
+        "cascadeAccuracy": float(np.mean(cascadePredictions == labels)),
+        "agreement": float(np.mean(baselinePredictions == cascadePredictions)),
+        "escalationRate": escalated / max(samples, 1),
+        "baselineSamplesPerSec": samples / baselineTime if baselineTime > 0 else 0.0,
+        "cascadeSamplesPerSec": samples / cascadeTime if cascadeTime > 0 else 0.0,
+        "speedup": baselineTime / cascadeTime if cascadeTime > 0 else 0.0,
+    }
+
+def PrintCascadeReport(report):
+    print("===============================================================")
+    print("Cascade inference report:")
+    print("Samples - ", report["samples"], ", escalated - {:.2f}%".format(100.0 * report["escalationRate"]))
+    print("Accuracy - baseline {:.4f}, cascade {:.4f}, agreement with the baseline {:.4f}".format(
+        report["baselineAccuracy"], report["cascadeAccuracy"], report["agreement"]))
+    print("Throughput - baseline {:.1f} samples/s, cascade {:.1f} samples/s, gain {:.2f}x".format(
+        report["baselineSamplesPerSec"], report["cascadeSamplesPerSec"], report["speedup"]))
+
+def MakeInt8OrtVariant(modelFile, outputFile=None):
+    """CPU equivalent of an int8 TensorRT build: ONNX Runtime dynamic quantization, int8
+    weights and per batch quantized activations. Return the quantized model file path"""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    if outputFile is None:
+        outputFile = modelFile.rsplit('.', 1)[0] + 'Int8.onnx'
+    quantize_dynamic(modelFile, outputFile, weight_type=QuantType.QInt8)
+    return outputFile
@@ -0,0 +1,162 @@
+# inferenceCache
+#!pip install xxhash (optional, faster input digests)
+from collections import OrderedDict
+import hashlib
+import threading
+import time
+import numpy as np
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+def ModelFingerprint(model):
+    """Return the SHA-256 hex digest of a model, given as a file path or as serialized bytes"""
+    digest = hashlib.sha256()
+    if isinstance(model, (bytes, bytearray)):
+        digest.update(model)
+    else:
+        with open(model, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+def InputDigest(arrays):
+    """Return a 128 bit digest of a list of input arrays: their dtypes, shapes and bytes
+    (xxh3 when xxhash is installed, BLAKE2b otherwise)"""
+    digest = xxhash.xxh3_128() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        array = np.ascontiguousarray(array)
+        digest.update("{}{}".format(array.dtype.str, array.shape).encode())
+        digest.update(memoryview(array).cast("B"))
+    return digest.digest()
+
+class _InFlight(object):
+    """An inference running for a key, the concurrent duplicates wait on its event"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.outputs = None
+
+class InferenceCache(object):
+    """Result cache in front of an inference function with the Inference(externalnputs)
+    calling convention (TensorRTUtils.Inference, OrtInference.Inference).
+    Entries are keyed by the model fingerprint and a digest of the input bytes, bounded by
+    count and bytes with LRU eviction, and expire after ttl seconds. A request identical to
+    one already running waits for that execution instead of running again.
+    Cached outputs are shared between the callers, so they are returned read only.
+
+    Usage example:
+        session = OrtInference(modelFile)
+        cache = InferenceCache(session.Inference, ModelFingerprint(modelFile), maxEntries=4096, ttl=600)
+        outputs = cache.Inference([image])
+    """
+
+    def __init__(self, inference, modelFingerprint, maxEntries=1024, maxBytes=0, ttl=0.0, clock=time.monotonic):
+        """Keyword arguments:
+        inference -- callable(externalnputs) returning the list of outputs, or None on error
+        modelFingerprint -- identifies the model, e.g. ModelFingerprint(modelFile)
+        maxEntries -- maximum number of cached results (0 for no limit)
+        maxBytes -- maximum total bytes of the cached outputs (0 for no limit)
+        ttl -- seconds a result stays valid (0 for no expiry)
+        clock -- time source, in seconds
+        """
+        self.inference = inference
+        self.modelFingerprint = modelFingerprint
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.ttl = ttl
+        self.clock = clock
+
+        # key -> (outputs, bytes, expiry time), least recently used first
+        self._entries = OrderedDict()
+        self._inFlight = {}
+        self._lock = threading.Lock()
+        self.bytes = 0
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+        self.deduplicated = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def Inference(self, externalnputs):
+        """Return the cached outputs of the inputs, or run the inference and cache them"""
+        key = (self.modelFingerprint, InputDigest(externalnputs))
+
+        owner = False
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self.ttl > 0 and self.clock() >= entry[2]:
+                    self._remove(key)
+                    self.expirations += 1
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+
+            inFlight = self._inFlight.get(key)
+            if inFlight is not None:
+                self.deduplicated += 1
+            else:
+                inFlight = _InFlight()
+                self._inFlight[key] = inFlight
+                self.misses += 1
+                owner = True
+        if not owner:
+            # A failed execution (None) is not cached, its duplicates get None as well
+            inFlight.event.wait()
+            return inFlight.outputs
+
+        try:
+            outputs = self.inference(externalnputs)
+            if outputs is not None:
+                # The inference may return its own reused buffers (TensorRT host memory)
+                outputs = [np.array(output, copy=True) for output in outputs]
+                for output in outputs:
+                    output.setflags(write=False)
+            inFlight.outputs = outputs
+        finally:
+            with self._lock:
+                del self._inFlight[key]
+                if inFlight.outputs is not None:
+                    self._insert(key, inFlight.outputs)
+            inFlight.event.set()
+        return inFlight.outputs
+
+    def _insert(self, key, outputs):
+        size = sum(output.nbytes for output in outputs)
+        if self.maxBytes > 0 and size > self.maxBytes:
+            return
+        expiry = self.clock() + self.ttl if self.ttl > 0 else np.inf
+        self._entries[key] = (outputs, size, expiry)
+        self.bytes += size
+        while (self.maxEntries > 0 and len(self._entries) > self.maxEntries) or (self.maxBytes > 0 and self.bytes > self.maxBytes):
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def Clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def Stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.deduplicated
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "deduplicated": self.deduplicated,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hitRate": (self.hits + self.deduplicated) / lookups if lookups > 0 else 0.0,
+            }
@@ -1,7 +1,9 @@
 # onnxUtils
 #!pip install tf2onnx onnx onnxsim
+import copy
 import json
 import time
+import numpy as np
 import tf2onnx
 import onnx
 import onnxsim
@@ -131,3 +133,159 @@ def ModelSimplify(name):
                 print('Simplified Onnx model could not be generated and validated')
         except BaseException as e:
             print('Onnx simplification exception - ', e)
+
+def ConvertInputToUint8(model, inputName=None, scale=1.0, mean=None, std=None, inputLayout=None):
+    """Return a copy of an ONNX model whose input is a raw uint8 tensor: Cast, normalization
+    ((x * scale - mean) / std, folded into a single Mul and Add) and, for inputLayout 'NHWC',
+    a Transpose to the model NCHW layout are prepended inside the graph.
+    The input keeps its name, so callers only have to feed the raw uint8 images.
+    Keyword arguments:
+    model -- the ONNX ModelProto
+    inputName -- the input to convert (default: the first graph input which is not an initializer)
+    scale -- scale of the raw values, e.g. 1/255 for [0, 1] inputs
+    mean, std -- optional per channel (or scalar) mean and standard deviation, after scaling
+    inputLayout -- None to keep the model input layout, 'NHWC' to feed channels last images
+                   to a NCHW model
+    """
+    model = copy.deepcopy(model)
+    graph = model.graph
+    initializerNames = set(initializer.name for initializer in graph.initializer)
+    graphInputs = [inp for inp in graph.input if inp.name not in initializerNames]
+    if inputName is None:
+        inputName = graphInputs[0].name
+    graphInput = [inp for inp in graphInputs if inp.name == inputName][0]
+    if graphInput.type.tensor_type.elem_type != onnx.TensorProto.FLOAT:
+        raise ValueError("Input {} is not a float tensor".format(inputName))
+
+    dims = list(graphInput.type.tensor_type.shape.dim)
+    if inputLayout == 'NHWC':
+        if len(dims) != 4:
+            raise ValueError("NHWC input layout requires a 4D NCHW model input, got rank {}".format(len(dims)))
+        dims = [dims[0], dims[2], dims[3], dims[1]]
+    elif inputLayout is not None:
+        raise ValueError("Unsupported input layout - {}".format(inputLayout))
+
+    # Per channel factors broadcast over the last axis of NHWC inputs, or axis 1 of NCHW inputs
+    mean = np.zeros(1) if mean is None else np.asarray(mean, dtype=np.float64).ravel()
+    std = np.ones(1) if std is None else np.asarray(std, dtype=np.float64).ravel()
+    multiplier = (scale / std).astype(np.float32)
+    addend = (-mean / std).astype(np.float32)
+    numChannels = max(len(multiplier), len(addend))
+    if numChannels > 1:
+        if len(dims) < 3:
+            raise ValueError("Per channel mean and std require an image input")
+        broadcastShape = [numChannels] if inputLayout == 'NHWC' else [numChannels] + [1] * (len(dims) - 2)
+        multiplier = np.broadcast_to(multiplier, (numChannels,)).reshape(broadcastShape)
+        addend = np.broadcast_to(addend, (numChannels,)).reshape(broadcastShape)
+
+    # The original input becomes an internal tensor, produced by the prepended nodes
+    normalizedName = inputName + '_normalized'
+    for node in graph.node:
+        for index, name in enumerate(node.input):
+            if name == inputName:
+                node.input[index] = normalizedName
+    for output in graph.output:
+        if output.name == inputName:
+            raise ValueError("Input {} is also a graph output".format(inputName))
+
+    nodes = [onnx.helper.make_node('Cast', [inputName], [inputName + '_float'], name=inputName + '_Cast', to=onnx.TensorProto.FLOAT)]
+    current = inputName + '_float'
+    if not np.all(multiplier == 1.0):
+        graph.initializer.append(onnx.numpy_helper.from_array(multiplier, inputName + '_multiplier'))
+        nodes.append(onnx.helper.make_node('Mul', [current, inputName + '_multiplier'], [inputName + '_scaled'], name=inputName + '_Mul'))
+        current = inputName + '_scaled'
+    if not np.all(addend == 0.0):
+        graph.initializer.append(onnx.numpy_helper.from_array(addend, inputName + '_addend'))
+        nodes.append(onnx.helper.make_node('Add', [current, inputName + '_addend'], [inputName + '_shifted'], name=inputName + '_Add'))
+        current = inputName + '_shifted'
+    if inputLayout == 'NHWC':
+        nodes.append(onnx.helper.make_node('Transpose', [current], [inputName + '_nchw'], name=inputName + '_Transpose', perm=[0, 3, 1, 2]))
+        current = inputName + '_nchw'
+    nodes.append(onnx.helper.make_node('Identity', [current], [normalizedName], name=inputName + '_Identity'))
+
+    # The nodes must stay topologically sorted, the new ones come first
+    allNodes = nodes + list(graph.node)
+    del graph.node[:]
+    graph.node.extend(allNodes)
+
+    graphInput.type.tensor_type.elem_type = onnx.TensorProto.UINT8
+    del graphInput.type.tensor_type.shape.dim[:]
+    graphInput.type.tensor_type.shape.dim.extend(dims)
+    return model
+
+def MakeUint8InputModel(name, scale=1.0, mean=None, std=None, inputLayout=None, overwrite_existing=False):
+    """Convert name.onnx to a model with a raw uint8 input (see ConvertInputToUint8),
+    saved as nameUint8.onnx. Every input then takes a quarter of the float32 host memory
+    bandwidth and transfer size. Return the new model file path."""
+    modelFile = name + 'Uint8.onnx'
+    if not os.path.isfile(modelFile) or overwrite_existing:
+        model = ConvertInputToUint8(onnx.load(name + '.onnx'), scale=scale, mean=mean, std=std, inputLayout=inputLayout)
+        onnx.checker.check_model(model)
+        onnx.save(model, modelFile)
+        print('Save uint8 input model to - ', modelFile)
+
+    return modelFile
+
+def AppendClassifierHeads(model, softmax=False, topK=0, argMax=False, outputName=None):
+    """Return a copy of a classification ONNX model with compact heads appended to its
+    (N, classes) output, and the list of the added output names:
+    softmax -- outputName + '_softmax', the class probabilities (TopK then ranks them)
+    topK -- if > 0, outputName + '_topk_values' and outputName + '_topk_indices', (N, topK)
+    argMax -- outputName + '_argmax', the (N,) int64 predicted classes
+    The original output is kept; binding only the heads (OrtInference outputNames, TensorRT
+    Inference outputNames) leaves a handful of values per image to copy back.
+    Keyword arguments:
+    model -- the ONNX ModelProto
+    outputName -- the logits output (default: the first graph output)
+    """
+    model = copy.deepcopy(model)
+    graph = model.graph
+    if outputName is None:
+        outputName = graph.output[0].name
+    logits = [output for output in graph.output if output.name == outputName][0]
+    batchDim = logits.type.tensor_type.shape.dim[0]
+    batchDim = batchDim.dim_param if batchDim.dim_param or batchDim.dim_value == 0 else batchDim.dim_value
+    if not batchDim:
+        batchDim = 'N'
+
+    headNames = []
+    ranked = outputName
+    if softmax:
+        ranked = outputName + '_softmax'
+        graph.node.append(onnx.helper.make_node('Softmax', [outputName], [ranked], name=ranked, axis=-1))
+        graph.output.append(onnx.helper.make_tensor_value_info(ranked, onnx.TensorProto.FLOAT,
+                                                              [batchDim] + [dim.dim_value for dim in logits.type.tensor_type.shape.dim[1:]]))
+        headNames.append(ranked)
+    if topK > 0:
+        kName = outputName + '_topk_k'
+        valuesName = outputName + '_topk_values'
+        indicesName = outputName + '_topk_indices'
+        graph.initializer.append(onnx.numpy_helper.from_array(np.array([topK], dtype=np.int64), kName))
+        graph.node.append(onnx.helper.make_node('TopK', [ranked, kName], [valuesName, indicesName], name=outputName + '_TopK', axis=-1))
+        graph.output.append(onnx.helper.make_tensor_value_info(valuesName, onnx.TensorProto.FLOAT, [batchDim, topK]))
+        graph.output.append(onnx.helper.make_tensor_value_info(indicesName, onnx.TensorProto.INT64, [batchDim, topK]))
+        headNames += [valuesName, indicesName]
+    if argMax:
+        argMaxName = outputName + '_argmax'
+        graph.node.append(onnx.helper.make_node('ArgMax', [outputName], [argMaxName], name=argMaxName, axis=-1, keepdims=0))
+        graph.output.append(onnx.helper.make_tensor_value_info(argMaxName, onnx.TensorProto.INT64, [batchDim]))
+        headNames.append(argMaxName)
+
+    return model, headNames
+
+def MakeClassifierHeadsModel(name, softmax=False, topK=0, argMax=False, overwrite_existing=False):
+    """Append the classifier heads (see AppendClassifierHeads) to name.onnx, saved as
+    nameHeads.onnx, unless it exists and overwrite_existing is False. Return the model file
+    path and the head output names (read from the existing file when it is kept)."""
+    modelFile = name + 'Heads.onnx'
+    if not os.path.isfile(modelFile) or overwrite_existing:
+        model, headNames = AppendClassifierHeads(onnx.load(name + '.onnx'), softmax=softmax, topK=topK, argMax=argMax)
+        onnx.checker.check_model(model)
+        onnx.save(model, modelFile)
+        print('Save classifier heads model to - ', modelFile, ', heads - ', headNames)
+    else:
+        # The heads of the saved model, whatever flags it was built with
+        outputs = onnx.load(modelFile, load_external_data=False).graph.output
+        headNames = [output.name for output in outputs if output.name.endswith(('_softmax', '_topk_values', '_topk_indices', '_argmax'))]
+
+    return modelFile, headNames
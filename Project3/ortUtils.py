@@ -0,0 +1,67 @@
+# ortUtils
+#!pip install onnxruntime
+import numpy as np
+import onnxruntime as ort
+
+class OrtInference(object):
+    """CPU (or any other ONNX Runtime provider) inference session, exposing the
+    same Inference(externalnputs) calling convention as the TensorRT utilities"""
+
+    def __init__(self, modelFile, intraOpThreads=0, interOpThreads=0, providers=None, outputNames=None):
+        """Keyword arguments:
+        modelFile -- path to the *.onnx model file (or the serialized model bytes)
+        intraOpThreads -- threads used inside a single operator, 0 lets ORT decide
+        interOpThreads -- threads used to run independent operators, 0 lets ORT decide
+        providers -- ONNX Runtime execution providers (default: CPU only)
+        outputNames -- outputs returned by Inference (default: all of them), e.g. only the
+                       compact heads of onnxUtils.AppendClassifierHeads
+        """
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = intraOpThreads
+        options.inter_op_num_threads = interOpThreads
+        if providers is None:
+            providers = ['CPUExecutionProvider']
+
+        self.modelFile = modelFile
+        self.session = ort.InferenceSession(modelFile, sess_options=options, providers=providers)
+        self.inputs = self.session.get_inputs()
+        self.outputs = self.session.get_outputs()
+        self.inputNames = [inp.name for inp in self.inputs]
+        self.outputNames = [out.name for out in self.outputs]
+        if outputNames is not None:
+            unknown = set(outputNames) - set(self.outputNames)
+            if unknown:
+                raise ValueError("Unknown model outputs - {}".format(sorted(unknown)))
+            self.outputNames = list(outputNames)
+
+    def Inference(self, externalnputs):
+        """Run the model on a list of inputs (one array per model input) and
+        return the list of the selected outputs, or None on error"""
+        if externalnputs is None:
+            print('External inputs list is None ERROR')
+            return None
+        if len(externalnputs) != len(self.inputNames):
+            print('External inputs list size - ', len(externalnputs), ' is not equal to model inputs list size - ', len(self.inputNames))
+            return None
+
+        feeds = {}
+        for inp, data in zip(self.inputs, externalnputs):
+            feeds[inp.name] = self._conform(inp, data)
+
+        try:
+            return self.session.run(self.outputNames, feeds)
+        except BaseException as e:
+            print('ORT inference exception ERROR - ', e)
+            return None
+
+    def _conform(self, inp, data):
+        # Reshape a batch to the rank the model expects, e.g. (N,28,28) -> (N,28,28,1)
+        if data.ndim != len(inp.shape):
+            data = data.reshape((data.shape[0],) + tuple(d if isinstance(d, int) else -1 for d in inp.shape[1:]))
+        if inp.type == 'tensor(float)' and data.dtype != np.float32:
+            data = data.astype(np.float32)
+        elif inp.type == 'tensor(uint8)' and data.dtype != np.uint8:
+            # Raw image models (see onnxUtils.ConvertInputToUint8) take the bytes as they are
+            data = data.astype(np.uint8)
+        return data
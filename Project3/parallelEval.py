@@ -0,0 +1,161 @@
+# parallelEval
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+class SharedArray(object):
+    """Descriptor of an array the worker processes can map without pickling
+    its data: either a multiprocessing.shared_memory block or a np.memmap file"""
+
+    def __init__(self, shape, dtype, shmName=None, fileName=None, offset=0):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.shmName = shmName
+        self.fileName = fileName
+        self.offset = offset
+
+    def attach(self):
+        """Map the array in the current process, return (array, handle)"""
+        if self.fileName is not None:
+            return np.memmap(self.fileName, dtype=self.dtype, mode='r', offset=self.offset, shape=self.shape), None
+
+        # The workers share the parent resource tracker, the block stays
+        # registered once and is unlinked by the parent only.
+        shm = shared_memory.SharedMemory(name=self.shmName)
+        return np.ndarray(self.shape, dtype=self.dtype, buffer=shm.buf), shm
+
+def _share(array):
+    """Return (SharedArray, owner handle) for array, memmaps are shared by file name"""
+    if isinstance(array, np.memmap) and array.filename is not None and array.flags.c_contiguous:
+        return SharedArray(array.shape, array.dtype, fileName=array.filename, offset=array.offset), None
+
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return SharedArray(array.shape, array.dtype, shmName=shm.name), shm
+
+def _evaluateShard(task):
+    modelFile, imagesDesc, labelsDesc, start, end, batchSize, numClasses, intraOpThreads, cores, predictionOutput = task
+
+    if cores is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+    # The workers are started without the parent state (forkserver or spawn),
+    # every one of them loads onnxruntime and creates its own session
+    from ortUtils import OrtInference
+    session = OrtInference(modelFile, intraOpThreads=intraOpThreads, interOpThreads=1,
+                           outputNames=None if predictionOutput is None else [predictionOutput])
+
+    images, imagesShm = imagesDesc.attach()
+    labels, labelsShm = labelsDesc.attach()
+
+    confusion = np.zeros((numClasses, numClasses), dtype=np.int64)
+    latencies = []
+    shardStart = time.perf_counter()
+    for batchStart in range(start, end, batchSize):
+        batchEnd = min(batchStart + batchSize, end)
+        batchTime = time.perf_counter()
+        outputs = session.Inference([images[batchStart:batchEnd]])
+        latencies.append(time.perf_counter() - batchTime)
+        if outputs is None:
+            raise RuntimeError("Inference failed on samples {}-{}".format(batchStart, batchEnd))
+
+        if predictionOutput is None:
+            predictions = np.argmax(outputs[0].reshape(batchEnd - batchStart, -1), axis=1)
+        else:
+            predictions = outputs[0].reshape(batchEnd - batchStart).astype(np.int64)
+        truth = labels[batchStart:batchEnd].astype(np.int64)
+        confusion += np.bincount(truth * numClasses + predictions, minlength=numClasses * numClasses).reshape(numClasses, numClasses)
+    shardTime = time.perf_counter() - shardStart
+
+    del images, labels
+    for shm in (imagesShm, labelsShm):
+        if shm is not None:
+            shm.close()
+
+    return {
+        "start": start,
+        "end": end,
+        "confusion": confusion,
+        "latencies": np.array(latencies),
+        "time": shardTime,
+        "pid": os.getpid(),
+    }
+
+def ParallelEvaluate(modelFile, images, labels, numWorkers=0, batchSize=64, intraOpThreads=1,
+                     pinCores=False, numClasses=10, startMethod=None, predictionOutput=None):
+    """Evaluate a classification ONNX model on a dataset sharded across worker
+    processes, each holding its own ONNX Runtime CPU session.
+    The inputs are shared through shared memory (or the np.memmap file they
+    live in), only shard boundaries and the per shard statistics are pickled.
+    Keyword arguments:
+    modelFile -- path to the *.onnx classification model
+    images, labels -- dataset arrays, images may be a np.memmap
+    numWorkers -- worker processes (default: cores / intraOpThreads)
+    batchSize -- inference batch size inside every worker
+    intraOpThreads -- ONNX Runtime intra op threads per worker
+    pinCores -- pin every worker to its own intraOpThreads cores (Linux only)
+    numClasses -- classes count for the confusion matrix
+    startMethod -- multiprocessing start method (default: forkserver where available, spawn
+    otherwise). The calling script must then be import safe (__main__ guarded). fork is
+    faster to start but may deadlock the workers once the parent holds threads, e.g. an
+    ONNX Runtime session, TensorFlow or a CUDA context.
+    predictionOutput -- name of an ArgMax head output (see onnxUtils.AppendClassifierHeads),
+    the only output then returned by the workers sessions (default: argmax of the first output)
+    """
+    numCores = os.cpu_count() or 1
+    if numWorkers <= 0:
+        numWorkers = max(1, numCores // intraOpThreads)
+    if startMethod is None:
+        startMethod = "forkserver" if "forkserver" in mp.get_all_start_methods() else "spawn"
+
+    numSamples = len(images)
+    bounds = np.linspace(0, numSamples, numWorkers + 1).astype(np.int64)
+
+    imagesDesc, imagesShm = _share(images)
+    labelsDesc, labelsShm = _share(labels)
+
+    tasks = []
+    for idx in range(numWorkers):
+        cores = None
+        if pinCores:
+            cores = set((idx * intraOpThreads + c) % numCores for c in range(intraOpThreads))
+        tasks.append((modelFile, imagesDesc, labelsDesc, int(bounds[idx]), int(bounds[idx + 1]),
+                      batchSize, numClasses, intraOpThreads, cores, predictionOutput))
+
+    try:
+        with mp.get_context(startMethod).Pool(processes=numWorkers) as pool:
+            startTime = time.perf_counter()
+            shards = pool.map(_evaluateShard, tasks)
+            totalTime = time.perf_counter() - startTime
+    finally:
+        for shm in (imagesShm, labelsShm):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+    return MergeShardResults(shards, totalTime, batchSize)
+
+def MergeShardResults(shards, totalTime, batchSize):
+    """Merge per shard confusion matrices and latencies into a single report.
+    The throughput is measured over the slowest shard inference loop, the workers start up
+    and session creation are only part of the wall time"""
+    confusion = sum(shard["confusion"] for shard in shards)
+    inferenceTime = max(shard["time"] for shard in shards)
+    latenciesMs = np.concatenate([shard["latencies"] for shard in shards]) * 1e3
+    numSamples = int(confusion.sum())
+
+    return {
+        "workers": len(shards),
+        "samples": numSamples,
+        "accuracy": float(np.trace(confusion)) / max(numSamples, 1),
+        "confusion": confusion,
+        "batchSize": batchSize,
+        "batchMeanMs": float(np.mean(latenciesMs)) if latenciesMs.size else 0.0,
+        "batchP99Ms": float(np.percentile(latenciesMs, 99)) if latenciesMs.size else 0.0,
+        "time": totalTime,
+        "inferenceTime": inferenceTime,
+        "samplesPerSec": numSamples / inferenceTime if inferenceTime > 0 else 0.0,
+    }
@@ -0,0 +1,199 @@
+# pipelineUtils
+import queue
+import threading
+import time
+import numpy as np
+
+class PrefetchBatch(object):
+    """A single assembled batch, living in one of the pipeline rotating buffers"""
+
+    def __init__(self, index, start, count, slot, host):
+        self.index = index
+        self.start = start
+        self.count = count
+        self.slot = slot
+        self.host = host
+
+    def __repr__(self):
+        return "PrefetchBatch(index={}, start={}, count={}, slot={})".format(self.index, self.start, self.count, self.slot)
+
+class PrefetchPipeline(object):
+    """Background input pipeline.
+    N worker threads convert the (uint8) source images into normalized float32
+    batches, written directly into a rotating set of preallocated host buffers
+    (page locked ones when a pycuda allocator is given), while the consumer is
+    busy executing the current batch.
+    Batches are always yielded in order. The buffer of a yielded batch is handed
+    back to the workers once the next batch is requested (or on release()).
+
+    Usage example:
+        with PrefetchPipeline(images, batchSize=1, allocator=cuda.pagelocked_empty) as pipeline:
+            for batch in pipeline:
+                outputs = InferencePinned([batch.host])
+    """
+
+    def __init__(self, images, batchSize=1, numWorkers=2, numBuffers=0, inputShape=None,
+                 scale=1.0, offset=0.0, dtype=np.float32, allocator=np.empty):
+        """Keyword arguments:
+        images -- source images array, first dimension is the samples dimension
+        batchSize -- number of samples in every assembled batch
+        numWorkers -- number of assembling threads
+        numBuffers -- number of rotating buffers (default: numWorkers + 2)
+        inputShape -- per sample shape expected by the model (default: images.shape[1:])
+        scale, offset -- normalization, the buffers hold images * scale + offset
+        dtype -- buffers element type
+        allocator -- callable(shape, dtype) used for the buffers, e.g. cuda.pagelocked_empty
+        """
+        if batchSize <= 0 or numWorkers <= 0:
+            raise ValueError("batchSize and numWorkers must be positive")
+
+        self.images = images
+        self.batchSize = batchSize
+        self.numWorkers = numWorkers
+        self.numBuffers = numBuffers if numBuffers > 0 else numWorkers + 2
+        self.inputShape = tuple(inputShape) if inputShape is not None else tuple(images.shape[1:])
+        self.scale = scale
+        self.offset = offset
+        self.dtype = np.dtype(dtype)
+        self.numSamples = images.shape[0]
+        self.numBatches = (self.numSamples + batchSize - 1) // batchSize
+
+        if int(np.prod(self.inputShape)) != int(np.prod(images.shape[1:])):
+            raise ValueError("inputShape {} does not match the images sample shape {}".format(self.inputShape, images.shape[1:]))
+
+        self.buffers = [allocator((batchSize,) + self.inputShape, self.dtype) for _ in range(self.numBuffers)]
+
+        # Bounded by construction: there are never more than numBuffers slots in flight
+        self._freeSlots = queue.Queue()
+        self._ready = {}
+        self._readyCondition = threading.Condition()
+        self._indexLock = threading.Lock()
+        self._nextToAssemble = 0
+        self._nextToYield = 0
+        self._current = None
+        self._error = None
+        self._stop = threading.Event()
+        self._threads = []
+
+        # Statistics, how long the consumer had to wait for a ready batch
+        self.consumerWaitTime = 0.0
+        self.consumerStalls = 0
+
+    def start(self):
+        for slot in range(self.numBuffers):
+            self._freeSlots.put(slot)
+        for idx in range(self.numWorkers):
+            thread = threading.Thread(target=self._worker, name="prefetch-{}".format(idx), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def close(self):
+        self._stop.set()
+        with self._readyCondition:
+            self._readyCondition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, excType, excValue, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.numBatches
+
+    def __iter__(self):
+        if not self._threads:
+            self.start()
+        while True:
+            batch = self.next()
+            if batch is None:
+                return
+            yield batch
+
+    def next(self):
+        """Return the next ready batch in order, or None at the end of the data.
+        The previously returned batch buffer is recycled."""
+        self.release()
+        if self._nextToYield >= self.numBatches:
+            return None
+
+        with self._readyCondition:
+            if self._nextToYield not in self._ready and self._error is None:
+                self.consumerStalls += 1
+                waitStart = time.perf_counter()
+                while self._nextToYield not in self._ready and self._error is None and not self._stop.is_set():
+                    self._readyCondition.wait()
+                self.consumerWaitTime += time.perf_counter() - waitStart
+            if self._error is not None:
+                raise self._error
+            if self._stop.is_set() and self._nextToYield not in self._ready:
+                return None
+            batch = self._ready.pop(self._nextToYield)
+
+        self._nextToYield += 1
+        self._current = batch
+        return batch
+
+    def release(self, batch=None):
+        """Hand the buffer of the given (default: current) batch back to the workers"""
+        if batch is None:
+            batch = self._current
+        if batch is None:
+            return
+        if batch is self._current:
+            self._current = None
+        self._freeSlots.put(batch.slot)
+
+    def _worker(self):
+        try:
+            while not self._stop.is_set():
+                try:
+                    slot = self._freeSlots.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                # The slot is taken before the batch index, so the batch the
+                # consumer is waiting for always owns a buffer.
+                with self._indexLock:
+                    index = self._nextToAssemble
+                    self._nextToAssemble += 1
+
+                if index >= self.numBatches:
+                    self._freeSlots.put(slot)
+                    return
+
+                batch = self._assemble(index, slot)
+
+                with self._readyCondition:
+                    self._ready[index] = batch
+                    self._readyCondition.notify_all()
+        except BaseException as e:
+            with self._readyCondition:
+                self._error = e
+                self._readyCondition.notify_all()
+
+    def _assemble(self, index, slot):
+        start = index * self.batchSize
+        count = min(self.batchSize, self.numSamples - start)
+        host = self.buffers[slot]
+        source = self.images[start:start + count].reshape((count,) + self.inputShape)
+        target = host[:count]
+
+        # Single pass conversion (and normalization) straight into the buffer
+        if self.scale != 1.0:
+            np.multiply(source, self.scale, out=target, casting='unsafe')
+            if self.offset != 0.0:
+                np.add(target, self.offset, out=target)
+        elif self.offset != 0.0:
+            np.add(source, self.offset, out=target, casting='unsafe')
+        else:
+            np.copyto(target, source, casting='unsafe')
+
+        if count < self.batchSize:
+            host[count:] = 0
+
+        return PrefetchBatch(index, start, count, slot, host)
@@ -0,0 +1,59 @@
+# test_wandb_helpers
+#!pip install pytest
+import numpy as np
+import pytest
+
+pytest.importorskip("wandb")
+pytest.importorskip("tensorflow")
+import wandb_helpers as wbh
+
+@pytest.fixture
+def registry(tmp_path):
+    """A local registry holding a tiny fashion-mnist dataset artifact"""
+    sourceDir = tmp_path / "source"
+    sourceDir.mkdir()
+    for idx, name in enumerate(wbh.dataset_names):
+        np.savez(sourceDir / (name + ".npz"), x=np.full((2, 28, 28), idx, dtype=np.uint8), y=np.arange(2))
+    registry = wbh.LocalArtifactRegistry(str(tmp_path / "registry"))
+    registry.log_artifact(wbh.dataset_artifact, "dataset", str(sourceDir))
+    return registry
+
+def test_cache_downloads_once(registry, tmp_path):
+    cache = wbh.ArtifactCache(str(tmp_path / "cache"), offline=False)
+    first = wbh.read_datasets(registry, cache=cache)
+    second = wbh.read_datasets(registry, cache=cache)
+
+    # 'latest' is resolved on every call, the unchanged digest is downloaded once
+    assert registry.use_count == 2
+    assert registry.download_count == 1
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a.images, b.images)
+        np.testing.assert_array_equal(a.labels, b.labels)
+
+def test_offline_resolves_latest_from_manifest(registry, tmp_path):
+    online = wbh.ArtifactCache(str(tmp_path / "cache"), offline=False)
+    expected = wbh.read_datasets(registry, cache=online)
+    useCount = registry.use_count
+
+    offline = wbh.ArtifactCache(str(tmp_path / "cache"), offline=True)
+    datasets = wbh.read_datasets(None, cache=offline)
+
+    assert registry.use_count == useCount
+    assert offline.is_fresh(wbh.dataset_artifact, "latest")
+    for a, b in zip(expected, datasets):
+        np.testing.assert_array_equal(a.images, b.images)
+
+def test_offline_uncached_artifact(tmp_path):
+    cache = wbh.ArtifactCache(str(tmp_path / "cache"), offline=True)
+    with pytest.raises(FileNotFoundError, match="offline mode"):
+        wbh.read_datasets(None, cache=cache)
+
+def test_alias_ttl(registry, tmp_path):
+    cache = wbh.ArtifactCache(str(tmp_path / "cache"), offline=False, alias_ttl=3600)
+    assert not cache.is_fresh(wbh.dataset_artifact, "latest")
+    wbh.read_datasets(registry, cache=cache)
+    assert cache.is_fresh(wbh.dataset_artifact, "latest")
+
+    # Within the ttl the alias is trusted, no remote call is made
+    wbh.read_datasets(None, cache=cache)
+    assert registry.use_count == 1
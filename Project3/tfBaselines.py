@@ -0,0 +1,54 @@
+# tfBaselines
+import tensorflow as tf
+
+def MakeXlaPredict(model):
+    """Return a batched predict callable running only the Keras model forward
+    pass (no metrics, no callbacks) through an XLA compiled tf.function"""
+
+    @tf.function(jit_compile=True)
+    def forward(batch):
+        return model(batch, training=False)
+
+    def predictBatch(batch):
+        return forward(tf.convert_to_tensor(batch)).numpy()
+
+    return predictBatch
+
+def ConvertToTflite(model, tfliteFile=None):
+    """Convert the Keras model to a float32 TFLite flatbuffer, optionally saved to tfliteFile"""
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    tfliteModel = converter.convert()
+    if tfliteFile is not None:
+        with open(tfliteFile, "wb") as f:
+            f.write(tfliteModel)
+    return tfliteModel
+
+def MakeTflitePredict(tfliteModel, batchSize, numThreads=None, useXnnpack=True):
+    """Return a batched predict callable running the TFLite model.
+    The builtin op resolver applies the default delegates, i.e. XNNPACK for
+    the float32 CPU kernels; without it the plain builtin kernels are timed.
+    Keyword arguments:
+    tfliteModel -- TFLite flatbuffer as returned by ConvertToTflite
+    batchSize -- the interpreter input is resized once to this batch size
+    numThreads -- interpreter (and XNNPACK) threads, None lets TFLite decide
+    useXnnpack -- apply the XNNPACK delegate
+    """
+    if useXnnpack:
+        resolver = tf.lite.experimental.OpResolverType.BUILTIN
+    else:
+        resolver = tf.lite.experimental.OpResolverType.BUILTIN_WITHOUT_DEFAULT_DELEGATES
+
+    interpreter = tf.lite.Interpreter(model_content=tfliteModel, num_threads=numThreads,
+                                      experimental_op_resolver_type=resolver)
+    inputDetails = interpreter.get_input_details()[0]
+    outputDetails = interpreter.get_output_details()[0]
+    inputShape = [batchSize] + list(inputDetails["shape"][1:])
+    interpreter.resize_tensor_input(inputDetails["index"], inputShape)
+    interpreter.allocate_tensors()
+
+    def predictBatch(batch):
+        interpreter.set_tensor(inputDetails["index"], batch.reshape(inputShape))
+        interpreter.invoke()
+        return interpreter.get_tensor(outputDetails["index"])
+
+    return predictBatch
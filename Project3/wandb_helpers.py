@@ -2,26 +2,207 @@
 #!pip install wandb
 from datetime import datetime
 import wandb
-from collections import namedtuple
+from collections import deque, namedtuple
+import hashlib
+import json
 import numpy as np
 import os
+import shutil
+import threading
+import time
 import tensorflow as tf
 
 Dataset = namedtuple("Dataset", ["images", "labels"])
 dataset_names = ["training", "validation", "test"]
 
+dataset_artifact = "ml-p2/ml-p2/fashion-mnist"
+
+def model_artifact(model_name):
+    return f"ml-p2/ml-p2/{model_name}"
+
 def start_wandb_run(model_name, config):
     timestamp = datetime.now().strftime("%H%M%S")
     return wandb.init(project=f"ml-p2", entity="ml-p2", name=f"{model_name}-{timestamp}" , 
         notes = f"Training FCNN model @{timestamp}", config = config)
 
-def read_datasets(wandb_run, dataset_tag = "latest"):
+class ArtifactCache:
+    '''
+    Local, content addressed cache of W&B artifacts.
+    Every artifact version is downloaded once into <root>/<name>/<digest>, and a
+    manifest maps "name:alias" (e.g. "fashion-mnist:latest") to the digest it
+    was last resolved to. In offline mode aliases are resolved from the manifest
+    only, so no remote call is made at all.
+    Usage example:
+        cache = ArtifactCache()
+        train_set, validation_set, test_set = wbh.read_datasets(run, cache = cache)
+    '''
+
+    def __init__(self, root = None, offline = None, alias_ttl = 0):
+        '''
+        root -- cache directory (default: $ML_P2_ARTIFACT_CACHE or ~/.cache/ml-p2-artifacts)
+        offline -- resolve from the manifest only (default: True when WANDB_MODE is offline/disabled)
+        alias_ttl -- seconds an alias resolution is trusted without asking W&B again
+        '''
+        if root is None:
+            root = os.environ.get("ML_P2_ARTIFACT_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "ml-p2-artifacts"))
+        if offline is None:
+            offline = os.environ.get("WANDB_MODE", "") in ("offline", "disabled")
+        self.root = root
+        self.offline = offline
+        self.alias_ttl = alias_ttl
+        self.manifest_file = os.path.join(root, "manifest.json")
+        os.makedirs(root, exist_ok=True)
+
+    def get(self, wandb_run, name, tag = "latest", type = None):
+        '''
+        Return the local directory of artifact name:tag, downloading it only if
+        this digest is not cached yet.
+        wandb_run -- a W&B run (or any object with use_artifact), unused when offline
+        '''
+        entry = self._manifest_entry(name, tag)
+        if entry is not None and (self.offline or time.time() - entry["resolved"] < self.alias_ttl):
+            artifact_dir = self._artifact_dir(name, entry["digest"])
+            if os.path.isdir(artifact_dir):
+                return artifact_dir
+        if self.offline:
+            raise FileNotFoundError(f"Artifact {name}:{tag} is not in the local cache {self.root} (offline mode)")
+
+        artifact = wandb_run.use_artifact(f"{name}:{tag}", type=type)
+        artifact_dir = self._artifact_dir(name, artifact.digest)
+        if not os.path.isdir(artifact_dir):
+            # Download next to the final location and move it in place at once,
+            # so an interrupted download never looks like a cached artifact.
+            partial_dir = f"{artifact_dir}.partial-{os.getpid()}"
+            shutil.rmtree(partial_dir, ignore_errors=True)
+            artifact.download(root=partial_dir)
+            try:
+                os.replace(partial_dir, artifact_dir)
+            except OSError:
+                if not os.path.isdir(artifact_dir):
+                    raise
+                shutil.rmtree(partial_dir, ignore_errors=True)
+
+        self._update_manifest(name, [tag, getattr(artifact, "version", None)], artifact.digest, type)
+        return artifact_dir
+
+    def is_cached(self, name, tag = "latest"):
+        entry = self._manifest_entry(name, tag)
+        return entry is not None and os.path.isdir(self._artifact_dir(name, entry["digest"]))
+
+    def is_fresh(self, name, tag = "latest"):
+        '''
+        True when get() returns name:tag without a W&B run: it is cached and
+        its alias resolution is trusted (offline mode, or within alias_ttl).
+        '''
+        entry = self._manifest_entry(name, tag)
+        return self.is_cached(name, tag) and (self.offline or time.time() - entry["resolved"] < self.alias_ttl)
+
+    def _artifact_dir(self, name, digest):
+        return os.path.join(self.root, *name.split("/"), digest)
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_file):
+            return {}
+        with open(self.manifest_file) as f:
+            return json.load(f)
+
+    def _manifest_entry(self, name, tag):
+        return self._read_manifest().get(f"{name}:{tag}")
+
+    def _update_manifest(self, name, tags, digest, type):
+        manifest = self._read_manifest()
+        for tag in tags:
+            if tag is not None:
+                manifest[f"{name}:{tag}"] = dict(digest = digest, type = type, resolved = time.time())
+        temp_file = f"{self.manifest_file}.{os.getpid()}"
+        with open(temp_file, "w") as f:
+            json.dump(manifest, f, indent = 2)
+        os.replace(temp_file, self.manifest_file)
+
+class LocalArtifactRegistry:
+    '''
+    File system backed stand-in for the W&B artifacts registry, for tests and
+    offline experiments (see test_wandb_helpers.py). It has the use_artifact()
+    interface of a W&B run, and counts the use_artifact() and download() calls.
+    Layout: <root>/<name>/<version>/... and <root>/<name>/aliases.json
+    Usage example:
+        registry = LocalArtifactRegistry("/tmp/registry")
+        registry.log_artifact("ml-p2/ml-p2/fashion-mnist", "dataset", "./data")
+        cache.get(registry, "ml-p2/ml-p2/fashion-mnist")
+    '''
+
+    def __init__(self, root):
+        self.root = root
+        self.use_count = 0
+        self.download_count = 0
+
+    def log_artifact(self, name, type, source_dir, aliases = ("latest",)):
+        name_dir = os.path.join(self.root, *name.split("/"))
+        os.makedirs(name_dir, exist_ok=True)
+        aliases_map = self._read_aliases(name_dir)
+        version = f"v{len([k for k in aliases_map if k.startswith('v') and k[1:].isdigit()])}"
+        shutil.copytree(source_dir, os.path.join(name_dir, version))
+        for alias in list(aliases) + [version]:
+            aliases_map[alias] = dict(version = version, type = type, digest = _directory_digest(os.path.join(name_dir, version)))
+        with open(os.path.join(name_dir, "aliases.json"), "w") as f:
+            json.dump(aliases_map, f, indent = 2)
+        return version
+
+    def use_artifact(self, full_name, type = None):
+        name, tag = full_name.rsplit(":", 1)
+        name_dir = os.path.join(self.root, *name.split("/"))
+        entry = self._read_aliases(name_dir).get(tag)
+        if entry is None:
+            raise ValueError(f"Artifact {full_name} not found in {self.root}")
+        if type is not None and entry["type"] != type:
+            raise ValueError(f"Artifact {full_name} is of type {entry['type']}, not {type}")
+        self.use_count += 1
+        return LocalArtifact(self, os.path.join(name_dir, entry["version"]), entry["version"], entry["digest"])
+
+    def _read_aliases(self, name_dir):
+        aliases_file = os.path.join(name_dir, "aliases.json")
+        if not os.path.exists(aliases_file):
+            return {}
+        with open(aliases_file) as f:
+            return json.load(f)
+
+class LocalArtifact:
+    def __init__(self, registry, path, version, digest):
+        self.registry = registry
+        self.path = path
+        self.version = version
+        self.digest = digest
+
+    def download(self, root = None):
+        self.registry.download_count += 1
+        if root is None:
+            return self.path
+        shutil.copytree(self.path, root)
+        return root
+
+def _directory_digest(path):
+    digest = hashlib.md5()
+    for dir_path, dir_names, file_names in os.walk(path):
+        dir_names.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(dir_path, file_name)
+            digest.update(os.path.relpath(file_path, path).replace(os.sep, "/").encode())
+            with open(file_path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(chunk)
+    return digest.hexdigest()
+
+def read_datasets(wandb_run, dataset_tag = "latest", cache = None):
     '''
     Read all datasets from W&B.
     Usage example: train_set, validation_set, test_set = wbh.read_datasets(run)
+    With a cache (see ArtifactCache) the artifact is only downloaded once.
     '''
-    artifact = wandb_run.use_artifact(f'ml-p2/ml-p2/fashion-mnist:{dataset_tag}', type='dataset')
-    data_dir = artifact.download()
+    if cache is not None:
+        data_dir = cache.get(wandb_run, dataset_artifact, dataset_tag, type='dataset')
+    else:
+        artifact = wandb_run.use_artifact(f'{dataset_artifact}:{dataset_tag}', type='dataset')
+        data_dir = artifact.download()
     return [ read_dataset(data_dir, ds_name) for ds_name in dataset_names ]
 
 def read_dataset(data_dir, ds_name):
@@ -29,9 +210,12 @@ def read_dataset(data_dir, ds_name):
     data = np.load(os.path.join(data_dir, filename))
     return Dataset(images = data["x"], labels = data["y"])
 
-def read_model(wandb_run, model_name, model_tag = "latest") -> tf.keras.models.Model:
-    artifact = wandb_run.use_artifact(f'ml-p2/ml-p2/{model_name}:{model_tag}', type='model')
-    artifact_dir = artifact.download()
+def read_model(wandb_run, model_name, model_tag = "latest", cache = None) -> tf.keras.models.Model:
+    if cache is not None:
+        artifact_dir = cache.get(wandb_run, model_artifact(model_name), model_tag, type='model')
+    else:
+        artifact = wandb_run.use_artifact(f'{model_artifact(model_name)}:{model_tag}', type='model')
+        artifact_dir = artifact.download()
     return tf.keras.models.load_model(artifact_dir)
 
 def save_model(wandb_run, model, config, model_name, model_description):
@@ -52,5 +236,120 @@ def load_best_model(sweep_id):
     model_file = runs[0].file("model-best.h5").download(replace=True)
     model_file.close()
 
+class JsonlMetricsBackend:
+    '''Append metric records to a local JSON lines file'''
+
+    def __init__(self, path):
+        self.file = open(path, "a")
+
+    def write(self, records):
+        self.file.write("".join(json.dumps(record) + "\n" for record in records))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+class ParquetMetricsBackend:
+    '''Write metric records to a local Parquet file, one row group per flush (requires pyarrow)'''
+
+    def __init__(self, path):
+        import pyarrow
+        import pyarrow.parquet
+        self.pyarrow = pyarrow
+        self.path = path
+        self.writer = None
+
+    def write(self, records):
+        table = self.pyarrow.Table.from_pylist(records)
+        if self.writer is None:
+            self.writer = self.pyarrow.parquet.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table.cast(self.writer.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+class WandbMetricsBackend:
+    '''Log metric records to a W&B run'''
+
+    def __init__(self, wandb_run):
+        self.wandb_run = wandb_run
+
+    def write(self, records):
+        for record in records:
+            self.wandb_run.log(record)
+
+    def close(self):
+        pass
+
+class MetricsSink:
+    '''
+    Non blocking metrics logging for the inference hot path.
+    log() only appends the record to a bounded in memory queue; a background
+    thread flushes the queued records to the backends in batches, when
+    flush_size records are queued or every flush_interval seconds.
+    When the queue is full the oldest record is dropped (and counted), so a
+    slow backend never blocks or slows down the caller.
+    Usage example:
+        with MetricsSink([JsonlMetricsBackend("metrics.jsonl"), WandbMetricsBackend(run)]) as sink:
+            sink.log({"latency_ms": latency})
+    '''
+
+    def __init__(self, backends, max_queue = 100000, flush_size = 1000, flush_interval = 1.0):
+        self.backends = list(backends)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.queue = deque(maxlen = max_queue)
+        self.condition = threading.Condition()
+        self.dropped = 0
+        self.logged = 0
+        self.written = 0
+        self.errors = 0
+        self.closed = False
+        self.thread = threading.Thread(target = self._flush_loop, name = "metrics-sink", daemon = True)
+        self.thread.start()
+
+    def log(self, record):
+        with self.condition:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(record)
+            self.logged += 1
+            if len(self.queue) >= self.flush_size:
+                self.condition.notify()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        for backend in self.backends:
+            backend.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _flush_loop(self):
+        while True:
+            with self.condition:
+                if not self.closed and len(self.queue) < self.flush_size:
+                    self.condition.wait(self.flush_interval)
+                records = list(self.queue)
+                self.queue.clear()
+                closed = self.closed
+            if records:
+                for backend in self.backends:
+                    try:
+                        backend.write(records)
+                    except Exception as e:
+                        self.errors += 1
+                        print(f"Metrics sink backend {type(backend).__name__} error - {e}")
+                self.written += len(records)
+            if closed:
+                return
+
 #if (__name__ == "__main__"):
 #    load_best_model("6zmewzd0")
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""COCO-style bounding box AP evaluation on flat NumPy arrays.
+
+Follows the COCO (pycocotools) bbox protocol: AP averaged over the IoU thresholds 0.5:0.05:0.95
+and 101 recall points, up to max_detections per image and category, crowd ground truths
+matching any number of detections (with IoU = intersection / detection area) and ignored.
+The per image/category greedy matching is a single Numba kernel over all the groups, the
+precision/recall accumulation is vectorized per category.
+"""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+RECALL_THRESHOLDS = np.linspace(0.0, 1.0, 101)
+
+
+def _match_groups(
+    det_boxes,
+    det_areas,
+    det_group_start,
+    det_group_end,
+    gt_boxes,
+    gt_crowd,
+    gt_ignore,
+    gt_group_start,
+    gt_group_end,
+    iou_thresholds,
+    area_min,
+    area_max,
+    matched,
+    ignored,
+):
+    """Greedily match the detections of every image/category group (sorted by descending score)
+    to its ground truths (sorted with the ignored ones last), for every IoU threshold, exactly
+    like pycocotools COCOeval.evaluateImg.
+    Keyword arguments:
+    det_boxes, det_areas -- (D,4) x,y,width,height detection boxes and their areas
+    det_group_start, det_group_end -- detection ranges of the groups
+    gt_boxes, gt_crowd, gt_ignore -- (G,4) ground truth boxes, crowd and ignore flags
+    gt_group_start, gt_group_end -- ground truth ranges of the same groups
+    iou_thresholds -- (T,) IoU thresholds
+    area_min, area_max -- area range, unmatched detections outside of it are ignored
+    matched, ignored -- (T,D) boolean outputs
+    """
+    num_thresholds = iou_thresholds.shape[0]
+    for group in range(det_group_start.shape[0]):
+        d0, d1 = det_group_start[group], det_group_end[group]
+        g0, g1 = gt_group_start[group], gt_group_end[group]
+        num_gts = g1 - g0
+
+        ious = np.zeros((d1 - d0, num_gts))
+        for d in range(d0, d1):
+            for g in range(g0, g1):
+                width = min(det_boxes[d, 0] + det_boxes[d, 2], gt_boxes[g, 0] + gt_boxes[g, 2]) - max(det_boxes[d, 0], gt_boxes[g, 0])
+                height = min(det_boxes[d, 1] + det_boxes[d, 3], gt_boxes[g, 1] + gt_boxes[g, 3]) - max(det_boxes[d, 1], gt_boxes[g, 1])
+                if width <= 0 or height <= 0:
+                    continue
+                intersection = width * height
+                if gt_crowd[g]:
+                    union = det_areas[d]
+                else:
+                    union = det_areas[d] + gt_boxes[g, 2] * gt_boxes[g, 3] - intersection
+                ious[d - d0, g - g0] = intersection / union
+
+        gt_taken = np.zeros(num_gts, dtype=np.bool_)
+        for t in range(num_thresholds):
+            gt_taken[:] = False
+            for d in range(d0, d1):
+                best_iou = min(iou_thresholds[t], 1 - 1e-10)
+                best = -1
+                for g in range(num_gts):
+                    if gt_taken[g] and not gt_crowd[g0 + g]:
+                        continue
+                    # Once matched to a regular ground truth, never fall back to an ignored one:
+                    if best > -1 and not gt_ignore[g0 + best] and gt_ignore[g0 + g]:
+                        break
+                    if ious[d - d0, g] < best_iou:
+                        continue
+                    best_iou = ious[d - d0, g]
+                    best = g
+                if best == -1:
+                    ignored[t, d] = det_areas[d] < area_min or det_areas[d] > area_max
+                    continue
+                gt_taken[best] = True
+                matched[t, d] = True
+                ignored[t, d] = gt_ignore[g0 + best]
+
+
+if numba is not None:
+    _match_groups = numba.njit(cache=True, nogil=True)(_match_groups)
+
+
+def _groups(keys):
+    """Return the unique keys of a sorted key array and their start/end indexes."""
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]]) if len(keys) else np.zeros(0, dtype=np.int64)
+    ends = np.r_[starts[1:], len(keys)].astype(np.int64)
+    return keys[starts], starts.astype(np.int64), ends
+
+
+def evaluate_detections(
+    gt_boxes,
+    gt_categories,
+    gt_image_ids,
+    det_boxes,
+    det_scores,
+    det_categories,
+    det_image_ids,
+    gt_crowd=None,
+    gt_areas=None,
+    num_categories=None,
+    max_detections=100,
+    area_range=(0.0, 1e10),
+    iou_thresholds=IOU_THRESHOLDS,
+):
+    """Evaluate detections against ground truths and return a dict with AP (COCO mAP@[.5:.95]),
+    AP50, AP75, AR (recall at max_detections averaged over the IoU thresholds), the per category
+    per_class_AP and per_class_recall (NaN for the categories without ground truth),
+    and the raw precision (T,R,K) and recall (T,K) arrays (-1 where undefined).
+    Keyword arguments:
+    gt_boxes -- (G,4) ground truth x,y,width,height boxes
+    gt_categories, gt_image_ids -- (G,) integer category and image ids of the ground truths
+    det_boxes -- (D,4) detection x,y,width,height boxes (e.g. from PostprocessYOLO.process_batch)
+    det_scores, det_categories, det_image_ids -- (D,) scores, integer categories and image ids
+    gt_crowd -- optional (G,) crowd flags
+    gt_areas -- optional (G,) ground truth areas (COCO uses the segmentation areas), for area_range
+    num_categories -- number of categories (default: max category + 1)
+    max_detections -- detections per image and category considered
+    area_range -- ground truths outside this area range are ignored, as the unmatched detections
+    iou_thresholds -- IoU thresholds of the AP average
+    """
+    gt_boxes = np.asarray(gt_boxes, dtype=np.float64).reshape(-1, 4)
+    det_boxes = np.asarray(det_boxes, dtype=np.float64).reshape(-1, 4)
+    gt_categories = np.asarray(gt_categories, dtype=np.int64)
+    det_categories = np.asarray(det_categories, dtype=np.int64)
+    det_scores = np.asarray(det_scores, dtype=np.float64)
+    gt_crowd = np.zeros(len(gt_boxes), dtype=np.bool_) if gt_crowd is None else np.asarray(gt_crowd, dtype=np.bool_)
+    gt_areas = gt_boxes[:, 2] * gt_boxes[:, 3] if gt_areas is None else np.asarray(gt_areas, dtype=np.float64)
+    iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64)
+    if num_categories is None:
+        num_categories = int(max(gt_categories.max(initial=-1), det_categories.max(initial=-1))) + 1
+
+    # Dense image indexes, and one integer key per image/category group:
+    image_ids, image_index = np.unique(np.r_[np.asarray(gt_image_ids), np.asarray(det_image_ids)], return_inverse=True)
+    gt_keys = gt_categories * len(image_ids) + image_index[: len(gt_boxes)]
+    det_keys = det_categories * len(image_ids) + image_index[len(gt_boxes) :]
+    gt_ignore = gt_crowd | (gt_areas < area_range[0]) | (gt_areas > area_range[1])
+
+    # Ground truths by group, the ignored ones last; detections by group and descending score
+    # (stable, as the pycocotools mergesort):
+    gt_order = np.lexsort((gt_ignore, gt_keys))
+    gt_boxes, gt_keys, gt_crowd, gt_ignore = gt_boxes[gt_order], gt_keys[gt_order], gt_crowd[gt_order], gt_ignore[gt_order]
+    det_order = np.lexsort((-det_scores, det_keys))
+    # Only the max_detections best scored detections of every group count:
+    group_keys, group_start, group_end = _groups(det_keys[det_order])
+    rank = np.arange(len(det_order)) - np.repeat(group_start, group_end - group_start)
+    det_order = det_order[rank < max_detections]
+    det_boxes, det_scores, det_keys = det_boxes[det_order], det_scores[det_order], det_keys[det_order]
+    det_areas = det_boxes[:, 2] * det_boxes[:, 3]
+
+    group_keys, det_group_start, det_group_end = _groups(det_keys)
+    gt_group_start = np.searchsorted(gt_keys, group_keys, side="left").astype(np.int64)
+    gt_group_end = np.searchsorted(gt_keys, group_keys, side="right").astype(np.int64)
+
+    num_thresholds = len(iou_thresholds)
+    matched = np.zeros((num_thresholds, len(det_boxes)), dtype=np.bool_)
+    ignored = np.zeros((num_thresholds, len(det_boxes)), dtype=np.bool_)
+    _match_groups(
+        det_boxes,
+        det_areas,
+        det_group_start,
+        det_group_end,
+        gt_boxes,
+        gt_crowd,
+        gt_ignore,
+        gt_group_start,
+        gt_group_end,
+        iou_thresholds,
+        float(area_range[0]),
+        float(area_range[1]),
+        matched,
+        ignored,
+    )
+
+    # Accumulate per category: the detections of all the images by descending score.
+    det_category = det_keys // len(image_ids)
+    gt_positives = np.bincount(gt_keys[~gt_ignore] // len(image_ids), minlength=num_categories)
+    precision = -np.ones((num_thresholds, len(RECALL_THRESHOLDS), num_categories))
+    recall = -np.ones((num_thresholds, num_categories))
+    category_order = np.lexsort((-det_scores, det_category))
+    category_keys, category_start, category_end = _groups(det_category[category_order])
+    category_ranges = dict(zip(category_keys.tolist(), zip(category_start, category_end)))
+    for category in range(num_categories):
+        if gt_positives[category] == 0:
+            continue
+        start, end = category_ranges.get(category, (0, 0))
+        indexes = category_order[start:end]
+        valid = ~ignored[:, indexes]
+        true_positives = np.cumsum(matched[:, indexes] & valid, axis=1, dtype=np.float64)
+        false_positives = np.cumsum(~matched[:, indexes] & valid, axis=1, dtype=np.float64)
+        if true_positives.shape[1] == 0:
+            recall[:, category] = 0.0
+            precision[:, :, category] = 0.0
+            continue
+        category_recall = true_positives / gt_positives[category]
+        category_precision = true_positives / (true_positives + false_positives + np.spacing(1))
+        recall[:, category] = category_recall[:, -1]
+        # Interpolated precision: the maximum precision at any higher recall.
+        category_precision = np.maximum.accumulate(category_precision[:, ::-1], axis=1)[:, ::-1]
+        for t in range(num_thresholds):
+            positions = np.searchsorted(category_recall[t], RECALL_THRESHOLDS, side="left")
+            inside = positions < category_recall.shape[1]
+            precision[t, :, category] = np.where(inside, category_precision[t, np.minimum(positions, category_recall.shape[1] - 1)], 0.0)
+
+    def mean_valid(values):
+        values = values[values > -1]
+        return float(values.mean()) if values.size else -1.0
+
+    has_gt = gt_positives > 0
+    per_class_ap = np.full(num_categories, np.nan)
+    per_class_ap[has_gt] = precision[:, :, has_gt].mean(axis=(0, 1))
+    per_class_recall = np.full(num_categories, np.nan)
+    per_class_recall[has_gt] = recall[:, has_gt].mean(axis=0)
+    iou_50 = np.flatnonzero(np.isclose(iou_thresholds, 0.5))
+    iou_75 = np.flatnonzero(np.isclose(iou_thresholds, 0.75))
+    return {
+        "AP": mean_valid(precision),
+        "AP50": mean_valid(precision[iou_50]) if iou_50.size else -1.0,
+        "AP75": mean_valid(precision[iou_75]) if iou_75.size else -1.0,
+        "AR": mean_valid(recall),
+        "per_class_AP": per_class_ap,
+        "per_class_recall": per_class_recall,
+        "precision": precision,
+        "recall": recall,
+        "images": len(image_ids),
+        "detections": len(det_boxes),
+        "ground_truths": len(gt_boxes),
+    }
+
+
+def print_evaluation(result, all_categories=None, top=10):
+    """Print the summary of evaluate_detections and the categories with the lowest AP."""
+    print(
+        "AP %.3f  AP50 %.3f  AP75 %.3f  AR %.3f  (%d images, %d ground truths, %d detections)"
+        % (result["AP"], result["AP50"], result["AP75"], result["AR"], result["images"], result["ground_truths"], result["detections"])
+    )
+    per_class_ap = result["per_class_AP"]
+    for category in [c for c in np.argsort(per_class_ap) if not np.isnan(per_class_ap[c])][:top]:
+        name = all_categories[category] if all_categories is not None else str(category)
+        print("  %-20s AP %.3f  recall %.3f" % (name, per_class_ap[category], result["per_class_recall"][category]))
+
+
+def synthetic_dataset(num_images, num_categories=80, objects_per_image=7, seed=0):
+    """Return synthetic (ground truths, detections) tuples of arrays: every ground truth is
+    detected with a jittered box, plus random false positives."""
+    rng = np.random.default_rng(seed)
+    num_gts = num_images * objects_per_image
+    gt_image_ids = np.repeat(np.arange(num_images), objects_per_image)
+    gt_categories = rng.integers(0, num_categories, size=num_gts)
+    gt_boxes = np.concatenate([rng.uniform(0, 500, size=(num_gts, 2)), rng.uniform(10, 200, size=(num_gts, 2))], axis=1)
+
+    found = rng.uniform(size=num_gts) < 0.8
+    det_boxes = gt_boxes[found] + rng.normal(0.0, 0.08, size=(found.sum(), 4)) * gt_boxes[found][:, [2, 3, 2, 3]]
+    det_boxes[:, 2:] = np.maximum(det_boxes[:, 2:], 1.0)
+    num_false = num_gts // 2
+    false_boxes = np.concatenate([rng.uniform(0, 500, size=(num_false, 2)), rng.uniform(10, 200, size=(num_false, 2))], axis=1)
+    det_boxes = np.concatenate([det_boxes, false_boxes])
+    det_scores = np.concatenate([rng.uniform(0.3, 1.0, size=found.sum()), rng.uniform(0.0, 0.7, size=num_false)])
+    det_categories = np.concatenate([gt_categories[found], rng.integers(0, num_categories, size=num_false)])
+    det_image_ids = np.concatenate([gt_image_ids[found], rng.integers(0, num_images, size=num_false)])
+    return (gt_boxes, gt_categories, gt_image_ids), (det_boxes, det_scores, det_categories, det_image_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", type=int, default=5000, help="synthetic validation set size")
+    args = parser.parse_args()
+
+    (gt_boxes, gt_categories, gt_image_ids), detections = synthetic_dataset(args.images)
+    # The first call compiles the matching kernel:
+    evaluate_detections(gt_boxes[:10], gt_categories[:10], gt_image_ids[:10], *[d[:10] for d in detections])
+    start = time.perf_counter()
+    result = evaluate_detections(gt_boxes, gt_categories, gt_image_ids, *detections)
+    print("evaluated in %.2f s" % (time.perf_counter() - start))
+    print_evaluation(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -16,10 +16,20 @@
 #
 
 import math
-from PIL import Image
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageDraw
 import numpy as np
 import os
 
+from nms import batched_nms, soft_nms
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 # YOLOv3-608 has been trained with these 80 categories from COCO:
 # Lin, Tsung-Yi, et al. "Microsoft COCO: Common Objects in Context."
@@ -39,18 +49,138 @@ CATEGORY_NUM = len(ALL_CATEGORIES)
 assert CATEGORY_NUM == 80
 
 
+def _decode_feats_dense(feats, anchors, res_0, res_1, boxes, box_confidences, box_class_probs):
+    """Decode one YOLO output directly from its NCHW layout.
+    The math is done per element in float64 with math.exp, exactly as the original
+    np.vectorize based implementation, so the results are bit identical.
+    Keyword arguments:
+    feats -- YOLO output as a (3,85,height,width) float32 array (a view of the NCHW output)
+    anchors -- (3,2) float64 array with the anchors of the output's mask
+    res_0, res_1 -- network input resolution the box sizes are divided by
+    boxes -- (height,width,3,4) float64 output array
+    box_confidences -- (height,width,3,1) float64 output array
+    box_class_probs -- (height,width,3,CATEGORY_NUM) float64 output array
+    """
+    num_anchors, num_channels, grid_h, grid_w = feats.shape
+    for anchor in range(num_anchors):
+        anchor_w = anchors[anchor, 0]
+        anchor_h = anchors[anchor, 1]
+        for row in range(grid_h):
+            for col in range(grid_w):
+                box_w = math.exp(np.float64(feats[anchor, 2, row, col])) * anchor_w / res_0
+                box_h = math.exp(np.float64(feats[anchor, 3, row, col])) * anchor_h / res_1
+                box_x = 1.0 / (1.0 + math.exp(-np.float64(feats[anchor, 0, row, col])))
+                box_y = 1.0 / (1.0 + math.exp(-np.float64(feats[anchor, 1, row, col])))
+                boxes[row, col, anchor, 0] = (box_x + col) / grid_w - box_w / 2.0
+                boxes[row, col, anchor, 1] = (box_y + row) / grid_h - box_h / 2.0
+                boxes[row, col, anchor, 2] = box_w
+                boxes[row, col, anchor, 3] = box_h
+                box_confidences[row, col, anchor, 0] = 1.0 / (1.0 + math.exp(-np.float64(feats[anchor, 4, row, col])))
+                for category in range(num_channels - 5):
+                    box_class_probs[row, col, anchor, category] = 1.0 / (
+                        1.0 + math.exp(-np.float64(feats[anchor, 5 + category, row, col]))
+                    )
+
+
+def _decode_feats_sparse(feats, anchors, res_0, res_1, cells, boxes, box_confidences, box_class_probs):
+    """Decode only the selected cells of one YOLO output, with the same per element
+    arithmetic as _decode_feats_dense.
+    Keyword arguments:
+    feats -- YOLO output as a (3,85,height,width) float32 array
+    anchors -- (3,2) float64 array with the anchors of the output's mask
+    res_0, res_1 -- network input resolution the box sizes are divided by
+    cells -- (K,3) integer array of (row, col, anchor) cells to decode
+    boxes -- (K,4) float64 output array
+    box_confidences -- (K,1) float64 output array
+    box_class_probs -- (K,CATEGORY_NUM) float64 output array
+    """
+    num_channels, grid_h, grid_w = feats.shape[1], feats.shape[2], feats.shape[3]
+    for idx in range(cells.shape[0]):
+        row = cells[idx, 0]
+        col = cells[idx, 1]
+        anchor = cells[idx, 2]
+        box_w = math.exp(np.float64(feats[anchor, 2, row, col])) * anchors[anchor, 0] / res_0
+        box_h = math.exp(np.float64(feats[anchor, 3, row, col])) * anchors[anchor, 1] / res_1
+        box_x = 1.0 / (1.0 + math.exp(-np.float64(feats[anchor, 0, row, col])))
+        box_y = 1.0 / (1.0 + math.exp(-np.float64(feats[anchor, 1, row, col])))
+        boxes[idx, 0] = (box_x + col) / grid_w - box_w / 2.0
+        boxes[idx, 1] = (box_y + row) / grid_h - box_h / 2.0
+        boxes[idx, 2] = box_w
+        boxes[idx, 3] = box_h
+        box_confidences[idx, 0] = 1.0 / (1.0 + math.exp(-np.float64(feats[anchor, 4, row, col])))
+        for category in range(num_channels - 5):
+            box_class_probs[idx, category] = 1.0 / (1.0 + math.exp(-np.float64(feats[anchor, 5 + category, row, col])))
+
+
+if numba is not None:
+    _decode_feats_dense = numba.njit(cache=True, nogil=True)(_decode_feats_dense)
+    _decode_feats_sparse = numba.njit(cache=True, nogil=True)(_decode_feats_sparse)
+
+
+def _sigmoid(values):
+    """Return the float64 sigmoid of a float32 array, using NumPy ufuncs only."""
+    result = np.negative(values, dtype=np.float64)
+    np.exp(result, out=result)
+    result += 1.0
+    return np.reciprocal(result, out=result)
+
+
+def draw_bboxes(image_raw, bboxes, confidences, categories, all_categories, bbox_color="blue", verbose=True):
+    """Draw the bounding boxes on the original input image and return it.
+    Keyword arguments:
+    image_raw -- a raw PIL Image
+    bboxes -- NumPy array containing the bounding box coordinates of N objects, with shape (N,4).
+    categories -- NumPy array containing the corresponding category for each object,
+    with shape (N,)
+    confidences -- NumPy array containing the corresponding confidence for each object,
+    with shape (N,)
+    all_categories -- a list of all categories in the correct ordered (required for looking up
+    the category name)
+    bbox_color -- an optional string specifying the color of the bounding boxes (default: 'blue')
+    verbose -- print the detections
+    """
+    draw = ImageDraw.Draw(image_raw)
+    if verbose:
+        print(bboxes, confidences, categories)
+    for box, score, category in zip(bboxes, confidences, categories):
+        x_coord, y_coord, width, height = box
+        left = max(0, np.floor(x_coord + 0.5).astype(int))
+        top = max(0, np.floor(y_coord + 0.5).astype(int))
+        right = min(image_raw.width, np.floor(x_coord + width + 0.5).astype(int))
+        bottom = min(image_raw.height, np.floor(y_coord + height + 0.5).astype(int))
+
+        draw.rectangle(((left, top), (right, bottom)), outline=bbox_color)
+        draw.text((left, top - 12), "{0} {1:.2f}".format(all_categories[category], score), fill=bbox_color)
+
+    return image_raw
+
+
 class PreprocessYOLO(object):
     """A simple class for loading images with PIL and reshaping them to the specified
     input resolution for YOLOv3-608.
     """
 
-    def __init__(self, yolo_input_resolution):
+    def __init__(self, yolo_input_resolution, draft=False, uint8_input=False):
         """Initialize with the input resolution for YOLOv3, which will stay fixed in this sample.
         Keyword arguments:
         yolo_input_resolution -- two-dimensional tuple with the target network's (spatial)
         input resolution in HW order
+        draft -- decode JPEG images that are at least twice as large as the input resolution
+        at a reduced DCT scale (1/2, 1/4 or 1/8), the smallest one still larger than the
+        resized image. Other formats are always fully decoded. The returned raw image is then
+        the reduced one, and the boxes are scaled to it; check the detection agreement with
+        decode_benchmark.py before enabling it (default: False)
+        uint8_input -- process and process_frame return the resized image as a (1,height,width,3)
+        uint8 array, for a model whose input was rewritten to take raw NHWC bytes (the Cast,
+        normalization and transpose done in the graph); process_batch is not affected
         """
         self.yolo_input_resolution = yolo_input_resolution
+        self.draft = draft
+        self.uint8_input = uint8_input
+        # Decoding counters: images, drafted images, decode time (in seconds) and
+        # the source and decoded pixel counts:
+        self.decode_stats = {"images": 0, "drafted": 0, "decode_time": 0.0, "source_pixels": 0, "decoded_pixels": 0}
+        self._stats_lock = threading.Lock()
 
     def process(self, input_image_path):
         """Load an image from the specified input path,
@@ -63,6 +193,120 @@ class PreprocessYOLO(object):
         image_preprocessed = self._shuffle_and_normalize(image_resized)
         return image_raw, image_preprocessed
 
+    def process_frame(self, image_raw):
+        """Return the pre-processed version of an already decoded image, e.g. a video frame.
+        Keyword arguments:
+        image_raw -- a PIL Image in RGB mode
+        """
+        return self._shuffle_and_normalize(self._resize(image_raw))
+
+    def process_batch(self, input_image_paths, out=None, num_threads=None, letterbox=True, fill_value=128):
+        """Load, resize and normalize a batch of images on a thread pool, each one written
+        straight into its slot of a single (N,3,height,width) float32 buffer.
+        Return the raw PIL images, the batch buffer and an (N,4) array with the
+        scale_x, scale_y, pad_x, pad_y transform from every raw image to the network input,
+        to be passed as letterboxes to PostprocessYOLO.
+        Keyword arguments:
+        input_image_paths -- string paths of the images to be loaded
+        out -- optional preallocated (N,3,height,width) float32 buffer (e.g. page locked memory)
+        num_threads -- worker threads (default: one per image, up to the CPU count)
+        letterbox -- keep the aspect ratio and pad the borders with fill_value, otherwise
+        stretch the images like process() does
+        fill_value -- the 8-bit padding gray level
+        """
+        batch_size = len(input_image_paths)
+        height, width = self.yolo_input_resolution
+        if out is None:
+            out = np.empty((batch_size, 3, height, width), dtype=np.float32)
+        assert out.shape == (batch_size, 3, height, width) and out.dtype == np.float32
+        images_raw = [None] * batch_size
+        transforms = np.empty((batch_size, 4), dtype=np.float64)
+
+        def process_image(index):
+            images_raw[index], transforms[index] = self._load_and_letterbox(
+                input_image_paths[index], out[index], letterbox, fill_value
+            )
+
+        if num_threads is None:
+            num_threads = min(batch_size, os.cpu_count() or 1)
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                list(executor.map(process_image, range(batch_size)))
+        else:
+            for index in range(batch_size):
+                process_image(index)
+
+        return images_raw, out, transforms
+
+    def _load_and_letterbox(self, input_image_path, slot, letterbox, fill_value):
+        """Load an image, resize it (keeping its aspect ratio when letterbox is set) and write it,
+        normalized to [0, 1] and in CHW format, into slot in a single pass.
+        Return the raw PIL image and its (scale_x, scale_y, pad_x, pad_y) transform.
+        Keyword arguments:
+        input_image_path -- string path of the image to be loaded
+        slot -- (3,height,width) float32 view to write the image to
+        letterbox -- keep the aspect ratio and pad the borders with fill_value
+        fill_value -- the 8-bit padding gray level
+        """
+        height, width = self.yolo_input_resolution
+
+        def letterbox_size(size):
+            scale = min(width / size[0], height / size[1])
+            return max(1, int(round(size[0] * scale))), max(1, int(round(size[1] * scale)))
+
+        image_raw = self._open_image(input_image_path, letterbox_size if letterbox else lambda size: (width, height))
+        raw_width, raw_height = image_raw.size
+
+        if letterbox:
+            new_width, new_height = letterbox_size(image_raw.size)
+            pad_x = (width - new_width) // 2
+            pad_y = (height - new_height) // 2
+            scale_x, scale_y = new_width / raw_width, new_height / raw_height
+        else:
+            new_width, new_height, pad_x, pad_y = width, height, 0, 0
+            scale_x, scale_y = width / raw_width, height / raw_height
+
+        image_resized = image_raw.convert("RGB").resize((new_width, new_height), resample=Image.BICUBIC)
+        if new_width != width or new_height != height:
+            slot.fill(np.float32(fill_value) / np.float32(255.0))
+        # HWC uint8 to normalized CHW float32, fused in a single pass into the slot:
+        np.divide(
+            np.asarray(image_resized).transpose(2, 0, 1),
+            np.float32(255.0),
+            out=slot[:, pad_y : pad_y + new_height, pad_x : pad_x + new_width],
+            dtype=np.float32,
+        )
+        return image_raw, (scale_x, scale_y, pad_x, pad_y)
+
+    def _open_image(self, input_image_path, target_size):
+        """Open and decode an image, at a reduced scale for large JPEG images when draft
+        decoding is enabled. The returned image is then the reduced one, so the boxes are
+        mapped to (and drawn on) its resolution.
+        Keyword arguments:
+        input_image_path -- string path of the image to be loaded
+        target_size -- function of the source (width, height) returning the (width, height)
+        the image will be resized to
+        """
+        image_raw = Image.open(input_image_path)
+        source_width, source_height = image_raw.size
+        drafted = False
+        if self.draft and image_raw.format == "JPEG":
+            # PIL picks the largest scale keeping both sides >= the requested size:
+            image_raw.draft(None, target_size(image_raw.size))
+            drafted = image_raw.size != (source_width, source_height)
+
+        start = time.perf_counter()
+        image_raw.load()
+        decode_time = time.perf_counter() - start
+
+        with self._stats_lock:
+            self.decode_stats["images"] += 1
+            self.decode_stats["drafted"] += int(drafted)
+            self.decode_stats["decode_time"] += decode_time
+            self.decode_stats["source_pixels"] += source_width * source_height
+            self.decode_stats["decoded_pixels"] += image_raw.size[0] * image_raw.size[1]
+        return image_raw
+
     def _load_and_resize(self, input_image_path):
         """Load an image from the specified path and resize it to the input resolution.
         Return the input image before resizing as a PIL Image (required for visualization),
@@ -71,13 +315,23 @@ class PreprocessYOLO(object):
         input_image_path -- string path of the image to be loaded
         """
 
-        image_raw = Image.open(input_image_path)
+        # Expecting yolo_input_resolution in (height, width) format, adjusting to PIL
+        # convention (width, height) in PIL:
+        new_resolution = (self.yolo_input_resolution[1], self.yolo_input_resolution[0])
+        image_raw = self._open_image(input_image_path, lambda size: new_resolution)
+        return image_raw, self._resize(image_raw)
+
+    def _resize(self, image_raw):
+        """Resize a PIL Image to the input resolution and return it as a NumPy float array.
+        Keyword arguments:
+        image_raw -- a PIL Image
+        """
         # Expecting yolo_input_resolution in (height, width) format, adjusting to PIL
         # convention (width, height) in PIL:
         new_resolution = (self.yolo_input_resolution[1], self.yolo_input_resolution[0])
         image_resized = image_raw.resize(new_resolution, resample=Image.BICUBIC)
-        image_resized = np.array(image_resized, dtype=np.float32, order="C")
-        return image_raw, image_resized
+        image_resized = np.array(image_resized, dtype=np.uint8 if self.uint8_input else np.float32, order="C")
+        return image_resized
 
     def _shuffle_and_normalize(self, image):
         """Normalize a NumPy array representing an image to the range [0, 1], and
@@ -86,6 +340,9 @@ class PreprocessYOLO(object):
         Keyword arguments:
         image -- image as three-dimensional NumPy float array, in HWC format
         """
+        if self.uint8_input:
+            # HWC to NHWC format, without a copy:
+            return image[np.newaxis]
         image /= 255.0
         # HWC to CHW format:
         image = np.transpose(image, [2, 0, 1])
@@ -99,7 +356,19 @@ class PreprocessYOLO(object):
 class PostprocessYOLO(object):
     """Class for post-processing the three outputs tensors from YOLOv3-608."""
 
-    def __init__(self, yolo_masks, yolo_anchors, obj_threshold, nms_threshold, yolo_input_resolution):
+    def __init__(
+        self,
+        yolo_masks,
+        yolo_anchors,
+        obj_threshold,
+        nms_threshold,
+        yolo_input_resolution,
+        decode_mode="dense",
+        max_candidates=None,
+        max_detections=None,
+        nms_method="hard",
+        soft_nms_sigma=0.5,
+    ):
         """Initialize with all values that will be kept when processing several frames.
         Assuming 3 outputs of the network in the case of (large) YOLOv3.
         Keyword arguments:
@@ -110,51 +379,120 @@ class PostprocessYOLO(object):
         float value between 0 and 1
         input_resolution_yolo -- two-dimensional tuple with the target network's (spatial)
         input resolution in HW order
+        decode_mode -- 'dense' decodes every cell, 'sparse' first thresholds the objectness
+        logits and decodes only the surviving cells (same detections, much less work)
+        max_candidates -- optional cap on the number of candidates per image that reach NMS,
+        the ones with the highest scores are kept
+        max_detections -- optional cap on the number of detections per image after NMS
+        nms_method -- 'hard' for the greedy NMS, 'soft' for Gaussian Soft-NMS, which decays
+        the scores of overlapping boxes instead of discarding them
+        soft_nms_sigma -- the Gaussian Soft-NMS decay parameter
         """
+        assert decode_mode in ["dense", "sparse"]
+        assert nms_method in ["hard", "soft"]
         self.masks = yolo_masks
         self.anchors = yolo_anchors
         self.object_threshold = obj_threshold
         self.nms_threshold = nms_threshold
         self.input_resolution_yolo = yolo_input_resolution
-
-    def process(self, outputs, resolution_raw):
+        # Cell offsets grids and anchor tensors, per (grid_h, grid_w, mask):
+        self._grid_cache = dict()
+        self.decode_mode = decode_mode
+        self.max_candidates = max_candidates
+        self.max_detections = max_detections
+        self.nms_method = nms_method
+        self.soft_nms_sigma = soft_nms_sigma
+        # box_confidence * class_prob >= obj_threshold requires box_confidence >= obj_threshold,
+        # i.e. an objectness logit >= logit(obj_threshold). The gate is slightly relaxed so that
+        # float rounding can never drop a cell the exact score test would keep.
+        if 0.0 < obj_threshold < 1.0:
+            self.objectness_logit_threshold = math.log(obj_threshold / (1.0 - obj_threshold)) - 1e-6
+        else:
+            self.objectness_logit_threshold = -np.inf
+
+    def process(self, outputs, resolution_raw, letterbox=None):
         """Take the YOLOv3 outputs generated from a TensorRT forward pass, post-process them
         and return a list of bounding boxes for detected object together with their category
         and their confidences in separate lists.
         Keyword arguments:
         outputs -- outputs from a TensorRT engine in NCHW format
         resolution_raw -- the original spatial resolution from the input PIL image in WH order
+        letterbox -- optional (scale_x, scale_y, pad_x, pad_y) transform returned by
+        PreprocessYOLO.process_batch, to map the boxes back through the letterboxing
         """
         outputs_reshaped = list()
         for output in outputs:
             outputs_reshaped.append(self._reshape_output(output))
 
-        boxes, categories, confidences = self._process_yolo_output(outputs_reshaped, resolution_raw)
+        boxes, categories, confidences = self._process_yolo_output(outputs_reshaped, resolution_raw, letterbox)
 
         return boxes, categories, confidences
 
+    def process_batch(self, outputs, resolutions_raw, num_threads=None, letterboxes=None):
+        """Post-process the YOLOv3 outputs of a whole batch of images, in parallel threads
+        (the Numba decode and NMS kernels release the GIL), and return the detections of all
+        images as compact arrays: boxes (M,4), categories (M,), confidences (M,) and offsets
+        (N+1,), the detections of image i being the rows offsets[i]:offsets[i+1].
+        Keyword arguments:
+        outputs -- the three outputs of a batched TensorRT engine in NCHW format,
+        with shapes (N,255,height,width)
+        resolutions_raw -- N original spatial resolutions of the input images in WH order
+        num_threads -- worker threads (default: one per image, up to the CPU count)
+        letterboxes -- optional (N,4) transforms returned by PreprocessYOLO.process_batch
+        """
+        batch_size = len(resolutions_raw)
+        assert all(len(output) == batch_size for output in outputs)
+
+        def process_image(index):
+            outputs_reshaped = [self._reshape_output(output[index : index + 1]) for output in outputs]
+            letterbox = None if letterboxes is None else letterboxes[index]
+            return self._process_yolo_output(outputs_reshaped, resolutions_raw[index], letterbox)
+
+        if num_threads is None:
+            num_threads = min(batch_size, os.cpu_count() or 1)
+        if num_threads > 1:
+            with ThreadPoolExecutor(max_workers=num_threads) as executor:
+                results = list(executor.map(process_image, range(batch_size)))
+        else:
+            results = [process_image(index) for index in range(batch_size)]
+
+        counts = [0 if boxes is None else len(boxes) for boxes, _, _ in results]
+        offsets = np.zeros(batch_size + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        boxes = np.empty((offsets[-1], 4), dtype=np.float64)
+        categories = np.empty(offsets[-1], dtype=np.int64)
+        confidences = np.empty(offsets[-1], dtype=np.float64)
+        for index, (image_boxes, image_categories, image_confidences) in enumerate(results):
+            if image_boxes is not None:
+                start, end = offsets[index], offsets[index + 1]
+                boxes[start:end] = image_boxes
+                categories[start:end] = image_categories
+                confidences[start:end] = image_confidences
+
+        return boxes, categories, confidences, offsets
+
     def _reshape_output(self, output):
-        """Reshape a TensorRT output from NCHW to NHWC format (with expected C=255),
-        and then return it in (height,width,3,85) dimensionality after further reshaping.
+        """Reshape a TensorRT output from NCHW format (with expected C=255) to
+        (3,85,height,width) without copying it. The decoding works on this layout directly.
         Keyword argument:
         output -- an output from a TensorRT engine after inference
         """
-        output = np.transpose(output, [0, 2, 3, 1])
-        _, height, width, _ = output.shape
-        dim1, dim2 = height, width
-        dim3 = 3
+        _, _, height, width = output.shape
+        dim1 = 3
         # There are CATEGORY_NUM=80 object categories:
-        dim4 = 4 + 1 + CATEGORY_NUM
-        return np.reshape(output, (dim1, dim2, dim3, dim4))
+        dim2 = 4 + 1 + CATEGORY_NUM
+        return np.reshape(output, (dim1, dim2, height, width))
 
-    def _process_yolo_output(self, outputs_reshaped, resolution_raw):
-        """Take in a list of three reshaped YOLO outputs in (height,width,3,85) shape and return
+    def _process_yolo_output(self, outputs_reshaped, resolution_raw, letterbox=None):
+        """Take in a list of three reshaped YOLO outputs in (3,85,height,width) shape and return
         return a list of bounding boxes for detected object together with their category and their
         confidences in separate lists.
         Keyword arguments:
         outputs_reshaped -- list of three reshaped YOLO outputs as NumPy arrays
-        with shape (height,width,3,85)
+        with shape (3,85,height,width)
         resolution_raw -- the original spatial resolution from the input PIL image in WH order
+        letterbox -- optional (scale_x, scale_y, pad_x, pad_y) transform of the preprocessing
         """
 
         # E.g. in YOLOv3-608, there are three output tensors, which we associate with their
@@ -162,7 +500,10 @@ class PostprocessYOLO(object):
         # for bounding boxes, their corresponding category predictions and their confidences:
         boxes, categories, confidences = list(), list(), list()
         for output, mask in zip(outputs_reshaped, self.masks):
-            box, category, confidence = self._process_feats(output, mask)
+            if self.decode_mode == "sparse":
+                box, category, confidence = self._process_feats_sparse(output, mask)
+            else:
+                box, category, confidence = self._process_feats(output, mask)
             box, category, confidence = self._filter_boxes(box, category, confidence)
             boxes.append(box)
             categories.append(category)
@@ -172,77 +513,81 @@ class PostprocessYOLO(object):
         categories = np.concatenate(categories)
         confidences = np.concatenate(confidences)
 
+        if self.max_candidates is not None and len(confidences) > self.max_candidates:
+            # Keep the top-k scores, in their original order:
+            top = np.sort(np.argpartition(-confidences, self.max_candidates - 1)[: self.max_candidates])
+            boxes, categories, confidences = boxes[top], categories[top], confidences[top]
+
         # Scale boxes back to original image shape:
-        width, height = resolution_raw
-        image_dims = [width, height, width, height]
-        boxes = boxes * image_dims
+        if letterbox is None:
+            width, height = resolution_raw
+            image_dims = [width, height, width, height]
+            boxes = boxes * image_dims
+        else:
+            # Network input pixels, minus the padding, divided by the resize scale:
+            scale_x, scale_y, pad_x, pad_y = letterbox
+            input_h, input_w = self.input_resolution_yolo
+            boxes = boxes * [input_w, input_h, input_w, input_h]
+            boxes -= [pad_x, pad_y, 0.0, 0.0]
+            boxes /= [scale_x, scale_y, scale_x, scale_y]
 
         # Using the candidates from the previous (loop) step, we apply the non-max suppression
-        # algorithm that clusters adjacent bounding boxes to a single bounding box:
-        nms_boxes, nms_categories, nscores = list(), list(), list()
-        for category in set(categories):
-            idxs = np.where(categories == category)
-            box = boxes[idxs]
-            category = categories[idxs]
-            confidence = confidences[idxs]
-
-            keep = self._nms_boxes(box, confidence)
-
-            nms_boxes.append(box[keep])
-            nms_categories.append(category[keep])
-            nscores.append(confidence[keep])
-
-        if not nms_categories and not nscores:
+        # algorithm that clusters adjacent bounding boxes to a single bounding box. All the
+        # categories are suppressed in a single class aware pass:
+        if len(confidences) == 0:
             return None, None, None
 
-        boxes = np.concatenate(nms_boxes)
-        categories = np.concatenate(nms_categories)
-        confidences = np.concatenate(nscores)
+        if self.nms_method == "soft":
+            keep, confidences = soft_nms(
+                boxes,
+                confidences,
+                sigma=self.soft_nms_sigma,
+                score_threshold=self.object_threshold,
+                max_detections=self.max_detections,
+                classes=categories,
+            )
+            return boxes[keep], categories[keep], confidences
 
-        return boxes, categories, confidences
+        keep = batched_nms(boxes, confidences, categories, self.nms_threshold, self.max_detections)
+
+        return boxes[keep], categories[keep], confidences[keep]
 
     def _process_feats(self, output_reshaped, mask):
-        """Take in a reshaped YOLO output in height,width,3,85 format together with its
+        """Take in a reshaped YOLO output in 3,85,height,width format together with its
         corresponding YOLO mask and return the detected bounding boxes, the confidence,
-        and the class probability in each cell/pixel.
+        and the class probability in each cell/pixel, in (height,width,3,...) format.
+        With Numba available the decoding is compiled and bit identical to the original
+        per element math.exp implementation, otherwise NumPy ufuncs are used (the results
+        may then differ in the last bit).
         Keyword arguments:
-        output_reshaped -- reshaped YOLO output as NumPy arrays with shape (height,width,3,85)
-        mask -- 2-dimensional tuple with mask specification for this output
+        output_reshaped -- reshaped YOLO output as NumPy arrays with shape (3,85,height,width)
+        mask -- 3-dimensional tuple with mask specification for this output
         """
-
-        # Two in-line functions required for calculating the bounding box
-        # descriptors:
-        def sigmoid(value):
-            """Return the sigmoid of the input."""
-            return 1.0 / (1.0 + math.exp(-value))
-
-        def exponential(value):
-            """Return the exponential of the input."""
-            return math.exp(value)
-
-        # Vectorized calculation of above two functions:
-        sigmoid_v = np.vectorize(sigmoid)
-        exponential_v = np.vectorize(exponential)
-
-        grid_h, grid_w, _, _ = output_reshaped.shape
-
-        anchors = [self.anchors[i] for i in mask]
-
-        # Reshape to N, height, width, num_anchors, box_params:
-        anchors_tensor = np.reshape(anchors, [1, 1, len(anchors), 2])
-        box_xy = sigmoid_v(output_reshaped[..., :2])
-        box_wh = exponential_v(output_reshaped[..., 2:4]) * anchors_tensor
-        box_confidence = sigmoid_v(output_reshaped[..., 4])
-
-        box_confidence = np.expand_dims(box_confidence, axis=-1)
-        box_class_probs = sigmoid_v(output_reshaped[..., 5:])
-
-        col = np.tile(np.arange(0, grid_w), grid_w).reshape(-1, grid_w)
-        row = np.tile(np.arange(0, grid_h).reshape(-1, 1), grid_h)
-
-        col = col.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-        row = row.reshape(grid_h, grid_w, 1, 1).repeat(3, axis=-2)
-        grid = np.concatenate((col, row), axis=-1)
+        _, num_channels, grid_h, grid_w = output_reshaped.shape
+        grid, anchors = self._get_grid_and_anchors(grid_h, grid_w, mask)
+
+        if numba is not None:
+            boxes = np.empty((grid_h, grid_w, len(mask), 4), dtype=np.float64)
+            box_confidence = np.empty((grid_h, grid_w, len(mask), 1), dtype=np.float64)
+            box_class_probs = np.empty((grid_h, grid_w, len(mask), num_channels - 5), dtype=np.float64)
+            _decode_feats_dense(
+                output_reshaped,
+                anchors.reshape(len(mask), 2),
+                float(self.input_resolution_yolo[0]),
+                float(self.input_resolution_yolo[1]),
+                boxes,
+                box_confidence,
+                box_class_probs,
+            )
+            return boxes, box_confidence, box_class_probs
+
+        # (3,C,height,width) to (height,width,3,C) views, nothing is copied here:
+        feats = np.transpose(output_reshaped, [2, 3, 0, 1])
+        box_xy = _sigmoid(feats[..., :2])
+        box_wh = np.exp(feats[..., 2:4], dtype=np.float64)
+        box_wh *= anchors
+        box_confidence = _sigmoid(feats[..., 4:5])
+        box_class_probs = _sigmoid(feats[..., 5:])
 
         box_xy += grid
         box_xy /= (grid_w, grid_h)
@@ -254,6 +599,81 @@ class PostprocessYOLO(object):
         # class confidence
         return boxes, box_confidence, box_class_probs
 
+    def _process_feats_sparse(self, output_reshaped, mask):
+        """Like _process_feats, but only for the cells whose objectness logit passes the
+        objectness gate. The boxes, confidences and class probabilities of those cells are
+        returned with shapes (K,4), (K,1) and (K,CATEGORY_NUM), in the same (row, col, anchor)
+        order the dense path produces them.
+        Keyword arguments:
+        output_reshaped -- reshaped YOLO output as NumPy arrays with shape (3,85,height,width)
+        mask -- 3-dimensional tuple with mask specification for this output
+        """
+        _, num_channels, grid_h, grid_w = output_reshaped.shape
+        grid, anchors = self._get_grid_and_anchors(grid_h, grid_w, mask)
+
+        # Objectness logits as a (height,width,3) view, thresholded before any exp is computed:
+        objectness = np.transpose(output_reshaped[:, 4], [1, 2, 0])
+        cells = np.argwhere(objectness >= self.objectness_logit_threshold)
+        num_cells = len(cells)
+
+        if numba is not None:
+            boxes = np.empty((num_cells, 4), dtype=np.float64)
+            box_confidence = np.empty((num_cells, 1), dtype=np.float64)
+            box_class_probs = np.empty((num_cells, num_channels - 5), dtype=np.float64)
+            _decode_feats_sparse(
+                output_reshaped,
+                anchors.reshape(len(mask), 2),
+                float(self.input_resolution_yolo[0]),
+                float(self.input_resolution_yolo[1]),
+                cells,
+                boxes,
+                box_confidence,
+                box_class_probs,
+            )
+            return boxes, box_confidence, box_class_probs
+
+        rows, cols, cell_anchors = cells[:, 0], cells[:, 1], cells[:, 2]
+        # (K,85) gather of the surviving cells only:
+        feats = output_reshaped[cell_anchors, :, rows, cols]
+        box_xy = _sigmoid(feats[:, :2])
+        box_wh = np.exp(feats[:, 2:4], dtype=np.float64)
+        box_wh *= anchors[0, 0, cell_anchors]
+        box_confidence = _sigmoid(feats[:, 4:5])
+        box_class_probs = _sigmoid(feats[:, 5:])
+
+        box_xy += grid[rows, cols, cell_anchors]
+        box_xy /= (grid_w, grid_h)
+        box_wh /= self.input_resolution_yolo
+        box_xy -= box_wh / 2.0
+        boxes = np.concatenate((box_xy, box_wh), axis=-1)
+
+        return boxes, box_confidence, box_class_probs
+
+    def _get_grid_and_anchors(self, grid_h, grid_w, mask):
+        """Return the cell offsets grid with shape (height,width,3,2) and the anchors
+        tensor with shape (1,1,3,2) for an output, computed once per (grid_h, grid_w, mask).
+        Keyword arguments:
+        grid_h, grid_w -- spatial dimensions of the output
+        mask -- 3-dimensional tuple with mask specification for this output
+        """
+        key = (grid_h, grid_w, tuple(mask))
+        cached = self._grid_cache.get(key)
+        if cached is None:
+            anchors = [self.anchors[i] for i in mask]
+            # Reshape to N, height, width, num_anchors, box_params:
+            anchors_tensor = np.reshape(np.array(anchors, dtype=np.float64), [1, 1, len(anchors), 2])
+
+            col = np.tile(np.arange(0, grid_w), grid_h).reshape(grid_h, grid_w)
+            row = np.tile(np.arange(0, grid_h).reshape(-1, 1), grid_w)
+
+            col = col.reshape(grid_h, grid_w, 1, 1).repeat(len(mask), axis=-2)
+            row = row.reshape(grid_h, grid_w, 1, 1).repeat(len(mask), axis=-2)
+            grid = np.concatenate((col, row), axis=-1).astype(np.float64)
+
+            cached = (grid, anchors_tensor)
+            self._grid_cache[key] = cached
+        return cached
+
     def _filter_boxes(self, boxes, box_confidences, box_class_probs):
         """Take in the unfiltered bounding box descriptors and discard each cell
         whose score is lower than the object threshold set during class initialization.
@@ -263,6 +683,7 @@ class PostprocessYOLO(object):
         box_confidences -- bounding box confidences with shape (height,width,3,1); 1 for as
         confidence scalar per element
         box_class_probs -- class probabilities with shape (height,width,3,CATEGORY_NUM)
+        (in sparse decode mode the leading (height,width,3) dimensions are a single K dimension)
         """
         box_scores = box_confidences * box_class_probs
         box_classes = np.argmax(box_scores, axis=-1)
@@ -279,6 +700,8 @@ class PostprocessYOLO(object):
         """Apply the Non-Maximum Suppression (NMS) algorithm on the bounding boxes with their
         confidence scores and return an array with the indexes of the bounding boxes we want to
         keep (and display later).
+        This is the original per category implementation, _process_yolo_output uses the nms
+        module instead; it is kept as the reference for nms_benchmark.py.
         Keyword arguments:
         boxes -- a NumPy array containing N bounding-box coordinates that survived filtering,
         with shape (N,4); 4 for x,y,height,width coordinates of the boxes
@@ -317,4 +740,4 @@ class PostprocessYOLO(object):
             ordered = ordered[indexes + 1]
 
         keep = np.array(keep)
-        return 
\ No newline at end of file
+        return keep
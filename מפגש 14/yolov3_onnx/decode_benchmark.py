@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compare full and reduced scale (draft) JPEG decoding in PreprocessYOLO: preprocessing time,
+decoded pixels, input tensor differences and, given the ONNX model, detection agreement."""
+
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from data_processing import PreprocessYOLO, PostprocessYOLO
+
+
+def synthetic_corpus(directory, num_images, size=(4032, 3024), seed=0):
+    """Write num_images smooth random JPEG images of the given (width, height) to directory
+    and return their paths."""
+    rng = np.random.default_rng(seed)
+    paths = list()
+    for index in range(num_images):
+        low = rng.integers(0, 256, size=(size[1] // 64, size[0] // 64, 3), dtype=np.uint8)
+        image = Image.fromarray(low).resize(size, resample=Image.BICUBIC)
+        path = os.path.join(directory, "synthetic_%d.jpg" % index)
+        image.save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def preprocess_all(preprocessor, paths):
+    """Preprocess every image one by one, return the raw images, the tensors and the wall time."""
+    images_raw, tensors = list(), list()
+    start = time.perf_counter()
+    for path in paths:
+        image_raw, tensor = preprocessor.process(path)
+        images_raw.append(image_raw)
+        tensors.append(tensor)
+    return images_raw, tensors, time.perf_counter() - start
+
+
+def detect(session, postprocessor, tensor, image_raw):
+    """Run the ONNX model and return the boxes (normalized by the image size) and categories."""
+    outputs = session.run(None, {session.get_inputs()[0].name: tensor})
+    boxes, categories, _ = postprocessor.process(outputs, image_raw.size)
+    if boxes is None:
+        return np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+    width, height = image_raw.size
+    return boxes / [width, height, width, height], categories
+
+
+def matched_fraction(reference_boxes, reference_categories, boxes, categories, iou_threshold=0.5):
+    """Return the fraction of the reference detections with a same category detection of IoU >= iou_threshold."""
+    if len(reference_boxes) == 0:
+        return 1.0
+    matched = 0
+    for box, category in zip(reference_boxes, reference_categories):
+        same = boxes[categories == category]
+        if len(same) == 0:
+            continue
+        x1 = np.maximum(box[0], same[:, 0])
+        y1 = np.maximum(box[1], same[:, 1])
+        x2 = np.minimum(box[0] + box[2], same[:, 0] + same[:, 2])
+        y2 = np.minimum(box[1] + box[3], same[:, 1] + same[:, 3])
+        intersection = np.maximum(0.0, x2 - x1) * np.maximum(0.0, y2 - y1)
+        iou = intersection / (box[2] * box[3] + same[:, 2] * same[:, 3] - intersection)
+        matched += int(iou.max() >= iou_threshold)
+    return matched / len(reference_boxes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("images", nargs="*", help="image files or directories (default: a synthetic 12 MP corpus)")
+    parser.add_argument("--synthetic", type=int, default=8, help="number of synthetic images when no images are given")
+    parser.add_argument("--onnx", help="yolov3.onnx, to compare the detections of both decodes")
+    args = parser.parse_args()
+
+    paths = list()
+    for entry in args.images:
+        paths.extend(sorted(glob.glob(os.path.join(entry, "*"))) if os.path.isdir(entry) else [entry])
+    temporary = None
+    if not paths:
+        temporary = tempfile.TemporaryDirectory()
+        paths = synthetic_corpus(temporary.name, args.synthetic)
+
+    input_resolution_yolov3_HW = (608, 608)
+    full = PreprocessYOLO(input_resolution_yolov3_HW, draft=False)
+    draft = PreprocessYOLO(input_resolution_yolov3_HW, draft=True)
+    # Warm up the file cache:
+    preprocess_all(full, paths)
+    full.decode_stats = dict.fromkeys(full.decode_stats, 0)
+
+    full_raw, full_tensors, full_time = preprocess_all(full, paths)
+    draft_raw, draft_tensors, draft_time = preprocess_all(draft, paths)
+
+    print("images: %d, drafted: %d" % (len(paths), draft.decode_stats["drafted"]))
+    print(
+        "decode time: full %.1f ms, draft %.1f ms, saved %.1f ms per image"
+        % tuple(
+            value * 1e3 / len(paths)
+            for value in (
+                full.decode_stats["decode_time"],
+                draft.decode_stats["decode_time"],
+                full.decode_stats["decode_time"] - draft.decode_stats["decode_time"],
+            )
+        )
+    )
+    print("preprocessing time: full %.1f ms, draft %.1f ms per image" % (full_time * 1e3 / len(paths), draft_time * 1e3 / len(paths)))
+    print("decoded pixels: %.1f%% of the source" % (100.0 * draft.decode_stats["decoded_pixels"] / draft.decode_stats["source_pixels"]))
+    differences = [np.abs(a - b) for a, b in zip(full_tensors, draft_tensors)]
+    print("input tensor difference: mean %.4f, max %.4f" % (np.mean([d.mean() for d in differences]), max(d.max() for d in differences)))
+
+    if args.onnx:
+        import onnxruntime
+
+        session = onnxruntime.InferenceSession(args.onnx, providers=["CPUExecutionProvider"])
+        postprocessor = PostprocessYOLO(
+            yolo_masks=[(6, 7, 8), (3, 4, 5), (0, 1, 2)],
+            yolo_anchors=[(10, 13), (16, 30), (33, 23), (30, 61), (62, 45), (59, 119), (116, 90), (156, 198), (373, 326)],
+            obj_threshold=0.6,
+            nms_threshold=0.5,
+            yolo_input_resolution=input_resolution_yolov3_HW,
+            decode_mode="sparse",
+        )
+        agreement = list()
+        for full_image, full_tensor, draft_image, draft_tensor in zip(full_raw, full_tensors, draft_raw, draft_tensors):
+            reference = detect(session, postprocessor, full_tensor, full_image)
+            drafted = detect(session, postprocessor, draft_tensor, draft_image)
+            agreement.append(min(matched_fraction(*(reference + drafted)), matched_fraction(*(drafted + reference))))
+        print("detection agreement (IoU >= 0.5, same category): %.1f%%" % (100.0 * np.mean(agreement)))
+
+    if temporary is not None:
+        temporary.cleanup()
+
+
+if __name__ == "__main__":
+    main()
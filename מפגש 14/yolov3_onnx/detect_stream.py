@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Pipelined YOLOv3 detection over a video file or a directory of frames.
+
+The decode, preprocess, infer, postprocess and annotate/encode stages run concurrently,
+connected by bounded queues: a slow stage blocks the ones before it instead of letting
+frames pile up in memory. Inference runs in the calling thread (a CUDA context is bound
+to the thread that created it), every other stage in its own thread.
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+from PIL import Image
+
+from data_processing import PreprocessYOLO, PostprocessYOLO, ALL_CATEGORIES, draw_bboxes
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp")
+VIDEO_EXTENSIONS = (".mp4", ".avi", ".mov", ".mkv")
+
+# End of stream marker passed through the queues:
+_END = object()
+
+
+def iterate_frames(source, max_frames=0):
+    """Yield the frames of a video file (requires OpenCV) or of a directory of images,
+    as RGB PIL Images.
+    Keyword arguments:
+    source -- path of a video file or of a directory of images (read in name order)
+    max_frames -- stop after this many frames (0 for all)
+    """
+    num_frames = 0
+    if os.path.isdir(source):
+        names = sorted(name for name in os.listdir(source) if name.lower().endswith(IMAGE_EXTENSIONS))
+        for name in names:
+            if max_frames and num_frames >= max_frames:
+                return
+            with Image.open(os.path.join(source, name)) as image:
+                yield image.convert("RGB")
+            num_frames += 1
+        return
+
+    if cv2 is None:
+        raise RuntimeError("Reading {} requires OpenCV (pip install opencv-python)".format(source))
+    capture = cv2.VideoCapture(source)
+    try:
+        while not max_frames or num_frames < max_frames:
+            success, frame = capture.read()
+            if not success:
+                return
+            yield Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+            num_frames += 1
+    finally:
+        capture.release()
+
+
+class FrameWriter(object):
+    """Encode the annotated frames into a directory of JPEG images, or into a video file
+    (requires OpenCV) when the output path has a video extension."""
+
+    def __init__(self, output_path, fps=30.0):
+        self.output_path = output_path
+        self.fps = fps
+        self._video = None
+        if not output_path.lower().endswith(VIDEO_EXTENSIONS):
+            os.makedirs(output_path, exist_ok=True)
+        elif cv2 is None:
+            raise RuntimeError("Writing {} requires OpenCV (pip install opencv-python)".format(output_path))
+
+    def write(self, index, image):
+        if not self.output_path.lower().endswith(VIDEO_EXTENSIONS):
+            image.save(os.path.join(self.output_path, "frame_{:06d}.jpg".format(index)), quality=90)
+            return
+        if self._video is None:
+            fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+            self._video = cv2.VideoWriter(self.output_path, fourcc, self.fps, image.size)
+        self._video.write(cv2.cvtColor(np.asarray(image), cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        if self._video is not None:
+            self._video.release()
+            self._video = None
+
+
+class OnnxRuntimeBackend(object):
+    """CPU inference backend running the YOLOv3 ONNX model with ONNX Runtime."""
+
+    def __init__(self, onnx_file_path, num_threads=0):
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(onnx_file_path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def infer(self, image):
+        """Return the three YOLO outputs for a (1,3,height,width) input, in NCHW format."""
+        return self.session.run(None, {self.input_name: image})
+
+    def close(self):
+        self.session = None
+
+
+class TensorRTBackend(object):
+    """TensorRT inference backend, built or loaded with onnx_to_tensorrt.get_engine.
+    Must be created and used from the same thread (the one holding the CUDA context)."""
+
+    def __init__(self, onnx_file_path, engine_file_path, input_resolution_HW=(608, 608)):
+        # Imported here so that the CPU backend does not require TensorRT and PyCUDA:
+        import common
+        from onnx_to_tensorrt import get_engine
+
+        self._common = common
+        self.engine = get_engine(onnx_file_path, engine_file_path)
+        self.context = self.engine.create_execution_context()
+        self.inputs, self.outputs, self.bindings, self.stream = common.allocate_buffers(self.engine)
+        height, width = input_resolution_HW
+        self.output_shapes = [(1, 255, height // stride, width // stride) for stride in (32, 16, 8)]
+
+    def infer(self, image):
+        """Return the three YOLO outputs for a (1,3,height,width) input, in NCHW format."""
+        self.inputs[0].host = image
+        trt_outputs = self._common.do_inference_v2(
+            self.context, bindings=self.bindings, inputs=self.inputs, outputs=self.outputs, stream=self.stream
+        )
+        # The host buffers are reused by the next inference, so the outputs are copied:
+        return [output.reshape(shape).copy() for output, shape in zip(trt_outputs, self.output_shapes)]
+
+    def close(self):
+        del self.context
+        del self.engine
+
+
+class StageStats(object):
+    """Per stage counters: processed frames, processing latencies and the time spent
+    blocked on the input (starved) and output (backpressure) queues."""
+
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.latencies = list()
+        self.input_wait = 0.0
+        self.output_wait = 0.0
+        self.first_start = None
+        self.last_end = None
+
+    def record(self, start, end):
+        if self.first_start is None:
+            self.first_start = start
+        self.last_end = end
+        self.frames += 1
+        self.latencies.append(end - start)
+
+    def summary(self):
+        elapsed = (self.last_end - self.first_start) if self.frames else 0.0
+        latencies_ms = np.array(self.latencies) * 1e3
+        return {
+            "stage": self.name,
+            "frames": self.frames,
+            "fps": self.frames / elapsed if elapsed > 0 else 0.0,
+            "mean_ms": float(latencies_ms.mean()) if self.frames else 0.0,
+            "p50_ms": float(np.percentile(latencies_ms, 50)) if self.frames else 0.0,
+            "p99_ms": float(np.percentile(latencies_ms, 99)) if self.frames else 0.0,
+            "input_wait_ms": self.input_wait * 1e3,
+            "output_wait_ms": self.output_wait * 1e3,
+        }
+
+
+class DetectionStream(object):
+    """The pipelined decode -> preprocess -> infer -> postprocess -> annotate/encode detector."""
+
+    def __init__(self, backend, preprocessor, postprocessor, queue_size=4, all_categories=ALL_CATEGORIES):
+        """Keyword arguments:
+        backend -- an object with an infer(image) method returning the three YOLO outputs
+        preprocessor -- a PreprocessYOLO
+        postprocessor -- a PostprocessYOLO
+        queue_size -- capacity of every queue between two stages
+        all_categories -- the category names, for the annotations
+        """
+        self.backend = backend
+        self.preprocessor = preprocessor
+        self.postprocessor = postprocessor
+        self.queue_size = queue_size
+        self.all_categories = all_categories
+
+    def run(self, frames, writer=None):
+        """Run the detection over frames, an iterable of RGB PIL Images, encoding the annotated
+        frames with writer (e.g. a FrameWriter) when given.
+        Return a report with the per stage statistics, the end to end latencies and the throughput.
+        """
+        names = ["decode", "preprocess", "infer", "postprocess", "annotate"]
+        stats = [StageStats(name) for name in names]
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(names) - 1)]
+        stop = threading.Event()
+        errors = list()
+        end_to_end = list()
+
+        def put(stage, item):
+            start = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    queues[stage].put(item, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+            stats[stage].output_wait += time.perf_counter() - start
+
+        def get(stage):
+            start = time.perf_counter()
+            while not stop.is_set():
+                try:
+                    item = queues[stage - 1].get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    continue
+            else:
+                item = _END
+            stats[stage].input_wait += time.perf_counter() - start
+            return item
+
+        def decode():
+            iterator = iter(frames)
+            index = 0
+            while not stop.is_set():
+                start = time.perf_counter()
+                frame = next(iterator, _END)
+                if frame is _END:
+                    break
+                end = time.perf_counter()
+                stats[0].record(start, end)
+                put(0, (index, start, frame))
+                index += 1
+
+        def preprocess(item):
+            index, created, frame = item
+            return index, created, frame, self.preprocessor.process_frame(frame)
+
+        def infer(item):
+            index, created, frame, image = item
+            return index, created, frame, self.backend.infer(image)
+
+        def postprocess(item):
+            index, created, frame, outputs = item
+            return (index, created, frame) + tuple(self.postprocessor.process(outputs, frame.size))
+
+        def annotate(item):
+            index, created, frame, boxes, categories, confidences = item
+            if boxes is not None:
+                frame = draw_bboxes(frame, boxes, confidences, categories, self.all_categories, verbose=False)
+            if writer is not None:
+                writer.write(index, frame)
+            end_to_end.append(time.perf_counter() - created)
+            return None
+
+        def worker(stage, function):
+            while True:
+                item = get(stage)
+                if item is _END:
+                    break
+                start = time.perf_counter()
+                result = function(item)
+                stats[stage].record(start, time.perf_counter())
+                if stage < len(queues):
+                    put(stage, result)
+
+        def guarded(stage, function):
+            try:
+                function()
+            except BaseException as error:
+                errors.append(error)
+                stop.set()
+            finally:
+                if stage < len(queues):
+                    put(stage, _END)
+
+        stage_functions = [None, preprocess, infer, postprocess, annotate]
+        threads = [threading.Thread(target=guarded, args=(0, decode), name="decode", daemon=True)]
+        for stage in (1, 3, 4):
+            target = lambda stage=stage: worker(stage, stage_functions[stage])
+            threads.append(threading.Thread(target=guarded, args=(stage, target), name=names[stage], daemon=True))
+
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        # Inference runs in this thread:
+        guarded(2, lambda: worker(2, infer))
+        for thread in threads:
+            thread.join()
+        total_time = time.perf_counter() - start
+        if errors:
+            raise errors[0]
+
+        latencies_ms = np.array(end_to_end) * 1e3
+        return {
+            "frames": len(end_to_end),
+            "time": total_time,
+            "fps": len(end_to_end) / total_time if total_time > 0 else 0.0,
+            "latency_mean_ms": float(latencies_ms.mean()) if len(end_to_end) else 0.0,
+            "latency_p99_ms": float(np.percentile(latencies_ms, 99)) if len(end_to_end) else 0.0,
+            "stages": [stage_stats.summary() for stage_stats in stats],
+        }
+
+
+def print_report(report):
+    """Print the per stage and end to end statistics of DetectionStream.run."""
+    print(
+        "%-12s %7s %8s %9s %9s %9s %14s %15s"
+        % ("stage", "frames", "fps", "mean ms", "p50 ms", "p99 ms", "input wait ms", "output wait ms")
+    )
+    for stage in report["stages"]:
+        print(
+            "%-12s %7d %8.1f %9.2f %9.2f %9.2f %14.1f %15.1f"
+            % (
+                stage["stage"],
+                stage["frames"],
+                stage["fps"],
+                stage["mean_ms"],
+                stage["p50_ms"],
+                stage["p99_ms"],
+                stage["input_wait_ms"],
+                stage["output_wait_ms"],
+            )
+        )
+    print(
+        "end to end: %d frames in %.2f s, %.1f FPS, latency mean %.1f ms, p99 %.1f ms"
+        % (report["frames"], report["time"], report["fps"], report["latency_mean_ms"], report["latency_p99_ms"])
+    )
+
+
+def get_postprocessor(input_resolution_yolov3_HW):
+    """Return the PostprocessYOLO for YOLOv3-608 with the sample thresholds."""
+    return PostprocessYOLO(
+        yolo_masks=[(6, 7, 8), (3, 4, 5), (0, 1, 2)],
+        yolo_anchors=[(10, 13), (16, 30), (33, 23), (30, 61), (62, 45), (59, 119), (116, 90), (156, 198), (373, 326)],
+        obj_threshold=0.6,
+        nms_threshold=0.5,
+        yolo_input_resolution=input_resolution_yolov3_HW,
+        decode_mode="sparse",
+    )
+
+
+def run_stream(backend, source, output_path=None, queue_size=4, max_frames=0, input_resolution_yolov3_HW=(608, 608)):
+    """Run a DetectionStream with backend over source, print and return its report."""
+    preprocessor = PreprocessYOLO(input_resolution_yolov3_HW)
+    postprocessor = get_postprocessor(input_resolution_yolov3_HW)
+    writer = FrameWriter(output_path) if output_path else None
+    stream = DetectionStream(backend, preprocessor, postprocessor, queue_size)
+    try:
+        report = stream.run(iterate_frames(source, max_frames), writer)
+    finally:
+        if writer is not None:
+            writer.close()
+    print_report(report)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", help="video file or directory of frames")
+    parser.add_argument("--output", help="directory (or video file) for the annotated frames")
+    parser.add_argument("--backend", choices=["onnxruntime", "tensorrt"], default="onnxruntime")
+    parser.add_argument("--onnx", default="yolov3.onnx", help="ONNX model, see yolov3_to_onnx.py")
+    parser.add_argument("--engine", default="yolov3.trt", help="serialized TensorRT engine")
+    parser.add_argument("--threads", type=int, default=0, help="ONNX Runtime intra op threads (0 for default)")
+    parser.add_argument("--queue-size", type=int, default=4)
+    parser.add_argument("--max-frames", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.backend == "tensorrt":
+        backend = TensorRTBackend(args.onnx, args.engine)
+    else:
+        backend = OnnxRuntimeBackend(args.onnx, args.threads)
+    try:
+        run_stream(backend, args.source, args.output, args.queue_size, args.max_frames)
+    finally:
+        backend.close()
+
+
+if __name__ == "__main__":
+    main()
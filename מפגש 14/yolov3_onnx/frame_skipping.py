@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Adaptive frame skipping for YOLOv3 on video: the detector only runs when a cheap change
+signal says the frame differs enough from the last detected one (or after max_skip frames);
+in between, the boxes are carried forward by an IoU/velocity tracker."""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from data_processing import PreprocessYOLO
+
+
+def gray_signature(image, size=(64, 36)):
+    """Return a downsampled grayscale version of a PIL Image as a float32 array in [0, 1]."""
+    return np.asarray(image.convert("L").resize(size, resample=Image.BILINEAR), dtype=np.float32) / 255.0
+
+
+def color_histogram(image, num_bins=20):
+    """Return the (3,num_bins) per channel histogram of a PIL Image, normalized to sum 1 per
+    channel. The binning is the one of the cv_histogram CUDA kernel: a value v falls into
+    bin int(v / (255 / num_bins)), and 255 (bin num_bins) is not counted."""
+    pixels = np.asarray(image.convert("RGB")).reshape(-1, 3)
+    bins = (pixels / np.float32(255.0 / num_bins)).astype(np.int32)
+    histogram = np.empty((3, num_bins), dtype=np.float64)
+    for channel in range(3):
+        counts = np.bincount(bins[:, channel], minlength=num_bins + 1)[:num_bins]
+        histogram[channel] = counts / max(counts.sum(), 1)
+    return histogram
+
+
+class ChangeDetector(object):
+    """Decide whether a frame differs enough from the reference (last detected) frame."""
+
+    def __init__(self, signal="gray", threshold=0.03):
+        """Keyword arguments:
+        signal -- 'gray' for the mean absolute difference of downsampled grayscale frames,
+        'histogram' for the L1 distance of the color histograms (halved, so both are in [0, 1])
+        threshold -- a frame whose distance to the reference exceeds this is a change
+        """
+        assert signal in ["gray", "histogram"]
+        self.signal = signal
+        self.threshold = threshold
+        self.reference = None
+        self.last_distance = 0.0
+
+    def signature(self, image):
+        if self.signal == "gray":
+            return gray_signature(image)
+        # The histogram of a box filtered thumbnail (longest side >= 160) is close enough:
+        return color_histogram(image.reduce(max(1, max(image.size) // 160)))
+
+    def distance(self, signature):
+        if self.signal == "gray":
+            return float(np.mean(np.abs(signature - self.reference)))
+        return float(np.abs(signature - self.reference).sum(axis=1).mean() / 2.0)
+
+    def changed(self, image):
+        """Return (changed, signature) for a frame; the caller sets the reference with
+        set_reference when it runs the detector on the frame."""
+        signature = self.signature(image)
+        if self.reference is None:
+            return True, signature
+        self.last_distance = self.distance(signature)
+        return self.last_distance > self.threshold, signature
+
+    def set_reference(self, signature):
+        self.reference = signature
+
+
+def box_iou(box, boxes):
+    """Return the IoUs of an x,y,width,height box with (N,4) boxes."""
+    x1 = np.maximum(box[0], boxes[:, 0])
+    y1 = np.maximum(box[1], boxes[:, 1])
+    x2 = np.minimum(box[0] + box[2], boxes[:, 0] + boxes[:, 2])
+    y2 = np.minimum(box[1] + box[3], boxes[:, 1] + boxes[:, 3])
+    intersection = np.maximum(0.0, x2 - x1) * np.maximum(0.0, y2 - y1)
+    return intersection / np.maximum(box[2] * box[3] + boxes[:, 2] * boxes[:, 3] - intersection, 1e-9)
+
+
+def match_detections(boxes, categories, reference_boxes, reference_categories, iou_threshold=0.5):
+    """Greedily match detections (in their order) to same category reference detections.
+    Return the number of matched pairs."""
+    if len(boxes) == 0 or len(reference_boxes) == 0:
+        return 0
+    used = np.zeros(len(reference_boxes), dtype=bool)
+    matched = 0
+    for box, category in zip(boxes, categories):
+        iou = box_iou(box, reference_boxes)
+        iou[used | (reference_categories != category)] = -1.0
+        best = int(np.argmax(iou))
+        if iou[best] >= iou_threshold:
+            used[best] = True
+            matched += 1
+    return matched
+
+
+class IoUTracker(object):
+    """Carry the detections forward between detector runs: every track moves by its
+    (smoothed) per frame velocity, and the tracks are re-associated with the new detections
+    by IoU (same category) whenever the detector runs."""
+
+    def __init__(self, iou_threshold=0.3, smoothing=0.5):
+        """Keyword arguments:
+        iou_threshold -- minimum IoU to associate a detection with a predicted track
+        smoothing -- weight of the new velocity measurement in the velocity update
+        """
+        self.iou_threshold = iou_threshold
+        self.smoothing = smoothing
+        self.boxes = np.zeros((0, 4))
+        self.categories = np.zeros(0, dtype=np.int64)
+        self.confidences = np.zeros(0)
+        self.velocities = np.zeros((0, 2))
+        self.frames_since_update = 0
+
+    def predict(self):
+        """Advance the tracks by one frame, return their boxes, categories and confidences."""
+        self.frames_since_update += 1
+        self.boxes[:, :2] += self.velocities
+        return self.boxes.copy(), self.categories.copy(), self.confidences.copy()
+
+    def update(self, boxes, categories, confidences):
+        """Replace the tracks with new detections (on a detector frame, after predict()),
+        estimating the velocities from the associated tracks."""
+        if boxes is None:
+            boxes, categories, confidences = np.zeros((0, 4)), np.zeros(0, dtype=np.int64), np.zeros(0)
+        velocities = np.zeros((len(boxes), 2))
+        used = np.zeros(len(self.boxes), dtype=bool)
+        for index in np.argsort(-np.asarray(confidences)):
+            if len(self.boxes) == 0:
+                break
+            iou = box_iou(boxes[index], self.boxes)
+            iou[used | (self.categories != categories[index])] = -1.0
+            best = int(np.argmax(iou))
+            if iou[best] >= self.iou_threshold:
+                used[best] = True
+                # The predicted box already moved by the old velocity, the residual corrects it:
+                residual = (boxes[index, :2] - self.boxes[best, :2]) / max(self.frames_since_update, 1)
+                velocities[index] = self.velocities[best] + self.smoothing * residual
+        self.boxes = np.array(boxes, dtype=np.float64)
+        self.categories = np.asarray(categories)
+        self.confidences = np.asarray(confidences, dtype=np.float64)
+        self.velocities = velocities
+        self.frames_since_update = 0
+
+
+class AdaptiveDetector(object):
+    """Run the detector on a frame only when the scene changed, or max_skip frames passed,
+    and track the boxes in between."""
+
+    def __init__(self, detect, change_detector=None, tracker=None, max_skip=15):
+        """Keyword arguments:
+        detect -- function of a PIL Image returning (boxes, categories, confidences), like
+        PostprocessYOLO.process (boxes may be None when nothing is detected)
+        change_detector -- a ChangeDetector (default: grayscale difference)
+        tracker -- an IoUTracker
+        max_skip -- maximum consecutive frames without running the detector
+        """
+        self.detect = detect
+        self.change_detector = change_detector if change_detector is not None else ChangeDetector()
+        self.tracker = tracker if tracker is not None else IoUTracker()
+        self.max_skip = max_skip
+        self.frames = 0
+        self.detector_runs = 0
+        self._skipped = 0
+
+    def process(self, image):
+        """Return (boxes, categories, confidences, detected) for the next frame."""
+        self.frames += 1
+        changed, signature = self.change_detector.changed(image)
+        boxes, categories, confidences = self.tracker.predict()
+        if changed or self._skipped >= self.max_skip:
+            self.detector_runs += 1
+            self._skipped = 0
+            self.change_detector.set_reference(signature)
+            self.tracker.update(*self.detect(image))
+            boxes, categories, confidences = self.tracker.boxes, self.tracker.categories, self.tracker.confidences
+            return boxes.copy(), categories.copy(), confidences.copy(), True
+        self._skipped += 1
+        return boxes, categories, confidences, False
+
+    @property
+    def invocation_rate(self):
+        return self.detector_runs / max(self.frames, 1)
+
+
+def evaluate_frame_skipping(frames, detect, adaptive_detector, iou_threshold=0.5):
+    """Run the detector on every frame and the adaptive detector side by side, and return the
+    detector invocation rate, the times and the precision/recall/F1 of the adaptive boxes with
+    respect to the every frame detections (IoU >= iou_threshold, same category)."""
+    matched = num_adaptive = num_reference = 0
+    reference_time = adaptive_time = 0.0
+    for image in frames:
+        start = time.perf_counter()
+        reference_boxes, reference_categories, _ = detect(image)
+        reference_time += time.perf_counter() - start
+        if reference_boxes is None:
+            reference_boxes, reference_categories = np.zeros((0, 4)), np.zeros(0, dtype=np.int64)
+
+        start = time.perf_counter()
+        boxes, categories, confidences, _ = adaptive_detector.process(image)
+        adaptive_time += time.perf_counter() - start
+
+        order = np.argsort(-confidences)
+        matched += match_detections(boxes[order], categories[order], reference_boxes, np.asarray(reference_categories), iou_threshold)
+        num_adaptive += len(boxes)
+        num_reference += len(reference_boxes)
+
+    precision = matched / num_adaptive if num_adaptive else 1.0
+    recall = matched / num_reference if num_reference else 1.0
+    return {
+        "frames": adaptive_detector.frames,
+        "detector_runs": adaptive_detector.detector_runs,
+        "invocation_rate": adaptive_detector.invocation_rate,
+        "every_frame_time": reference_time,
+        "adaptive_time": adaptive_time,
+        "precision": precision,
+        "recall": recall,
+        "f1": 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0,
+    }
+
+
+def main():
+    # detect_stream is imported here, it pulls the video and inference backends:
+    from detect_stream import OnnxRuntimeBackend, get_postprocessor, iterate_frames
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("source", help="video file or directory of frames")
+    parser.add_argument("--onnx", default="yolov3.onnx", help="ONNX model, see yolov3_to_onnx.py")
+    parser.add_argument("--signal", choices=["gray", "histogram"], default="gray")
+    parser.add_argument("--threshold", type=float, default=0.03, help="change threshold of the signal")
+    parser.add_argument("--max-skip", type=int, default=15, help="maximum consecutive frames without detection")
+    parser.add_argument("--max-frames", type=int, default=0)
+    args = parser.parse_args()
+
+    input_resolution_yolov3_HW = (608, 608)
+    preprocessor = PreprocessYOLO(input_resolution_yolov3_HW)
+    postprocessor = get_postprocessor(input_resolution_yolov3_HW)
+    backend = OnnxRuntimeBackend(args.onnx)
+
+    def detect(image):
+        return postprocessor.process(backend.infer(preprocessor.process_frame(image)), image.size)
+
+    adaptive_detector = AdaptiveDetector(detect, ChangeDetector(args.signal, args.threshold), IoUTracker(), args.max_skip)
+    report = evaluate_frame_skipping(iterate_frames(args.source, args.max_frames), detect, adaptive_detector)
+    print(
+        "frames: %d, detector runs: %d (%.1f%%)"
+        % (report["frames"], report["detector_runs"], 100.0 * report["invocation_rate"])
+    )
+    print(
+        "time: every frame %.2f s, adaptive %.2f s (%.1fx)"
+        % (report["every_frame_time"], report["adaptive_time"], report["every_frame_time"] / max(report["adaptive_time"], 1e-9))
+    )
+    print(
+        "agreement with every frame detection: precision %.3f, recall %.3f, F1 %.3f"
+        % (report["precision"], report["recall"], report["f1"])
+    )
+
+
+if __name__ == "__main__":
+    main()
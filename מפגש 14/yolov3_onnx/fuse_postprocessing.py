@@ -0,0 +1,350 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Append the YOLOv3 post-processing (box decoding, score thresholding and NonMaxSuppression)
+to the ONNX model of yolov3_to_onnx.py, so that the runtime returns only the final detections
+instead of the three full-size feature maps, and compare both paths on ONNX Runtime."""
+
+from __future__ import print_function
+
+import argparse
+import copy
+import glob
+import os
+import time
+
+import numpy as np
+import onnx
+from onnx import helper
+from onnx import numpy_helper
+from onnx import TensorProto
+
+from data_processing import PreprocessYOLO, PostprocessYOLO
+
+YOLO_MASKS = [(6, 7, 8), (3, 4, 5), (0, 1, 2)]
+YOLO_ANCHORS = [(10, 13), (16, 30), (33, 23), (30, 61), (62, 45), (59, 119), (116, 90), (156, 198), (373, 326)]
+
+# The outputs of the fused model: S detections over the whole batch, with their image index
+# in the batch, category, confidence and x,y,width,height box normalized by the network input.
+DETECTION_OUTPUTS = ["detection_batch_indices", "detection_classes", "detection_scores", "detection_boxes"]
+
+
+class PostprocessGraphBuilder(object):
+    """Helper class collecting the nodes and initializers appended to the YOLOv3 graph."""
+
+    def __init__(self, prefix="postprocess"):
+        self.prefix = prefix
+        self.nodes = list()
+        self.initializer = list()
+        self._counter = 0
+
+    def constant(self, name, value):
+        """Add an initializer and return its name."""
+        name = "%s_%s" % (self.prefix, name)
+        self.initializer.append(numpy_helper.from_array(np.asarray(value), name))
+        return name
+
+    def node(self, op_type, inputs, num_outputs=1, **attributes):
+        """Add a node and return the name of its output (or the list of names of its outputs)."""
+        name = "%s_%03d_%s" % (self.prefix, self._counter, op_type)
+        self._counter += 1
+        outputs = [name] if num_outputs == 1 else ["%s_%d" % (name, index) for index in range(num_outputs)]
+        self.nodes.append(helper.make_node(op_type, inputs=inputs, outputs=outputs, name=name, **attributes))
+        return outputs[0] if num_outputs == 1 else outputs
+
+    def slice(self, tensor, start, end, axis=-1):
+        return self.node(
+            "Slice",
+            [
+                tensor,
+                self.constant("starts_%d" % self._counter, np.array([start], dtype=np.int64)),
+                self.constant("ends_%d" % self._counter, np.array([end], dtype=np.int64)),
+                self.constant("axes_%d" % self._counter, np.array([axis], dtype=np.int64)),
+            ],
+        )
+
+    def reshape(self, tensor, shape):
+        return self.node("Reshape", [tensor, self.constant("shape_%d" % self._counter, np.array(shape, dtype=np.int64))])
+
+
+def _decode_output(builder, output_name, grid_h, grid_w, anchors, input_h, input_w, num_classes):
+    """Append the decoding of one YOLO output (N,3*(5+num_classes),grid_h,grid_w) and return the
+    names of its top-left x,y,width,height boxes (N,K,4) and of its class scores (N,K,num_classes),
+    K = 3*grid_h*grid_w, in (anchor, row, col) order. The math is the one of
+    PostprocessYOLO._process_feats, in float32."""
+    num_anchors = len(anchors)
+    cells = grid_h * grid_w
+    # (N,3*85,H,W) to (N,3*H*W,85):
+    feats = builder.reshape(output_name, [0, num_anchors, 5 + num_classes, cells])
+    feats = builder.node("Transpose", [feats], perm=[0, 1, 3, 2])
+    feats = builder.reshape(feats, [0, num_anchors * cells, 5 + num_classes])
+
+    # The (col, row) offset and the anchor of every box, normalized by the grid and input sizes:
+    col, row = np.meshgrid(np.arange(grid_w), np.arange(grid_h))
+    grid = np.tile(np.stack([col.ravel(), row.ravel()], axis=-1), (num_anchors, 1))
+    anchors_tensor = np.repeat(np.array(anchors, dtype=np.float64), cells, axis=0)
+    grid_name = builder.constant("grid_%d" % grid_h, (grid / [grid_w, grid_h])[None].astype(np.float32))
+    anchors_name = builder.constant("anchors_%d" % grid_h, (anchors_tensor / [input_w, input_h])[None].astype(np.float32))
+    inverse_grid_name = builder.constant(
+        "inverse_grid_%d" % grid_h, np.array([1.0 / grid_w, 1.0 / grid_h], dtype=np.float32)
+    )
+
+    box_xy = builder.node("Sigmoid", [builder.slice(feats, 0, 2)])
+    box_xy = builder.node("Add", [builder.node("Mul", [box_xy, inverse_grid_name]), grid_name])
+    box_wh = builder.node("Mul", [builder.node("Exp", [builder.slice(feats, 2, 4)]), anchors_name])
+    half = builder.constant("half_%d" % grid_h, np.array(0.5, dtype=np.float32))
+    box_xy = builder.node("Sub", [box_xy, builder.node("Mul", [box_wh, half])])
+    boxes = builder.node("Concat", [box_xy, box_wh], axis=-1)
+
+    box_confidence = builder.node("Sigmoid", [builder.slice(feats, 4, 5)])
+    box_class_probs = builder.node("Sigmoid", [builder.slice(feats, 5, 5 + num_classes)])
+    scores = builder.node("Mul", [box_confidence, box_class_probs])
+    return boxes, scores
+
+
+def append_postprocessing(
+    model_def,
+    yolo_masks=YOLO_MASKS,
+    yolo_anchors=YOLO_ANCHORS,
+    obj_threshold=0.6,
+    nms_threshold=0.5,
+    max_detections_per_class=100,
+):
+    """Return a copy of a YOLOv3 ONNX model whose outputs are replaced by the decoded and
+    suppressed detections (DETECTION_OUTPUTS). Like PostprocessYOLO, every box only competes
+    for its highest scoring category, and the NMS is per category. The IoU of NonMaxSuppression
+    is the exact one, while PostprocessYOLO keeps the +1 pixel intersection of the sample, so
+    a few more overlapping boxes may survive. The spatial dimensions of the model must be
+    static, the batch dimension may be symbolic.
+    Keyword arguments:
+    model_def -- the ONNX ModelProto of yolov3_to_onnx.py (opset 11 or later)
+    yolo_masks -- the YOLO masks, one per output in the output order
+    yolo_anchors -- the YOLO anchors, in WH order
+    obj_threshold -- threshold of the box scores (objectness times class probability)
+    nms_threshold -- IoU threshold of the non-max suppression
+    max_detections_per_class -- maximum detections of each category per image
+    """
+    model_def = copy.deepcopy(model_def)
+    graph = model_def.graph
+    input_dims = graph.input[0].type.tensor_type.shape.dim
+    input_h, input_w = input_dims[2].dim_value, input_dims[3].dim_value
+    assert len(graph.output) == len(yolo_masks)
+
+    builder = PostprocessGraphBuilder()
+    boxes, scores = list(), list()
+    for output, mask in zip(graph.output, yolo_masks):
+        channels, grid_h, grid_w = [dim.dim_value for dim in output.type.tensor_type.shape.dim[1:]]
+        assert grid_h > 0 and grid_w > 0, "The spatial dimensions of the outputs must be static"
+        num_classes = channels // len(mask) - 5
+        output_boxes, output_scores = _decode_output(
+            builder, output.name, grid_h, grid_w, [yolo_anchors[i] for i in mask], input_h, input_w, num_classes
+        )
+        boxes.append(output_boxes)
+        scores.append(output_scores)
+    boxes = builder.node("Concat", boxes, axis=1)
+    scores = builder.node("Concat", scores, axis=1)
+
+    # Keep only the highest scoring category of every box (the first one on ties, like np.argmax):
+    best_class = builder.node("ArgMax", [scores], axis=-1, keepdims=1)
+    class_ids = builder.constant("class_ids", np.arange(num_classes, dtype=np.int64))
+    best_class_mask = builder.node("Cast", [builder.node("Equal", [best_class, class_ids])], to=TensorProto.FLOAT)
+    scores = builder.node("Mul", [scores, best_class_mask])
+    # NonMaxSuppression takes the scores in (N,classes,boxes) order and any two opposite corners:
+    scores = builder.node("Transpose", [scores], perm=[0, 2, 1])
+    corners = builder.node(
+        "Concat",
+        [builder.slice(boxes, 0, 2), builder.node("Add", [builder.slice(boxes, 0, 2), builder.slice(boxes, 2, 4)])],
+        axis=-1,
+    )
+    selected = builder.node(
+        "NonMaxSuppression",
+        [
+            corners,
+            scores,
+            builder.constant("max_output_boxes_per_class", np.array([max_detections_per_class], dtype=np.int64)),
+            builder.constant("iou_threshold", np.array([nms_threshold], dtype=np.float32)),
+            builder.constant("score_threshold", np.array([obj_threshold], dtype=np.float32)),
+        ],
+        center_point_box=0,
+    )
+
+    # selected holds (batch index, class, box index) rows:
+    batch_indices = builder.reshape(builder.slice(selected, 0, 1), [-1])
+    classes = builder.reshape(builder.slice(selected, 1, 2), [-1])
+    batch_and_box = builder.node("Concat", [builder.slice(selected, 0, 1), builder.slice(selected, 2, 3)], axis=-1)
+    detection_scores = builder.node("GatherND", [scores, selected])
+    detection_boxes = builder.node("GatherND", [boxes, batch_and_box])
+    for name, tensor in zip(DETECTION_OUTPUTS, [batch_indices, classes, detection_scores, detection_boxes]):
+        builder.nodes.append(helper.make_node("Identity", inputs=[tensor], outputs=[name], name=name))
+
+    graph.node.extend(builder.nodes)
+    graph.initializer.extend(builder.initializer)
+    del graph.output[:]
+    graph.output.extend(
+        [
+            helper.make_tensor_value_info(DETECTION_OUTPUTS[0], TensorProto.INT64, ["S"]),
+            helper.make_tensor_value_info(DETECTION_OUTPUTS[1], TensorProto.INT64, ["S"]),
+            helper.make_tensor_value_info(DETECTION_OUTPUTS[2], TensorProto.FLOAT, ["S"]),
+            helper.make_tensor_value_info(DETECTION_OUTPUTS[3], TensorProto.FLOAT, ["S", 4]),
+        ]
+    )
+    graph.name = graph.name + "-NMS"
+    return model_def
+
+
+def split_detections(outputs, resolutions_raw):
+    """Return the (boxes, categories, confidences) of every image of a batch from the outputs
+    of a fused model, with the boxes scaled to the original image sizes (WH order), like
+    PostprocessYOLO.process (None, None, None for an image without detections)."""
+    batch_indices, classes, scores, boxes = outputs
+    results = list()
+    for index, (width, height) in enumerate(resolutions_raw):
+        selected = batch_indices == index
+        if not selected.any():
+            results.append((None, None, None))
+            continue
+        image_scores = scores[selected].astype(np.float64)
+        # In descending score order, like the NMS of PostprocessYOLO:
+        order = np.argsort(-image_scores, kind="stable")
+        image_boxes = boxes[selected][order].astype(np.float64) * [width, height, width, height]
+        results.append((image_boxes, classes[selected][order], image_scores[order]))
+    return results
+
+
+def _match_fraction(reference, candidate, iou_threshold=0.5):
+    """Return the numbers of reference detections and of those with a same category candidate
+    detection of IoU >= iou_threshold."""
+    reference_boxes, reference_categories, _ = reference
+    boxes, categories, _ = candidate
+    if reference_boxes is None:
+        return 0, 0
+    if boxes is None:
+        return len(reference_boxes), 0
+    matched = 0
+    for box, category in zip(reference_boxes, reference_categories):
+        same = boxes[categories == category]
+        x1 = np.maximum(box[0], same[:, 0])
+        y1 = np.maximum(box[1], same[:, 1])
+        x2 = np.minimum(box[0] + box[2], same[:, 0] + same[:, 2])
+        y2 = np.minimum(box[1] + box[3], same[:, 1] + same[:, 3])
+        intersection = np.maximum(0.0, x2 - x1) * np.maximum(0.0, y2 - y1)
+        iou = intersection / (box[2] * box[3] + same[:, 2] * same[:, 3] - intersection)
+        matched += int(len(iou) > 0 and iou.max() >= iou_threshold)
+    return len(reference_boxes), matched
+
+
+def compare_paths(onnx_file_path, fused_onnx_file_path, image_paths, obj_threshold=0.6, nms_threshold=0.5, runs=1):
+    """Run the raw model followed by PostprocessYOLO and the fused model on ONNX Runtime CPU
+    on every image, and return the output bytes per image, the mean end-to-end latencies
+    (inference and post-processing) and the detection agreement of both paths."""
+    import onnxruntime
+
+    raw_session = onnxruntime.InferenceSession(onnx_file_path, providers=["CPUExecutionProvider"])
+    fused_session = onnxruntime.InferenceSession(fused_onnx_file_path, providers=["CPUExecutionProvider"])
+    input_dims = raw_session.get_inputs()[0].shape
+    input_resolution_HW = (input_dims[2], input_dims[3])
+    preprocessor = PreprocessYOLO(input_resolution_HW)
+    postprocessor = PostprocessYOLO(
+        yolo_masks=YOLO_MASKS,
+        yolo_anchors=YOLO_ANCHORS,
+        obj_threshold=obj_threshold,
+        nms_threshold=nms_threshold,
+        yolo_input_resolution=input_resolution_HW,
+        decode_mode="sparse",
+    )
+    input_name = raw_session.get_inputs()[0].name
+
+    raw_bytes = fused_bytes = 0
+    raw_latencies, fused_latencies = list(), list()
+    num_reference = num_matched = num_fused = 0
+    for image_path in image_paths:
+        image_raw, image = preprocessor.process(image_path)
+        for _ in range(runs):
+            start = time.perf_counter()
+            raw_outputs = raw_session.run(None, {input_name: image})
+            reference = postprocessor.process(raw_outputs, image_raw.size)
+            raw_latencies.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            fused_outputs = fused_session.run(None, {input_name: image})
+            detections = split_detections(fused_outputs, [image_raw.size])[0]
+            fused_latencies.append(time.perf_counter() - start)
+        raw_bytes += sum(output.nbytes for output in raw_outputs)
+        fused_bytes += sum(output.nbytes for output in fused_outputs)
+        total, matched = _match_fraction(reference, detections)
+        num_reference += total
+        num_matched += matched
+        num_fused += 0 if detections[0] is None else len(detections[0])
+
+    return {
+        "images": len(image_paths),
+        "raw_bytes": raw_bytes / len(image_paths),
+        "fused_bytes": fused_bytes / len(image_paths),
+        "raw_latency": float(np.mean(raw_latencies)),
+        "fused_latency": float(np.mean(fused_latencies)),
+        "reference_detections": num_reference,
+        "fused_detections": num_fused,
+        "matched": num_matched,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--onnx", default="yolov3.onnx", help="ONNX model, see yolov3_to_onnx.py")
+    parser.add_argument("--output", default="yolov3-nms.onnx", help="path of the fused ONNX model")
+    parser.add_argument("--obj-threshold", type=float, default=0.6)
+    parser.add_argument("--nms-threshold", type=float, default=0.5)
+    parser.add_argument("--max-detections", type=int, default=100, help="maximum detections per category and image")
+    parser.add_argument("--compare", nargs="*", help="images or directories to compare both paths on with ONNX Runtime")
+    parser.add_argument("--runs", type=int, default=3, help="timed runs per image of --compare")
+    args = parser.parse_args()
+
+    model_def = onnx.load(args.onnx)
+    fused_model_def = append_postprocessing(
+        model_def,
+        obj_threshold=args.obj_threshold,
+        nms_threshold=args.nms_threshold,
+        max_detections_per_class=args.max_detections,
+    )
+    onnx.checker.check_model(fused_model_def)
+    onnx.save(fused_model_def, args.output)
+    print("Saved {} with {} post-processing nodes".format(args.output, len(fused_model_def.graph.node) - len(model_def.graph.node)))
+
+    if args.compare is not None:
+        image_paths = list()
+        for entry in args.compare:
+            image_paths.extend(sorted(glob.glob(os.path.join(entry, "*"))) if os.path.isdir(entry) else [entry])
+        report = compare_paths(args.onnx, args.output, image_paths, args.obj_threshold, args.nms_threshold, args.runs)
+        print(
+            "output bytes per image: raw {:.0f}, fused {:.0f} ({:.0f}x less)".format(
+                report["raw_bytes"], report["fused_bytes"], report["raw_bytes"] / max(report["fused_bytes"], 1)
+            )
+        )
+        print(
+            "end-to-end latency: raw + PostprocessYOLO {:.1f} ms, fused {:.1f} ms".format(
+                report["raw_latency"] * 1e3, report["fused_latency"] * 1e3
+            )
+        )
+        print(
+            "detections: {} reference, {} fused, {} of the reference matched (IoU >= 0.5, same category)".format(
+                report["reference_detections"], report["fused_detections"], report["matched"]
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
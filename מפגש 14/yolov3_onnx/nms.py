@@ -0,0 +1,319 @@
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Non-Maximum Suppression (NMS) engine for the YOLOv3 post-processing.
+
+All functions take boxes in the x,y,width,height format used by PostprocessYOLO and
+compute the Intersection over Union exactly like PostprocessYOLO._nms_boxes does
+(intersection sides get +1, areas do not), keeping a box when its IoU with every
+higher scored kept box is <= iou_threshold.
+"""
+
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+# Above this number of candidates the hard NMS switches to the spatial grid kernel:
+GRID_NMS_MIN_BOXES = 256
+# Upper bound on the number of cells of the spatial grid:
+GRID_NMS_MAX_CELLS = 1 << 22
+
+
+def _iou(x1_i, y1_i, x2_i, y2_i, area_i, x1_j, y1_j, x2_j, y2_j, area_j):
+    """Return the IoU of two boxes given by their corners and areas."""
+    width = max(0.0, min(x2_i, x2_j) - max(x1_i, x1_j) + 1)
+    height = max(0.0, min(y2_i, y2_j) - max(y1_i, y1_j) + 1)
+    intersection = width * height
+    return intersection / (area_i + area_j - intersection)
+
+
+def _nms_bitmask(x1, y1, x2, y2, areas, order, iou_threshold, max_detections):
+    """Greedy NMS over the boxes in score order, with the suppressed set kept as a bitmask
+    of 64-bit words indexed by rank. Only the rows of kept boxes are ever computed.
+    Keyword arguments:
+    x1, y1, x2, y2, areas -- float64 arrays with the boxes corners and areas
+    order -- box indexes sorted by descending score
+    iou_threshold -- boxes with a larger IoU than this are suppressed
+    max_detections -- stop once this many boxes are kept
+    """
+    num_boxes = order.shape[0]
+    removed = np.zeros((num_boxes + 63) // 64, dtype=np.uint64)
+    keep = np.empty(min(num_boxes, max_detections), dtype=np.int64)
+    num_keep = 0
+    for rank_i in range(num_boxes):
+        if (removed[rank_i >> 6] >> np.uint64(rank_i & 63)) & np.uint64(1):
+            continue
+        i = order[rank_i]
+        keep[num_keep] = i
+        num_keep += 1
+        if num_keep >= max_detections:
+            break
+        for rank_j in range(rank_i + 1, num_boxes):
+            if (removed[rank_j >> 6] >> np.uint64(rank_j & 63)) & np.uint64(1):
+                continue
+            j = order[rank_j]
+            iou = _iou(x1[i], y1[i], x2[i], y2[i], areas[i], x1[j], y1[j], x2[j], y2[j], areas[j])
+            if iou > iou_threshold:
+                removed[rank_j >> 6] |= np.uint64(1) << np.uint64(rank_j & 63)
+    return keep[:num_keep]
+
+
+def _nms_grid(x1, y1, x2, y2, areas, order, iou_threshold, max_detections, cell_size, grid_w, grid_h):
+    """Greedy NMS where every kept box is only compared with the boxes of its own and the
+    8 neighbouring cells of a uniform grid. With a cell size larger than any box side (+1),
+    boxes further away can not overlap, so the result equals the full greedy NMS.
+    Keyword arguments:
+    x1, y1, x2, y2, areas -- float64 arrays with the boxes corners and areas
+    order -- box indexes sorted by descending score
+    iou_threshold -- boxes with a larger IoU than this are suppressed, must be >= 0
+    max_detections -- stop once this many boxes are kept
+    cell_size -- side of a grid cell
+    grid_w, grid_h -- grid dimensions in cells
+    """
+    num_boxes = order.shape[0]
+    origin_x = x1.min()
+    origin_y = y1.min()
+
+    # Bucket the boxes (by rank) into cells, in CSR form:
+    cell_of_rank = np.empty(num_boxes, dtype=np.int64)
+    cell_counts = np.zeros(grid_w * grid_h + 1, dtype=np.int64)
+    for rank in range(num_boxes):
+        i = order[rank]
+        cell_x = min(int((x1[i] - origin_x) / cell_size), grid_w - 1)
+        cell_y = min(int((y1[i] - origin_y) / cell_size), grid_h - 1)
+        cell = cell_y * grid_w + cell_x
+        cell_of_rank[rank] = cell
+        cell_counts[cell + 1] += 1
+    cell_start = np.cumsum(cell_counts)
+    cell_fill = cell_start[:-1].copy()
+    cell_ranks = np.empty(num_boxes, dtype=np.int64)
+    for rank in range(num_boxes):
+        cell = cell_of_rank[rank]
+        cell_ranks[cell_fill[cell]] = rank
+        cell_fill[cell] += 1
+
+    removed = np.zeros((num_boxes + 63) // 64, dtype=np.uint64)
+    keep = np.empty(min(num_boxes, max_detections), dtype=np.int64)
+    num_keep = 0
+    for rank_i in range(num_boxes):
+        if (removed[rank_i >> 6] >> np.uint64(rank_i & 63)) & np.uint64(1):
+            continue
+        i = order[rank_i]
+        keep[num_keep] = i
+        num_keep += 1
+        if num_keep >= max_detections:
+            break
+        cell_x = cell_of_rank[rank_i] % grid_w
+        cell_y = cell_of_rank[rank_i] // grid_w
+        for neighbour_y in range(max(0, cell_y - 1), min(grid_h, cell_y + 2)):
+            for neighbour_x in range(max(0, cell_x - 1), min(grid_w, cell_x + 2)):
+                cell = neighbour_y * grid_w + neighbour_x
+                for position in range(cell_start[cell], cell_start[cell + 1]):
+                    rank_j = cell_ranks[position]
+                    if rank_j <= rank_i:
+                        continue
+                    if (removed[rank_j >> 6] >> np.uint64(rank_j & 63)) & np.uint64(1):
+                        continue
+                    j = order[rank_j]
+                    iou = _iou(x1[i], y1[i], x2[i], y2[i], areas[i], x1[j], y1[j], x2[j], y2[j], areas[j])
+                    if iou > iou_threshold:
+                        removed[rank_j >> 6] |= np.uint64(1) << np.uint64(rank_j & 63)
+    return keep[:num_keep]
+
+
+def _soft_nms(x1, y1, x2, y2, areas, scores, iou_threshold, sigma, gaussian, score_threshold, max_detections):
+    """Soft-NMS (Bodla et al. 2017): instead of discarding the boxes overlapping a selected
+    box, decay their scores, linearly by (1 - IoU) above iou_threshold or with a Gaussian
+    exp(-IoU^2 / sigma), and drop them once below score_threshold.
+    Returns the selected indexes and their decayed scores, in selection order.
+    """
+    num_boxes = scores.shape[0]
+    current = scores.copy()
+    alive = np.ones(num_boxes, dtype=np.bool_)
+    keep = np.empty(min(num_boxes, max_detections), dtype=np.int64)
+    keep_scores = np.empty(min(num_boxes, max_detections), dtype=np.float64)
+    num_keep = 0
+    while num_keep < max_detections:
+        best = -1
+        best_score = -np.inf
+        for j in range(num_boxes):
+            if alive[j] and current[j] > best_score:
+                best = j
+                best_score = current[j]
+        if best < 0:
+            break
+        alive[best] = False
+        keep[num_keep] = best
+        keep_scores[num_keep] = best_score
+        num_keep += 1
+        for j in range(num_boxes):
+            if not alive[j]:
+                continue
+            iou = _iou(x1[best], y1[best], x2[best], y2[best], areas[best], x1[j], y1[j], x2[j], y2[j], areas[j])
+            if gaussian:
+                current[j] *= math.exp(-(iou * iou) / sigma)
+            elif iou > iou_threshold:
+                current[j] *= 1.0 - iou
+            if current[j] < score_threshold:
+                alive[j] = False
+    return keep[:num_keep], keep_scores[:num_keep]
+
+
+def _nms_numpy(x1, y1, x2, y2, areas, order, iou_threshold, max_detections):
+    """Vectorized NumPy greedy NMS, used when Numba is not available."""
+    keep = list()
+    while order.size > 0 and len(keep) < max_detections:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        width = np.maximum(0.0, np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]) + 1)
+        height = np.maximum(0.0, np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]) + 1)
+        intersection = width * height
+        iou = intersection / (areas[i] + areas[rest] - intersection)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+if numba is not None:
+    _iou = numba.njit(cache=True, nogil=True, inline="always")(_iou)
+    _nms_bitmask = numba.njit(cache=True, nogil=True)(_nms_bitmask)
+    _nms_grid = numba.njit(cache=True, nogil=True)(_nms_grid)
+    _soft_nms = numba.njit(cache=True, nogil=True)(_soft_nms)
+
+
+def _corners(boxes):
+    """Split (N,4) x,y,width,height boxes into contiguous float64 corner and area arrays."""
+    boxes = np.asarray(boxes, dtype=np.float64)
+    x1 = np.ascontiguousarray(boxes[:, 0])
+    y1 = np.ascontiguousarray(boxes[:, 1])
+    width = boxes[:, 2]
+    height = boxes[:, 3]
+    return x1, y1, x1 + width, y1 + height, width * height
+
+
+def _grid_shape(x1, y1, x2, y2):
+    """Return (cell_size, grid_w, grid_h) for the spatial grid NMS, or None when the grid
+    would be too large to pay off."""
+    cell_size = max(float(np.max(x2 - x1)), float(np.max(y2 - y1))) + 1.0
+    grid_w = int((x1.max() - x1.min()) / cell_size) + 1
+    grid_h = int((y1.max() - y1.min()) / cell_size) + 1
+    if grid_w * grid_h > GRID_NMS_MAX_CELLS or grid_w * grid_h < 4:
+        return None
+    return cell_size, grid_w, grid_h
+
+
+def nms(boxes, scores, iou_threshold, max_detections=None, method="auto"):
+    """Apply greedy NMS to the boxes and return the indexes of the kept boxes, sorted by
+    descending score.
+    Keyword arguments:
+    boxes -- (N,4) array of x,y,width,height boxes
+    scores -- (N,) array of scores
+    iou_threshold -- boxes with a larger IoU with a higher scored kept box are suppressed
+    max_detections -- optional cap on the number of kept boxes
+    method -- 'bitmask', 'grid' (spatial pre-partition for very large candidate counts),
+    'numpy', or 'auto' to choose by the number of boxes
+    """
+    num_boxes = len(scores)
+    if max_detections is None:
+        max_detections = num_boxes
+    if num_boxes == 0 or max_detections <= 0:
+        return np.zeros(0, dtype=np.int64)
+
+    x1, y1, x2, y2, areas = _corners(boxes)
+    order = np.asarray(scores).argsort()[::-1].astype(np.int64)
+
+    if numba is None or method == "numpy":
+        return _nms_numpy(x1, y1, x2, y2, areas, order, iou_threshold, max_detections)
+
+    if method == "auto":
+        method = "grid" if num_boxes >= GRID_NMS_MIN_BOXES else "bitmask"
+    if method == "grid" and iou_threshold >= 0:
+        grid_shape = _grid_shape(x1, y1, x2, y2)
+        if grid_shape is not None:
+            cell_size, grid_w, grid_h = grid_shape
+            return _nms_grid(x1, y1, x2, y2, areas, order, iou_threshold, max_detections, cell_size, grid_w, grid_h)
+    return _nms_bitmask(x1, y1, x2, y2, areas, order, iou_threshold, max_detections)
+
+
+def _offset_boxes(boxes, classes):
+    """Shift the boxes of every class along x by a class dependent offset, so that boxes
+    of different classes can never overlap and one class agnostic NMS pass does the
+    work of one pass per class."""
+    boxes = np.array(boxes, dtype=np.float64)
+    if len(boxes) == 0:
+        return boxes
+    # The +2 keeps a gap wider than the +1 of the intersection sides:
+    span = (boxes[:, 0] + boxes[:, 2]).max() - boxes[:, 0].min() + 2.0
+    boxes[:, 0] += np.asarray(classes, dtype=np.float64) * span
+    return boxes
+
+
+def batched_nms(boxes, scores, classes, iou_threshold, max_detections=None, method="auto"):
+    """Class aware NMS in a single pass, using per class coordinate offsets.
+    Return the indexes of the kept boxes sorted by descending score.
+    Keyword arguments:
+    boxes -- (N,4) array of x,y,width,height boxes
+    scores -- (N,) array of scores
+    classes -- (N,) array of integer categories, only boxes of the same category suppress each other
+    iou_threshold -- IoU threshold for the suppression
+    max_detections -- optional cap on the number of kept boxes (over all classes)
+    method -- see nms()
+    """
+    return nms(_offset_boxes(boxes, classes), scores, iou_threshold, max_detections, method)
+
+
+def soft_nms(boxes, scores, iou_threshold=0.3, sigma=0.5, method="gaussian", score_threshold=0.001, max_detections=None, classes=None):
+    """Soft-NMS, return the selected indexes and their decayed scores, by descending decayed score.
+    Keyword arguments:
+    boxes -- (N,4) array of x,y,width,height boxes
+    scores -- (N,) array of scores
+    iou_threshold -- overlap above which the linear method decays the scores
+    sigma -- the Gaussian method decay parameter
+    method -- 'gaussian' or 'linear'
+    score_threshold -- boxes whose decayed score drops below this are discarded
+    max_detections -- optional cap on the number of selected boxes
+    classes -- optional (N,) array of categories, to decay only within the same category
+    """
+    assert method in ["gaussian", "linear"]
+    if numba is None:
+        raise RuntimeError("soft_nms requires Numba")
+    num_boxes = len(scores)
+    if max_detections is None:
+        max_detections = num_boxes
+    if num_boxes == 0 or max_detections <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+    if classes is not None:
+        boxes = _offset_boxes(boxes, classes)
+    x1, y1, x2, y2, areas = _corners(boxes)
+    return _soft_nms(
+        x1,
+        y1,
+        x2,
+        y2,
+        areas,
+        np.asarray(scores, dtype=np.float64),
+        iou_threshold,
+        sigma,
+        method == "gaussian",
+        score_threshold,
+        max_detections,
+    )
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Benchmark the nms module against the original per category PostprocessYOLO._nms_boxes loop
+on synthetic YOLO-like candidates, and check that both keep the same boxes."""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+
+import nms
+from data_processing import PostprocessYOLO
+
+
+def synthetic_candidates(num_boxes, num_categories=80, image_size=1920, seed=0):
+    """Return (boxes, scores, categories) of num_boxes candidates clustered around objects,
+    the way the YOLO heads produce several overlapping candidates per object.
+    Keyword arguments:
+    num_boxes -- number of candidate boxes
+    num_categories -- number of categories
+    image_size -- side of the square image the boxes lie in
+    seed -- random seed
+    """
+    rng = np.random.default_rng(seed)
+    num_objects = max(1, num_boxes // 8)
+    centers = rng.uniform(0, image_size, size=(num_objects, 2))
+    sizes = rng.uniform(10, 200, size=(num_objects, 2))
+    object_categories = rng.integers(0, num_categories, size=num_objects)
+
+    owner = rng.integers(0, num_objects, size=num_boxes)
+    jitter = rng.normal(0.0, 0.1, size=(num_boxes, 4))
+    width_height = sizes[owner] * np.exp(jitter[:, 2:])
+    x_y = centers[owner] + jitter[:, :2] * sizes[owner] - width_height / 2
+    boxes = np.concatenate([x_y, width_height], axis=1)
+    scores = rng.uniform(0.6, 1.0, size=num_boxes)
+    # Some candidates are misclassified:
+    categories = np.where(rng.uniform(size=num_boxes) < 0.1, rng.integers(0, num_categories, size=num_boxes), object_categories[owner])
+    return boxes, scores, categories
+
+
+def legacy_nms(postprocessor, boxes, scores, categories):
+    """Return the indexes kept by the original per category loop."""
+    keep = list()
+    for category in set(categories):
+        idxs = np.where(categories == category)[0]
+        keep.append(idxs[postprocessor._nms_boxes(boxes[idxs], scores[idxs])])
+    return np.concatenate(keep)
+
+
+def best_time(function, repeats):
+    """Return the result of function and its best wall time over repeats runs, in seconds."""
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000, 100000], help="candidate counts to benchmark")
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    parser.add_argument("--legacy-max", type=int, default=20000, help="skip the (quadratic) legacy loop above this count")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    postprocessor = PostprocessYOLO(None, None, 0.6, args.iou_threshold, (608, 608))
+    methods = ["bitmask", "grid"] if nms.numba is not None else ["numpy"]
+
+    # Compile the Numba kernels before timing:
+    warmup_boxes, warmup_scores, warmup_categories = synthetic_candidates(100)
+    for method in methods:
+        nms.batched_nms(warmup_boxes, warmup_scores, warmup_categories, args.iou_threshold, method=method)
+
+    print("%10s %12s" % ("boxes", "legacy ms") + "".join("%12s" % (method + " ms") for method in methods) + " %8s %6s" % ("kept", "equal"))
+    for num_boxes in args.sizes:
+        boxes, scores, categories = synthetic_candidates(num_boxes)
+        line = "%10d" % num_boxes
+        reference = None
+        if num_boxes <= args.legacy_max:
+            reference, legacy_time = best_time(lambda: legacy_nms(postprocessor, boxes, scores, categories), args.repeats)
+            line += " %12.2f" % (legacy_time * 1e3)
+        else:
+            line += " %12s" % "skipped"
+
+        equal = True
+        for method in methods:
+            keep, method_time = best_time(
+                lambda: nms.batched_nms(boxes, scores, categories, args.iou_threshold, method=method), args.repeats
+            )
+            line += "%12.2f" % (method_time * 1e3)
+            if reference is not None:
+                equal = equal and np.array_equal(np.sort(keep), np.sort(reference))
+        line += " %8d %6s" % (len(keep), equal if reference is not None else "-")
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -18,13 +18,14 @@
 
 from __future__ import print_function
 
+import argparse
+
 import numpy as np
 import tensorrt as trt
 import pycuda.driver as cuda
 import pycuda.autoinit
-from PIL import ImageDraw
 
-from data_processing import PreprocessYOLO, PostprocessYOLO, ALL_CATEGORIES
+from data_processing import PreprocessYOLO, PostprocessYOLO, ALL_CATEGORIES, draw_bboxes
 
 import sys, os
 
@@ -35,34 +36,6 @@ from downloader import getFilePath
 TRT_LOGGER = trt.Logger()
 
 
-def draw_bboxes(image_raw, bboxes, confidences, categories, all_categories, bbox_color="blue"):
-    """Draw the bounding boxes on the original input image and return it.
-    Keyword arguments:
-    image_raw -- a raw PIL Image
-    bboxes -- NumPy array containing the bounding box coordinates of N objects, with shape (N,4).
-    categories -- NumPy array containing the corresponding category for each object,
-    with shape (N,)
-    confidences -- NumPy array containing the corresponding confidence for each object,
-    with shape (N,)
-    all_categories -- a list of all categories in the correct ordered (required for looking up
-    the category name)
-    bbox_color -- an optional string specifying the color of the bounding boxes (default: 'blue')
-    """
-    draw = ImageDraw.Draw(image_raw)
-    print(bboxes, confidences, categories)
-    for box, score, category in zip(bboxes, confidences, categories):
-        x_coord, y_coord, width, height = box
-        left = max(0, np.floor(x_coord + 0.5).astype(int))
-        top = max(0, np.floor(y_coord + 0.5).astype(int))
-        right = min(image_raw.width, np.floor(x_coord + width + 0.5).astype(int))
-        bottom = min(image_raw.height, np.floor(y_coord + height + 0.5).astype(int))
-
-        draw.rectangle(((left, top), (right, bottom)), outline=bbox_color)
-        draw.text((left, top - 12), "{0} {1:.2f}".format(all_categories[category], score), fill=bbox_color)
-
-    return image_raw
-
-
 def get_engine(onnx_file_path, engine_file_path=""):
     """Attempts to load a serialized engine if available, otherwise builds a new TensorRT engine and saves it."""
 
@@ -91,8 +64,10 @@ def get_engine(onnx_file_path, engine_file_path=""):
                     for error in range(parser.num_errors):
                         print(parser.get_error(error))
                     return None
-            # The actual yolov3.onnx is generated with batch size 64. Reshape input to batch size 1
-            network.get_input(0).shape = [1, 3, 608, 608]
+            # yolov3.onnx is generated with the batch size 64 of the cfg file, and the models of
+            # yolov3_to_onnx.py --resolutions with a symbolic batch size. Reshape the input to
+            # batch size 1, keeping the resolution of the model:
+            network.get_input(0).shape = [1] + list(network.get_input(0).shape)[1:]
             print("Completed parsing of ONNX file")
             print("Building an engine from file {}; this may take a while...".format(onnx_file_path))
             plan = builder.build_serialized_network(network, config)
@@ -114,9 +89,27 @@ def get_engine(onnx_file_path, engine_file_path=""):
 def main():
     """Create a TensorRT engine for ONNX-based YOLOv3-608 and run inference."""
 
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--stream", help="run the pipelined detection over a video file or a directory of frames")
+    parser.add_argument("--output", help="directory (or video file) for the annotated frames of --stream")
+    parser.add_argument("--queue-size", type=int, default=4, help="capacity of the queues between the --stream stages")
+    parser.add_argument("--max-frames", type=int, default=0, help="stop --stream after this many frames")
+    args = parser.parse_args()
+
     # Try to load a previously generated YOLOv3-608 network graph in ONNX format:
     onnx_file_path = "yolov3.onnx"
     engine_file_path = "yolov3.trt"
+
+    if args.stream:
+        from detect_stream import TensorRTBackend, run_stream
+
+        backend = TensorRTBackend(onnx_file_path, engine_file_path)
+        try:
+            run_stream(backend, args.stream, args.output, args.queue_size, args.max_frames)
+        finally:
+            backend.close()
+        return
+
     # Download a dog image and save it to the following file path:
     input_image_path = getFilePath("samples/python/yolov3_onnx/dog.jpg")
     # Two-dimensional tuple with the target network's (spatial) input resolution in HW ordered
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+#
+# SPDX-License-Identifier: Apache-2.0
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Tiled YOLOv3 detection for images larger than the network input: the image is cut into
+overlapping tiles at native resolution, the tiles run through the fixed shape network in
+batches, and the detections are mapped back to the image and merged with a global NMS."""
+
+from __future__ import print_function
+
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from data_processing import ALL_CATEGORIES, draw_bboxes
+from nms import batched_nms
+
+
+def tile_origins(length, tile, overlap):
+    """Return the start offsets of tiles of size tile covering [0, length) with at least
+    overlap pixels of overlap, the last tile ending exactly at length."""
+    if not 0 <= overlap < tile:
+        raise ValueError("The overlap ({}) has to be in [0, {}).".format(overlap, tile))
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    num_tiles = int(np.ceil((length - tile) / stride)) + 1
+    # Spread the tiles evenly, so all the overlaps are about the same:
+    return [int(round(index * (length - tile) / (num_tiles - 1))) for index in range(num_tiles)]
+
+
+class TiledDetector(object):
+    """Detect objects in a large image with overlapping network sized tiles."""
+
+    def __init__(self, infer, postprocessor, batch_size=1, overlap=96, fill_value=128):
+        """Keyword arguments:
+        infer -- function of a (batch_size,3,height,width) float32 array returning the three YOLO
+        outputs in NCHW format (e.g. a TensorRT or ONNX Runtime backend with a fixed batch size)
+        postprocessor -- a PostprocessYOLO for the network input resolution
+        batch_size -- tiles per inference, the last batch is padded to this size
+        overlap -- minimum overlap of neighbouring tiles, in pixels; objects smaller than
+        this are always fully inside at least one tile
+        fill_value -- the 8-bit gray level padding images smaller than a tile
+        """
+        self.infer = infer
+        self.postprocessor = postprocessor
+        self.batch_size = batch_size
+        self.overlap = overlap
+        self.fill_value = fill_value
+        self.tile_h, self.tile_w = postprocessor.input_resolution_yolo
+        # Fail early on an overlap the smaller tile side cannot take (ValueError):
+        tile_origins(max(self.tile_h, self.tile_w), min(self.tile_h, self.tile_w), overlap)
+        self._batch = np.empty((batch_size, 3, self.tile_h, self.tile_w), dtype=np.float32)
+        self.last_stats = dict()
+
+    def tiles(self, image):
+        """Return the HWC uint8 image (padded to at least one tile) and the list of (x, y)
+        tile origins covering it."""
+        pixels = np.asarray(image.convert("RGB"))
+        height, width = pixels.shape[:2]
+        if height < self.tile_h or width < self.tile_w:
+            padded = np.full((max(height, self.tile_h), max(width, self.tile_w), 3), self.fill_value, dtype=np.uint8)
+            padded[:height, :width] = pixels
+            pixels = padded
+        origins = [
+            (x, y)
+            for y in tile_origins(pixels.shape[0], self.tile_h, self.overlap)
+            for x in tile_origins(pixels.shape[1], self.tile_w, self.overlap)
+        ]
+        return pixels, origins
+
+    def detect(self, image):
+        """Return the boxes (in image pixels, clipped to the image), categories and confidences
+        detected in a PIL Image, or None, None, None when there are none. The timings are stored in last_stats."""
+        start = time.perf_counter()
+        pixels, origins = self.tiles(image)
+        prepare_time = infer_time = postprocess_time = 0.0
+
+        boxes, categories, confidences = list(), list(), list()
+        for batch_start in range(0, len(origins), self.batch_size):
+            batch_origins = origins[batch_start : batch_start + self.batch_size]
+
+            prepare_start = time.perf_counter()
+            for slot, (x, y) in enumerate(batch_origins):
+                # The tile is a view of the image, normalized and transposed straight into its slot:
+                tile = pixels[y : y + self.tile_h, x : x + self.tile_w]
+                np.divide(tile.transpose(2, 0, 1), np.float32(255.0), out=self._batch[slot], dtype=np.float32)
+            if len(batch_origins) < self.batch_size:
+                self._batch[len(batch_origins) :] = 0.0
+            infer_start = time.perf_counter()
+            outputs = self.infer(self._batch)
+            postprocess_start = time.perf_counter()
+
+            # The first len(batch_origins) images are the tiles, the rest is padding:
+            outputs = [np.asarray(output)[: len(batch_origins)] for output in outputs]
+            tile_boxes, tile_categories, tile_confidences, offsets = self.postprocessor.process_batch(
+                outputs, [(self.tile_w, self.tile_h)] * len(batch_origins)
+            )
+            tile_index = np.repeat(np.arange(len(batch_origins)), np.diff(offsets))
+            tile_boxes[:, :2] += np.array(batch_origins, dtype=np.float64)[tile_index]
+            boxes.append(tile_boxes)
+            categories.append(tile_categories)
+            confidences.append(tile_confidences)
+
+            prepare_time += infer_start - prepare_start
+            infer_time += postprocess_start - infer_start
+            postprocess_time += time.perf_counter() - postprocess_start
+
+        # Global NMS, merging the duplicates detected in the overlaps of neighbouring tiles:
+        merge_start = time.perf_counter()
+        boxes = np.concatenate(boxes)
+        categories = np.concatenate(categories)
+        confidences = np.concatenate(confidences)
+        num_candidates = len(boxes)
+        keep = batched_nms(boxes, confidences, categories, self.postprocessor.nms_threshold)
+        boxes, categories, confidences = boxes[keep], categories[keep], confidences[keep]
+        # Clip to the image, the tiles of a small image extend into the fill_value padding:
+        corners = np.clip(
+            np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1), 0.0, np.tile(image.size, 2).astype(np.float64)
+        )
+        boxes = np.concatenate([corners[:, :2], corners[:, 2:] - corners[:, :2]], axis=1)
+        inside = np.all(boxes[:, 2:] > 0.0, axis=1)
+        boxes, categories, confidences = boxes[inside], categories[inside], confidences[inside]
+        end = time.perf_counter()
+
+        total_time = end - start
+        self.last_stats = {
+            "tiles": len(origins),
+            "batches": (len(origins) + self.batch_size - 1) // self.batch_size,
+            "time": total_time,
+            "tiles_per_sec": len(origins) / total_time if total_time > 0 else 0.0,
+            "prepare_time": prepare_time,
+            "infer_time": infer_time,
+            "postprocess_time": postprocess_time,
+            "merge_time": end - merge_start,
+            "tile_detections": num_candidates,
+            "detections": len(boxes),
+        }
+        if len(boxes) == 0:
+            return None, None, None
+        return boxes, categories, confidences
+
+
+def main():
+    # detect_stream is imported here, it pulls the inference backends:
+    from detect_stream import OnnxRuntimeBackend, get_postprocessor
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("image", help="the (large) input image")
+    parser.add_argument("--onnx", default="yolov3.onnx", help="ONNX model, see yolov3_to_onnx.py")
+    parser.add_argument("--batch-size", type=int, default=1, help="tiles per inference, must match the model batch size")
+    parser.add_argument("--overlap", type=int, default=96, help="minimum overlap of neighbouring tiles, in pixels")
+    parser.add_argument("--output", help="save the image with the detections to this path")
+    args = parser.parse_args()
+
+    input_resolution_yolov3_HW = (608, 608)
+    backend = OnnxRuntimeBackend(args.onnx)
+    detector = TiledDetector(backend.infer, get_postprocessor(input_resolution_yolov3_HW), args.batch_size, args.overlap)
+
+    image = Image.open(args.image)
+    image.load()
+    # The first run compiles the post-processing kernels, only the second is timed:
+    detector.detect(image)
+    boxes, categories, confidences = detector.detect(image)
+    stats = detector.last_stats
+    print(
+        "%d tiles in %d batches: %.1f tiles/s (%.2f s; prepare %.2f s, infer %.2f s, postprocess %.2f s, merge %.3f s)"
+        % (
+            stats["tiles"],
+            stats["batches"],
+            stats["tiles_per_sec"],
+            stats["time"],
+            stats["prepare_time"],
+            stats["infer_time"],
+            stats["postprocess_time"],
+            stats["merge_time"],
+        )
+    )
+    print("%d tile detections merged into %d" % (stats["tile_detections"], stats["detections"]))
+
+    if args.output and boxes is not None:
+        draw_bboxes(image.convert("RGB"), boxes, confidences, categories, ALL_CATEGORIES, verbose=False).save(args.output)
+        print("Saved image with bounding boxes of detected objects to {}.".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,11 +18,17 @@
 
 from __future__ import print_function
 from collections import OrderedDict
+import argparse
+import copy
+import hashlib
+import io
+import json
 import sys
 import os
 
 import onnx
 from onnx import helper
+from onnx import numpy_helper
 from onnx import TensorProto
 import numpy as np
 
@@ -33,6 +39,9 @@ from downloader import getFilePath
 class DarkNetParser(object):
     """Definition of a parser for DarkNet-based YOLOv3-608 (only tested for this topology)."""
 
+    # Version of the format of the parse cache files, part of their key:
+    CACHE_VERSION = 1
+
     def __init__(self, supported_layers):
         """Initializes a DarkNetParser object.
         Keyword argument:
@@ -46,24 +55,49 @@ class DarkNetParser(object):
         self.supported_layers = supported_layers
         self.layer_counter = 0
 
-    def parse_cfg_file(self, cfg_file_path):
+    def parse_cfg_file(self, cfg_file_path, cache_dir=None):
         """Takes the yolov3.cfg file and parses it layer by layer,
         appending each layer's parameters as a dictionary to layer_configs.
         Keyword argument:
         cfg_file_path -- path to the yolov3.cfg file as string
+        cache_dir -- optional directory caching the parsed layers of every cfg file by the
+        hash of its content (and of the supported layers), so that a file that was already
+        parsed is not parsed again (default: None for no cache)
         """
-        with open(cfg_file_path) as cfg_file:
-            remainder = cfg_file.read()
-            while remainder is not None:
-                layer_dict, layer_name, remainder = self._next_layer(remainder)
-                if layer_dict is not None:
-                    self.layer_configs[layer_name] = layer_dict
+        if cache_dir is None:
+            with open(cfg_file_path) as cfg_file:
+                for layer_type, param_lines in self._layer_blocks(cfg_file):
+                    self._add_layer(layer_type, self._parse_layer_params(layer_type, param_lines))
+            return self.layer_configs
+
+        with open(cfg_file_path, "rb") as cfg_file:
+            content = cfg_file.read()
+        key = hashlib.sha256()
+        key.update(("%d\0%s\0" % (self.CACHE_VERSION, ",".join(self.supported_layers))).encode())
+        key.update(content)
+        cache_file_path = os.path.join(cache_dir, key.hexdigest() + ".json")
+        if os.path.exists(cache_file_path):
+            with open(cache_file_path) as cache_file:
+                layers = json.load(cache_file)
+        else:
+            layers = [
+                (layer_type, self._parse_layer_params(layer_type, param_lines))
+                for layer_type, param_lines in self._layer_blocks(io.StringIO(content.decode()))
+            ]
+            os.makedirs(cache_dir, exist_ok=True)
+            # Written to a temporary file and renamed, so a concurrent conversion never reads
+            # a partial cache file:
+            temporary_file_path = "%s.%d.tmp" % (cache_file_path, os.getpid())
+            with open(temporary_file_path, "w") as cache_file:
+                json.dump(layers, cache_file)
+            os.replace(temporary_file_path, cache_file_path)
+        for layer_type, layer_dict in layers:
+            self._add_layer(layer_type, layer_dict)
         return self.layer_configs
 
-    def _next_layer(self, remainder):
-        """Takes in a string and segments it by looking for DarkNet delimiters.
-        Returns the layer parameters and the remaining string after the last delimiter.
-        Example for the first Conv layer in yolo.cfg ...
+    def _layer_blocks(self, lines):
+        """Single pass over the lines of a DarkNet cfg file, yielding the type and the parameter
+        lines of every layer. Example for the first Conv layer in yolo.cfg ...
         [convolutional]
         batch_normalize=1
         filters=32
@@ -71,39 +105,60 @@ class DarkNetParser(object):
         stride=1
         pad=1
         activation=leaky
-        ... becomes the following layer_dict return value:
+        ... yields 'convolutional' and the six parameter lines. The parameters of a layer
+        end at its first empty line: everything until the next layer is ignored, like the
+        training parameters after the first paragraph of [net].
+        Keyword argument:
+        lines -- an iterable of the lines of the cfg file, e.g. the open file
+        """
+        layer_type = None
+        param_lines = None
+        for line in lines:
+            line = line.rstrip("\r\n")
+            if line.startswith("["):
+                if layer_type is not None:
+                    yield layer_type, param_lines
+                layer_type = line[1 : line.index("]")]
+                param_lines = list()
+            elif param_lines is not None:
+                if line.strip():
+                    param_lines.append(line)
+                else:
+                    # End of the parameter block, ignore the lines until the next layer:
+                    yield layer_type, param_lines
+                    layer_type = None
+                    param_lines = None
+        if layer_type is not None:
+            yield layer_type, param_lines
+
+    def _parse_layer_params(self, layer_type, param_lines):
+        """Returns the parameter dictionary of a layer, e.g. for the first Conv layer in yolo.cfg
         {'activation': 'leaky', 'stride': 1, 'pad': 1, 'filters': 32,
         'batch_normalize': 1, 'type': 'convolutional', 'size': 3}.
-        '001_convolutional' is returned as layer_name, and all lines that follow in yolo.cfg
-        are returned as the next remainder.
-        Keyword argument:
-        remainder -- a string with all raw text after the previously parsed layer
+        Only the type is stored for layers that are not supported.
+        Keyword arguments:
+        layer_type -- the layer type in DarkNet naming convention
+        param_lines -- the parameter lines of the layer
         """
-        remainder = remainder.split("[", 1)
-        if len(remainder) == 2:
-            remainder = remainder[1]
-        else:
-            return None, None, None
-        remainder = remainder.split("]", 1)
-        if len(remainder) == 2:
-            layer_type, remainder = remainder
-        else:
-            return None, None, None
-        if remainder.replace(" ", "")[0] == "#":
-            remainder = remainder.split("\n", 1)[1]
-
-        layer_param_block, remainder = remainder.split("\n\n", 1)
-        layer_param_lines = layer_param_block.split("\n")[1:]
-        layer_name = str(self.layer_counter).zfill(3) + "_" + layer_type
         layer_dict = dict(type=layer_type)
         if layer_type in self.supported_layers:
-            for param_line in layer_param_lines:
+            for param_line in param_lines:
                 if param_line[0] == "#":
                     continue
                 param_type, param_value = self._parse_params(param_line)
                 layer_dict[param_type] = param_value
+        return layer_dict
+
+    def _add_layer(self, layer_type, layer_dict):
+        """Stores a layer dictionary in layer_configs, named after its index and type
+        (e.g. '001_convolutional').
+        Keyword arguments:
+        layer_type -- the layer type in DarkNet naming convention
+        layer_dict -- the parameter dictionary of the layer
+        """
+        layer_name = str(self.layer_counter).zfill(3) + "_" + layer_type
+        self.layer_configs[layer_name] = layer_dict
         self.layer_counter += 1
-        return layer_dict, layer_name, remainder
 
     def _parse_params(self, param_line):
         """Identifies the parameters contained in one of the cfg file and returns
@@ -159,18 +214,21 @@ class ConvParams(object):
     weights, checking on feasible combinations.
     """
 
-    def __init__(self, node_name, batch_normalize, conv_weight_dims):
+    def __init__(self, node_name, batch_normalize, conv_weight_dims, fold_batchnorm=False):
         """Constructor based on the base node name (e.g. 101_convolutional), the batch
         normalization setting, and the convolutional weights shape.
         Keyword arguments:
         node_name -- base name of this YOLO convolutional layer
         batch_normalize -- bool value if batch normalization is used
         conv_weight_dims -- the dimensions of this layer's convolutional weights
+        fold_batchnorm -- the batch normalization is folded into the convolution weights
+        and a convolution bias (only the conv parameters are created)
         """
         self.node_name = node_name
         self.batch_normalize = batch_normalize
         assert len(conv_weight_dims) == 4
         self.conv_weight_dims = conv_weight_dims
+        self.fold_batchnorm = batch_normalize and fold_batchnorm
 
     def generate_param_name(self, param_category, suffix):
         """Generates a name based on two string inputs,
@@ -184,7 +242,7 @@ class ConvParams(object):
         elif param_category == "conv":
             assert suffix in ["weights", "bias"]
             if suffix == "bias":
-                assert not self.batch_normalize
+                assert not self.batch_normalize or self.fold_batchnorm
         param_name = self.node_name + "_" + param_category + "_" + suffix
         return param_name
 
@@ -214,17 +272,21 @@ class ResizeParams(object):
 
 
 class WeightLoader(object):
-    """Helper class used for loading the serialized weights of a binary file stream
+    """Helper class used for loading the serialized weights of a memory-mapped binary file
     and returning the initializers and the input tensors required for populating
     the ONNX graph with weights.
     """
 
-    def __init__(self, weights_file_path):
+    def __init__(self, weights_file_path, epsilon_bn=1e-5):
         """Initialized with a path to the YOLOv3 .weights file.
         Keyword argument:
         weights_file_path -- path to the weights file.
+        epsilon_bn -- the batch normalization epsilon, for folding it into convolutions
         """
-        self.weights_file = self._open_weights_file(weights_file_path)
+        self.weights = self._open_weights_file(weights_file_path)
+        self.epsilon_bn = epsilon_bn
+        # Offset of the next parameter, in float32 elements:
+        self.offset = 0
 
     def load_resize_scales(self, resize_params):
         """Returns the initializers with the value of the scale input
@@ -237,7 +299,7 @@ class WeightLoader(object):
         name = resize_params.generate_param_name()
         shape = resize_params.value.shape
         data = resize_params.value
-        scale_init = helper.make_tensor(name, TensorProto.FLOAT, shape, data)
+        scale_init = numpy_helper.from_array(np.asarray(data, dtype=np.float32), name)
         scale_input = helper.make_tensor_value_info(name, TensorProto.FLOAT, shape)
         initializer.append(scale_init)
         inputs.append(scale_input)
@@ -247,7 +309,7 @@ class WeightLoader(object):
         rank = 4
         roi_name = resize_params.generate_roi_name()
         roi_input = helper.make_tensor_value_info(roi_name, TensorProto.FLOAT, [rank])
-        roi_init = helper.make_tensor(roi_name, TensorProto.FLOAT, [rank], [0, 0, 0, 0])
+        roi_init = numpy_helper.from_array(np.zeros(rank, dtype=np.float32), roi_name)
         initializer.append(roi_init)
         inputs.append(roi_input)
 
@@ -261,6 +323,8 @@ class WeightLoader(object):
         """
         initializer = list()
         inputs = list()
+        if conv_params.fold_batchnorm:
+            return self._create_folded_param_tensors(conv_params)
         if conv_params.batch_normalize:
             bias_init, bias_input = self._create_param_tensors(conv_params, "bn", "bias")
             bn_scale_init, bn_scale_input = self._create_param_tensors(conv_params, "bn", "scale")
@@ -277,15 +341,43 @@ class WeightLoader(object):
         inputs.append(conv_input)
         return initializer, inputs
 
+    def _create_folded_param_tensors(self, conv_params):
+        """Creates the initializers and input tensors of a convolution with its batch
+        normalization folded in: W' = W * scale / sqrt(var + eps) per output channel and
+        b' = bias - mean * scale / sqrt(var + eps), computed in float64 and stored as float32.
+        Keyword argument:
+        conv_params -- a ConvParams object with fold_batchnorm set
+        """
+        # The DarkNet order is the bn bias, scale, mean, var and then the conv weights:
+        bn_params = dict()
+        for suffix in ["bias", "scale", "mean", "var"]:
+            _, param_data, _ = self._load_one_param_type(conv_params, "bn", suffix)
+            bn_params[suffix] = param_data.astype(np.float64)
+        weights_name, weights_data, weights_shape = self._load_one_param_type(conv_params, "conv", "weights")
+
+        factor = bn_params["scale"] / np.sqrt(bn_params["var"] + self.epsilon_bn)
+        weights = (weights_data.astype(np.float64) * factor[:, None, None, None]).astype(np.float32)
+        bias = (bn_params["bias"] - bn_params["mean"] * factor).astype(np.float32)
+
+        bias_name = conv_params.generate_param_name("conv", "bias")
+        initializer = [numpy_helper.from_array(bias, bias_name), numpy_helper.from_array(weights, weights_name)]
+        inputs = [
+            helper.make_tensor_value_info(bias_name, TensorProto.FLOAT, list(bias.shape)),
+            helper.make_tensor_value_info(weights_name, TensorProto.FLOAT, weights_shape),
+        ]
+        return initializer, inputs
+
     def _open_weights_file(self, weights_file_path):
-        """Opens a YOLOv3 DarkNet file stream and skips the header.
+        """Memory-maps a YOLOv3 DarkNet weights file and returns its parameters (after the
+        header) as a read-only little-endian float32 array; nothing is read before it is used.
         Keyword argument:
         weights_file_path -- path to the weights file.
         """
-        weights_file = open(weights_file_path, "rb")
-        length_header = 5
-        np.ndarray(shape=(length_header,), dtype="int32", buffer=weights_file.read(length_header * 4))
-        return weights_file
+        # The header is the major, minor and revision int32 version numbers and the number
+        # of images seen during training, an int64 since version 0.2:
+        major, minor, _ = np.fromfile(weights_file_path, dtype="<i4", count=3)
+        length_header = 20 if major * 10 + minor >= 2 else 16
+        return np.memmap(weights_file_path, dtype="<f4", mode="r", offset=length_header)
 
     def _create_param_tensors(self, conv_params, param_category, suffix):
         """Creates the initializers with weights from the weights file together with
@@ -298,12 +390,13 @@ class WeightLoader(object):
         """
         param_name, param_data, param_data_shape = self._load_one_param_type(conv_params, param_category, suffix)
 
-        initializer_tensor = helper.make_tensor(param_name, TensorProto.FLOAT, param_data_shape, param_data)
+        # The float32 view is copied once, as raw bytes, into the tensor:
+        initializer_tensor = numpy_helper.from_array(param_data, param_name)
         input_tensor = helper.make_tensor_value_info(param_name, TensorProto.FLOAT, param_data_shape)
         return initializer_tensor, input_tensor
 
     def _load_one_param_type(self, conv_params, param_category, suffix):
-        """Deserializes the weights from a file stream in the DarkNet order.
+        """Returns a float32 view of the next weights of the memory-mapped file, in the DarkNet order.
         Keyword arguments:
         conv_params -- a ConvParams object
         param_category -- the category of parameters to be created ('bn' or 'conv')
@@ -319,24 +412,40 @@ class WeightLoader(object):
                 param_shape = [channels_out, channels_in, filter_h, filter_w]
             elif suffix == "bias":
                 param_shape = [channels_out]
-        param_size = np.product(np.array(param_shape))
-        param_data = np.ndarray(shape=param_shape, dtype="float32", buffer=self.weights_file.read(param_size * 4))
-        param_data = param_data.flatten().astype(float)
+        param_size = int(np.prod(param_shape))
+        if self.offset + param_size > self.weights.size:
+            raise ValueError("The weights file is too short for {}".format(param_name))
+        param_data = self.weights[self.offset : self.offset + param_size].reshape(param_shape)
+        self.offset += param_size
         return param_name, param_data, param_shape
 
 
 class GraphBuilderONNX(object):
     """Class for creating an ONNX graph from a previously generated list of layer dictionaries."""
 
-    def __init__(self, output_tensors):
+    def __init__(self, output_tensors=None, fold_batchnorm=False, input_resolution=None, batch_size=None):
         """Initialize with all DarkNet default parameters used creating YOLOv3,
         and specify the output tensors as an OrderedDict for their output dimensions
         with their names as keys.
         Keyword argument:
         output_tensors -- the output tensors as an OrderedDict containing the keys'
-        output dimensions
+        output dimensions (default: None for the convolutions feeding the 'yolo' layers,
+        with their dimensions derived from the input resolution)
+        fold_batchnorm -- fold every batch normalization into the weights and bias of its
+        convolution, instead of emitting BatchNormalization nodes
+        input_resolution -- the input height and width, or one int for a square input,
+        overriding the ones of the 'net' layer (default: None)
+        batch_size -- the batch dimension of the input and outputs: an int, a string for a
+        symbolic dimension (e.g. 'N'), or None for the 'batch' of the 'net' layer
         """
         self.output_tensors = output_tensors
+        self.fold_batchnorm = fold_batchnorm
+        if isinstance(input_resolution, int):
+            input_resolution = (input_resolution, input_resolution)
+        self.input_resolution = input_resolution
+        self.batch_size_override = batch_size
+        # Spatial (height, width) of the output of every created major node, by its name:
+        self._spatial_dims = dict()
         self._nodes = list()
         self.graph_def = None
         self.input_tensor = None
@@ -347,7 +456,7 @@ class GraphBuilderONNX(object):
         self.major_node_specs = list()
         self.batch_size = 1
 
-    def build_onnx_graph(self, layer_configs, weights_file_path, verbose=True):
+    def build_onnx_graph(self, layer_configs, weights_file_path, verbose=True, weight_loader=None):
         """Iterate over all layer configs (parsed from the DarkNet representation
         of YOLOv3-608), create an ONNX graph, populate it with weights from the weights
         file and return the graph definition.
@@ -355,12 +464,16 @@ class GraphBuilderONNX(object):
         layer_configs -- an OrderedDict object with all parsed layers' configurations
         weights_file_path -- location of the weights file
         verbose -- toggles if the graph is printed after creation (default: True)
+        weight_loader -- an already opened WeightLoader to read the weights from, from the
+        start of the file, instead of weights_file_path (default: None)
         """
         for layer_name in layer_configs.keys():
             layer_dict = layer_configs[layer_name]
             major_node_specs = self._make_onnx_node(layer_name, layer_dict)
             if major_node_specs.name is not None:
                 self.major_node_specs.append(major_node_specs)
+        if self.output_tensors is None:
+            self.output_tensors = self._derive_output_tensors(layer_configs)
         outputs = list()
         for tensor_name in self.output_tensors.keys():
             output_dims = [
@@ -369,7 +482,10 @@ class GraphBuilderONNX(object):
             output_tensor = helper.make_tensor_value_info(tensor_name, TensorProto.FLOAT, output_dims)
             outputs.append(output_tensor)
         inputs = [self.input_tensor]
-        weight_loader = WeightLoader(weights_file_path)
+        if weight_loader is None:
+            weight_loader = WeightLoader(weights_file_path, self.epsilon_bn)
+        else:
+            weight_loader.offset = 0
         initializer = list()
         # If a layer has parameters, add them to the initializer and input lists.
         for layer_name in self.param_dict.keys():
@@ -384,14 +500,35 @@ class GraphBuilderONNX(object):
                 initializer.extend(initializer_layer)
                 inputs.extend(inputs_layer)
         del weight_loader
+        graph_name = "YOLOv3-%d" % self.input_tensor.type.tensor_type.shape.dim[2].dim_value
         self.graph_def = helper.make_graph(
-            nodes=self._nodes, name="YOLOv3-608", inputs=inputs, outputs=outputs, initializer=initializer
+            nodes=self._nodes, name=graph_name, inputs=inputs, outputs=outputs, initializer=initializer
         )
         if verbose:
             print(helper.printable_graph(self.graph_def))
         model_def = helper.make_model(self.graph_def, producer_name="NVIDIA TensorRT sample")
         return model_def
 
+    def _derive_output_tensors(self, layer_configs):
+        """Return the output tensors as an OrderedDict of their CHW dimensions: the outputs of
+        the convolutions right before the 'yolo' layers, in the order of the cfg file.
+        Keyword argument:
+        layer_configs -- an OrderedDict object with all parsed layers' configurations
+        """
+        output_tensors = OrderedDict()
+        layer_names = list(layer_configs.keys())
+        for index, layer_name in enumerate(layer_names):
+            if layer_configs[layer_name]["type"] != "yolo":
+                continue
+            output_name = layer_names[index - 1]
+            output_dict = layer_configs[output_name]
+            if output_dict["type"] != "convolutional" or output_dict["activation"] != "linear":
+                raise ValueError("The layer before {} is not a linear convolution.".format(layer_name))
+            output_tensors[output_name] = [output_dict["filters"]] + list(self._spatial_dims[output_name])
+        if not output_tensors:
+            raise ValueError("The cfg file has no 'yolo' layers, the output tensors have to be given.")
+        return output_tensors
+
     def _make_onnx_node(self, layer_name, layer_dict):
         """Take in a layer parameter dictionary, choose the correct function for
         creating an ONNX node and store the information important to graph creation
@@ -429,10 +566,15 @@ class GraphBuilderONNX(object):
         layer_dict -- a layer parameter dictionary (one element of layer_configs)
         """
         batch_size = layer_dict["batch"]
+        if self.batch_size_override is not None:
+            batch_size = self.batch_size_override
         channels = layer_dict["channels"]
         height = layer_dict["height"]
         width = layer_dict["width"]
+        if self.input_resolution is not None:
+            height, width = self.input_resolution
         self.batch_size = batch_size
+        self._spatial_dims[layer_name] = (height, width)
         input_tensor = helper.make_tensor_value_info(
             str(layer_name), TensorProto.FLOAT, [batch_size, channels, height, width]
         )
@@ -473,13 +615,13 @@ class GraphBuilderONNX(object):
 
         kernel_shape = [kernel_size, kernel_size]
         weights_shape = [filters, previous_channels] + kernel_shape
-        conv_params = ConvParams(layer_name, batch_normalize, weights_shape)
+        conv_params = ConvParams(layer_name, batch_normalize, weights_shape, self.fold_batchnorm)
 
         strides = [stride, stride]
         dilations = [1, 1]
         weights_name = conv_params.generate_param_name("conv", "weights")
         inputs.append(weights_name)
-        if not batch_normalize:
+        if not batch_normalize or conv_params.fold_batchnorm:
             bias_name = conv_params.generate_param_name("conv", "bias")
             inputs.append(bias_name)
 
@@ -497,7 +639,7 @@ class GraphBuilderONNX(object):
         inputs = [layer_name]
         layer_name_output = layer_name
 
-        if batch_normalize:
+        if batch_normalize and not conv_params.fold_batchnorm:
             layer_name_bn = layer_name + "_bn"
             bn_param_suffixes = ["scale", "bias", "mean", "var"]
             for suffix in bn_param_suffixes:
@@ -529,6 +671,10 @@ class GraphBuilderONNX(object):
         else:
             print("Activation not supported.")
 
+        # With auto_pad SAME, the output is the input divided by the stride, rounded up:
+        height, width = self._spatial_dims[previous_node_specs.name]
+        self._spatial_dims[layer_name] = (-(-height // stride), -(-width // stride))
+        self._spatial_dims[layer_name_output] = self._spatial_dims[layer_name]
         self.param_dict[layer_name] = conv_params
         return layer_name_output, filters
 
@@ -555,6 +701,7 @@ class GraphBuilderONNX(object):
             name=layer_name,
         )
         self._nodes.append(shortcut_node)
+        self._spatial_dims[layer_name] = self._spatial_dims[first_node_specs.name]
         return layer_name, channels
 
     def _make_route_node(self, layer_name, layer_dict):
@@ -577,6 +724,7 @@ class GraphBuilderONNX(object):
         else:
             inputs = list()
             channels = 0
+            spatial_dims = set()
             for index in route_node_indexes:
                 if index > 0:
                     # Increment by one because we count the input as a node (DarkNet
@@ -585,8 +733,15 @@ class GraphBuilderONNX(object):
                 route_node_specs = self._get_previous_node_specs(target_index=index)
                 inputs.append(route_node_specs.name)
                 channels += route_node_specs.channels
+                spatial_dims.add(self._spatial_dims[route_node_specs.name])
             assert inputs
             assert channels > 0
+            if len(spatial_dims) != 1:
+                raise ValueError(
+                    "{} concatenates tensors of sizes {}, the input resolution has to be a multiple of "
+                    "the largest stride of the network (32 for YOLOv3).".format(layer_name, sorted(spatial_dims))
+                )
+            self._spatial_dims[layer_name] = spatial_dims.pop()
 
             route_node = helper.make_node(
                 "Concat",
@@ -632,12 +787,165 @@ class GraphBuilderONNX(object):
             name=layer_name,
         )
         self._nodes.append(resize_node)
+        height, width = self._spatial_dims[previous_node_specs.name]
+        self._spatial_dims[layer_name] = (int(height * resize_scale_factors), int(width * resize_scale_factors))
         self.param_dict[layer_name] = resize_params
         return layer_name, channels
 
 
+def with_symbolic_batch(model_def, batch_name="N"):
+    """Return a copy of an ONNX model whose inputs and outputs have a symbolic batch dimension.
+    Keyword arguments:
+    model_def -- an ONNX ModelProto
+    batch_name -- the name of the symbolic dimension
+    """
+    model_def = copy.deepcopy(model_def)
+    for value_info in list(model_def.graph.input[:1]) + list(model_def.graph.output):
+        value_info.type.tensor_type.shape.dim[0].dim_param = batch_name
+    return model_def
+
+
+def build_onnx_models(layer_configs, weights_file_path, resolutions, fold_batchnorm=False, batch_size="N"):
+    """Build one ONNX model per input resolution from the same parsed layer configurations
+    and the same memory-mapped weights file, and return them in an OrderedDict by resolution.
+    The output dimensions are derived from every resolution.
+    Keyword arguments:
+    layer_configs -- an OrderedDict object with all parsed layers' configurations
+    weights_file_path -- location of the weights file
+    resolutions -- the square input resolutions, e.g. [320, 416, 608]
+    fold_batchnorm -- fold the batch normalizations into the convolutions
+    batch_size -- the batch dimension, symbolic by default (see GraphBuilderONNX)
+    """
+    weight_loader = WeightLoader(weights_file_path)
+    model_defs = OrderedDict()
+    for resolution in resolutions:
+        builder = GraphBuilderONNX(fold_batchnorm=fold_batchnorm, input_resolution=resolution, batch_size=batch_size)
+        model_defs[resolution] = builder.build_onnx_graph(
+            layer_configs=layer_configs, weights_file_path=weights_file_path, verbose=False, weight_loader=weight_loader
+        )
+    return model_defs
+
+
+def measure_latency(infer, input_shape, runs=50, warmup=5, seed=0):
+    """Return the latencies in milliseconds of runs calls of infer on a random float32 input.
+    Keyword arguments:
+    infer -- function of the (N,C,H,W) input array running the model
+    input_shape -- the input shape
+    runs -- number of timed calls
+    warmup -- number of untimed calls before them
+    seed -- seed of the random input
+    """
+    import time
+
+    image = np.random.default_rng(seed).uniform(0.0, 1.0, size=input_shape).astype(np.float32)
+    for _ in range(warmup):
+        infer(image)
+    latencies = np.empty(runs)
+    for run in range(runs):
+        start = time.perf_counter()
+        infer(image)
+        latencies[run] = (time.perf_counter() - start) * 1e3
+    return latencies
+
+
+def pick_resolution(model_paths, target_p99_ms, make_infer=None, runs=50, warmup=5):
+    """Return the largest resolution whose p99 latency at batch size 1 meets target_p99_ms on
+    the current backend (None if none does), and the p99 latencies measured so far, by resolution.
+    The resolutions are measured from the largest down, stopping at the first one that fits.
+    Keyword arguments:
+    model_paths -- a dict of ONNX model paths by square input resolution
+    target_p99_ms -- the latency budget, in milliseconds
+    make_infer -- function of a model path returning a function of the input array running the
+    model, e.g. wrapping a TensorRT engine (default: None for ONNX Runtime on the CPU)
+    runs, warmup -- see measure_latency
+    """
+    if make_infer is None:
+        import onnxruntime
+
+        def make_infer(model_path):
+            session = onnxruntime.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+            input_name = session.get_inputs()[0].name
+            return lambda image: session.run(None, {input_name: image})
+
+    latencies_p99 = OrderedDict()
+    for resolution in sorted(model_paths, reverse=True):
+        infer = make_infer(model_paths[resolution])
+        latencies = measure_latency(infer, [1, 3, resolution, resolution], runs, warmup)
+        latencies_p99[resolution] = float(np.percentile(latencies, 99))
+        del infer
+        if latencies_p99[resolution] <= target_p99_ms:
+            return resolution, latencies_p99
+    return None, latencies_p99
+
+
+def compare_onnx_models(reference_model_def, model_def, batch_size=1, seed=0):
+    """Run two ONNX models with the same inputs and outputs (e.g. without and with batch
+    normalization folding) with ONNX Runtime on the CPU, on the same random input, and return
+    a list with the maximum absolute and relative difference of every output, and both run times.
+    Keyword arguments:
+    reference_model_def, model_def -- the ONNX ModelProtos to compare
+    batch_size -- batch size of the random input
+    seed -- seed of the random input
+    """
+    import time
+    import onnxruntime
+
+    input_dims = [dim.dim_value for dim in reference_model_def.graph.input[0].type.tensor_type.shape.dim]
+    image = np.random.default_rng(seed).uniform(0.0, 1.0, size=[batch_size] + input_dims[1:]).astype(np.float32)
+    results = list()
+    for candidate in (reference_model_def, model_def):
+        session = onnxruntime.InferenceSession(
+            with_symbolic_batch(candidate).SerializeToString(), providers=["CPUExecutionProvider"]
+        )
+        start = time.perf_counter()
+        outputs = session.run(None, {session.get_inputs()[0].name: image})
+        results.append((outputs, time.perf_counter() - start))
+
+    (reference_outputs, reference_time), (outputs, run_time) = results
+    differences = list()
+    for reference, output in zip(reference_outputs, outputs):
+        absolute = np.abs(reference.astype(np.float64) - output)
+        differences.append(
+            {
+                "max_abs": float(absolute.max()),
+                "max_rel": float((absolute / np.maximum(np.abs(reference), 1e-3)).max()),
+                "reference_time": reference_time,
+                "time": run_time,
+            }
+        )
+    return differences
+
+
 def main():
     """Run the DarkNet-to-ONNX conversion for YOLOv3-608."""
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument(
+        "--fold-batchnorm", action="store_true", help="fold the batch normalizations into the convolutions"
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="with --fold-batchnorm, also build the unfolded graph and compare both with ONNX Runtime",
+    )
+    parser.add_argument(
+        "--resolutions",
+        type=int,
+        nargs="+",
+        help="export yolov3-<resolution>.onnx with a symbolic batch size for each of these square input "
+        "resolutions (multiples of 32), instead of yolov3.onnx",
+    )
+    parser.add_argument(
+        "--latency-budget",
+        type=float,
+        help="with --resolutions, print the largest resolution whose p99 latency (ms) on ONNX Runtime meets this",
+    )
+    parser.add_argument(
+        "--cfg-cache-dir",
+        default=os.path.join(os.path.expanduser("~"), ".cache", "yolov3_onnx"),
+        help="directory caching the parsed cfg files by content hash, empty to always parse",
+    )
+    args = parser.parse_args()
+
     cfg_file_path = getFilePath("samples/python/yolov3_onnx/yolov3.cfg")
     # These are the only layers DarkNetParser will extract parameters from. The three layers of
     # type 'yolo' are not parsed in detail because they are included in the post-processing later:
@@ -646,10 +954,37 @@ def main():
     # Create a DarkNetParser object, and the use it to generate an OrderedDict with all
     # layer's configs from the cfg file:
     parser = DarkNetParser(supported_layers)
-    layer_configs = parser.parse_cfg_file(cfg_file_path)
+    layer_configs = parser.parse_cfg_file(cfg_file_path, cache_dir=args.cfg_cache_dir or None)
     # We do not need the parser anymore after we got layer_configs:
     del parser
 
+    weights_file_path = getFilePath("samples/python/yolov3_onnx/yolov3.weights")
+
+    if args.resolutions:
+        # One model per resolution from the same parse and weights mapping, the output
+        # dimensions are derived from the 'yolo' layers:
+        model_paths = OrderedDict()
+        model_defs = build_onnx_models(layer_configs, weights_file_path, args.resolutions, args.fold_batchnorm)
+        for resolution, model_def in model_defs.items():
+            onnx.checker.check_model(model_def)
+            model_paths[resolution] = "yolov3-{}.onnx".format(resolution)
+            onnx.save(model_def, model_paths[resolution])
+            output_dims = [
+                [dim.dim_param or dim.dim_value for dim in output.type.tensor_type.shape.dim]
+                for output in model_def.graph.output
+            ]
+            print("Saved {} with outputs {}".format(model_paths[resolution], output_dims))
+        del model_defs
+        if args.latency_budget is not None:
+            resolution, latencies_p99 = pick_resolution(model_paths, args.latency_budget)
+            for measured, latency_p99 in latencies_p99.items():
+                print("{}x{}: p99 latency {:.1f} ms".format(measured, measured, latency_p99))
+            if resolution is None:
+                print("No resolution meets the p99 latency budget of {} ms".format(args.latency_budget))
+            else:
+                print("Largest resolution within {} ms: {}x{}".format(args.latency_budget, resolution, resolution))
+        return
+
     # In above layer_config, there are three outputs that we need to know the output
     # shape of (in CHW format):
     output_tensor_dims = OrderedDict()
@@ -658,9 +993,7 @@ def main():
     output_tensor_dims["106_convolutional"] = [255, 76, 76]
 
     # Create a GraphBuilderONNX object with the known output tensor dimensions:
-    builder = GraphBuilderONNX(output_tensor_dims)
-
-    weights_file_path = getFilePath("samples/python/yolov3_onnx/yolov3.weights")
+    builder = GraphBuilderONNX(output_tensor_dims, fold_batchnorm=args.fold_batchnorm)
 
     # Now generate an ONNX graph with weights from the previously parsed layer configurations
     # and the weights file:
@@ -672,6 +1005,23 @@ def main():
 
     # Perform a sanity check on the ONNX model definition:
     onnx.checker.check_model(yolov3_model_def)
+    print(
+        "Created {} nodes and {} initializers".format(
+            len(yolov3_model_def.graph.node), len(yolov3_model_def.graph.initializer)
+        )
+    )
+
+    if args.fold_batchnorm and args.verify:
+        reference_model_def = GraphBuilderONNX(output_tensor_dims).build_onnx_graph(
+            layer_configs=layer_configs, weights_file_path=weights_file_path, verbose=False
+        )
+        for output, difference in zip(output_tensor_dims.keys(), compare_onnx_models(reference_model_def, yolov3_model_def)):
+            print(
+                "{}: max abs difference {:.3g}, max rel difference {:.3g}, ONNX Runtime {:.3f} s -> {:.3f} s".format(
+                    output, difference["max_abs"], difference["max_rel"], difference["reference_time"], difference["time"]
+                )
+            )
+        del reference_model_def
 
     # Serialize the generated ONNX graph to this file:
     output_file_path = "yolov3.onnx"